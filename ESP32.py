@@ -17,11 +17,13 @@ WIFI_PASSWORD = INSERT_PASSWORD
 # MQTT configuration
 MQTT_BROKER = INSERT_IP_BROKER
 MQTT_PORT = 1883
-TOPIC = 'home/data'
 
 # Unique MQTT client ID based on the machine's unique ID
 CLIENT_ID = ubinascii.hexlify(machine.unique_id())
 
+# MQTT topic for sensor data, scoped to this device so the server keeps one state per board
+TOPIC = 'home/data/' + CLIENT_ID.decode()
+
 
 ##################################################
 
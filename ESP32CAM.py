@@ -1,5 +1,6 @@
 import camera
 import os
+import json
 import time
 import machine
 import network
@@ -18,14 +19,41 @@ WIFI_PASSWORD = INSERT_PASSWORD
 MQTT_BROKER = INSERT_IP_BROKER
 MQTT_PORT = 1883
 
+# Seconds after which the broker drops a silent connection: a ping is sent when nothing
+# was sent for half of it
+MQTT_KEEPALIVE = 60
+
+# Delays (seconds) between reconnection attempts to the broker, doubling up to the maximum
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
 # Unique MQTT client ID based on the machine's unique ID
 CLIENT_ID = ubinascii.hexlify(machine.unique_id())
 
-# MQTT topic for Camera
-CAM_TOPIC = 'home/cam'
+# MQTT topic for Camera, scoped to this device so the server keeps one state per camera
+CAM_TOPIC = 'home/cam/' + CLIENT_ID.decode()
+
+# MQTT topic for monitoring, on which the server replies to this camera
+MONITORING_TOPIC = 'home/monitoring/' + CLIENT_ID.decode()
+
+# MQTT topic on which the server sets the capture interval and JPEG quality of this camera
+CONTROL_TOPIC = 'home/control/' + CLIENT_ID.decode()
 
-# MQTT topic for monitoring
-MONITORING_TOPIC = 'home/monitoring'
+# Capture settings used until the server sends its own: seconds between two captures,
+# JPEG quality (10 is the best, 63 the worst) and resolution (name of a camera.FRAME_*
+# constant, e.g. 'VGA', or None for the default of the driver)
+CAPTURE_INTERVAL = 5
+JPEG_QUALITY = 12
+FRAME_SIZE = None
+
+# Photos discarded after the camera is initialized, while the sensor adjusts its exposure
+WARMUP_FRAMES = 2
+
+# Photos are published straight from memory. While the broker is unreachable they are kept
+# in this flash folder, within QUEUE_MAX_BYTES (the oldest are dropped beyond it), and
+# published in order once it is back.
+QUEUE_FOLDER = 'queue'
+QUEUE_MAX_BYTES = 512 * 1024
 
 ##################################################
 
@@ -38,26 +66,61 @@ class Camera:
 		:param flash_pin (int): The pin number used for flash.
 		"""
 		self.flash = machine.Pin(flash_pin, machine.Pin.OUT)
+		self.flash_timer = machine.Timer(0)
+		# The camera stays initialized between photos, and is only initialized again
+		# after an error. The settings are applied again after each initialization.
+		self.ready = False
+		self.framesize = None
+		self.quality = None
 
 	def init_camera(self):
 		"""
-		Initializes the camera connected to the device.
+		Initializes the camera connected to the device, with the current resolution and
+		quality, and discards the first photos while the exposure settles.
 
 		:return bool: True if the camera is successfully initialized, otherwise False.
 		"""
 		try:
 			camera.init(0, format=camera.JPEG)
+			if self.framesize is not None:
+				camera.framesize(getattr(camera, 'FRAME_' + self.framesize))
+			if self.quality is not None:
+				camera.quality(self.quality)
+			for _ in range(WARMUP_FRAMES):
+				camera.capture()
 			print("Camera initialized successfully")
-			return True
+			self.ready = True
 		except Exception as e:
 			print(f"Error initializing the camera: {e}")
-			return False
-            
-    
+			self.deinit()
+		return self.ready
+
+	def configure(self, framesize=None, quality=None):
+		"""
+		Changes the resolution and JPEG quality of the next photos, in place if the camera
+		is initialized. Only the settings that changed are sent to the sensor.
+
+		:param framesize (str): Name of a camera.FRAME_* constant, e.g. 'VGA', or None to keep it.
+		:param quality (int): JPEG quality, from 10 (best) to 63 (worst), or None to keep it.
+		"""
+		try:
+			if framesize is not None and framesize != self.framesize:
+				if self.ready:
+					camera.framesize(getattr(camera, 'FRAME_' + framesize))
+				self.framesize = framesize
+			if quality is not None and quality != self.quality:
+				if self.ready:
+					camera.quality(quality)
+				self.quality = quality
+		except Exception as e:
+			print(f"Error configuring the camera: {e}")
+			self.deinit()
+
 	def deinit(self):
 		"""
 		Release the camera.
 		"""
+		self.ready = False
 		try:
 			camera.deinit()
 			print("Camera successfully disabled\n")
@@ -66,35 +129,24 @@ class Camera:
 
 	def capture_photo(self):
 		"""
-		Capture a photo with the camera.
+		Capture a photo with the camera, initializing it first if needed. After an error,
+		the camera is released and initialized again at the next photo.
 
 		:return bytes: The data of the captured photo, or None in case of error.
 		"""
+		if not self.ready and not self.init_camera():
+			return None
 		try:
 			photo = camera.capture()
+			if not photo:
+				raise OSError("empty frame")
 			print("Photo captured successfully")
 			return photo
 		except Exception as e:
 			print(f"Error capturing photo: {e}")
+			self.deinit()
 			return None
 
-
-
-	def save_photo(self, photo, path):
-		"""
-		Saves the photo to the specified location.
-
-		Args:
-		photo (bytes): The photo data to be saved.
-		path (str): The path where to save the photo.
-		"""
-		try:
-			with open(path, "wb") as file:
-				file.write(photo)
-				print("Photo saved to ", {path})
-		except Exception as e:
-			print(f"Error while saving the photo at {path}: {e}")
-
 	def turn_on_flash(self):
 		"""
 		Turns on the camera flash.
@@ -106,18 +158,112 @@ class Camera:
 		Turns off the camera flash.
 		"""
 	    	self.flash.off()
-    	
-	@staticmethod
-	def convert_image_to_binary(image_path):
+
+	def blink_flash(self, duration_ms=1000):
+		"""
+		Turns on the flash and turns it off after a while, without waiting.
+
+		:param duration_ms (int): Time the flash stays on, in milliseconds.
+		"""
+		self.turn_on_flash()
+		self.flash_timer.init(period=duration_ms, mode=machine.Timer.ONE_SHOT, callback=lambda timer: self.turn_off_flash())
+
+##################################################
+
+
+class FrameQueue:
+	"""
+	Photos waiting in flash for the broker, oldest first.
+
+	Flash is only written while the broker is unreachable, so it does not wear out in
+	normal operation. Each photo is one file named after a sequence number, so the queue
+	survives a reboot and keeps its order. Beyond max_bytes, the oldest photos are dropped.
+	"""
+
+	def __init__(self, folder=QUEUE_FOLDER, max_bytes=QUEUE_MAX_BYTES):
 		"""
-		Converts an image to binary data.
+		Initializes the queue with the photos left in the folder.
+
+		:param folder (str): The folder of the queued photos.
+		:param max_bytes (int): The flash budget of the queue, in bytes.
+		"""
+		self.folder = folder
+		self.max_bytes = max_bytes
+		try:
+			os.mkdir(folder)
+		except OSError:
+			pass  # The folder already exists
+		self.files = sorted(name for name in os.listdir(folder) if name.endswith('.jpg'))
+		self.sizes = {}
+		for name in self.files:
+			self.sizes[name] = os.stat(self._path(name))[6]
+		self.total = sum(self.sizes.values())
+		self.next_id = int(self.files[-1][:-4]) + 1 if self.files else 0
+
+	def __len__(self):
+		return len(self.files)
+
+	def _path(self, name):
+		return self.folder + '/' + name
+
+	def push(self, photo):
+		"""
+		Adds a photo at the end of the queue.
+
+		:param photo (bytes): The data of the photo.
+		"""
+		name = '{:08d}.jpg'.format(self.next_id)
+		self.next_id += 1
+		try:
+			with open(self._path(name), "wb") as file:
+				file.write(photo)
+		except OSError as e:
+			print(f"Error while queuing the photo: {e}")
+			return
+		self.files.append(name)
+		self.sizes[name] = len(photo)
+		self.total += len(photo)
+		while self.total > self.max_bytes and len(self.files) > 1:
+			print("Queue full, oldest photo dropped")
+			self._remove(self.files[0])
+
+	def _remove(self, name):
+		"""
+		Deletes the file of the first photo of the queue.
+
+		:param name (str): The file name of the photo.
+		"""
+		self.files.remove(name)
+		self.total -= self.sizes.pop(name, 0)
+		try:
+			os.remove(self._path(name))
+		except OSError as e:
+			print(f"Error deleting queued photo {name}: {e}")
 
-		:param image_path (str): The path of the image to convert.
+	def flush(self, session, topic):
+		"""
+		Publishes the queued photos, oldest first, until the queue is empty or the broker
+		becomes unreachable.
 
-		:return bytes: The binary data of the image.
+		:param session (MQTTSession): The MQTT session.
+		:param topic (str): The MQTT topic of the photos.
+		:return bool: True if the queue is empty, otherwise False.
 		"""
-		with open(image_path, "rb") as image_file:
-			return image_file.read()
+		while self.files:
+			name = self.files[0]
+			try:
+				with open(self._path(name), "rb") as file:
+					photo = file.read()
+			except OSError as e:
+				print(f"Error reading queued photo {name}: {e}")
+				self._remove(name)
+				continue
+			if not session.publish(topic, photo):
+				return False
+			self._remove(name)
+			print("Queued photo published,", len(self.files), "left")
+		return True
+
 
 ##################################################
 
@@ -140,26 +286,172 @@ def connect_wifi(ssid, password):
 
 
 ##################################################
-	
-	
-def publish_image_mqtt(binary_image, client_id, mqtt_broker, mqtt_port, topic):
+
+
+class MQTTSession:
+	"""
+	Long-lived MQTT connection, used both to publish the images and to receive the
+	messages of the server.
+
+	A ping is sent when nothing was sent for half the keepalive period, so the broker
+	keeps the connection. When the connection is lost, it is attempted again after a delay
+	doubling from RECONNECT_DELAY to RECONNECT_MAX_DELAY seconds. The attempts are made by
+	poll() and publish(), which never wait for the delay, so the camera keeps running
+	while the broker is unreachable. The topics are subscribed again on every connection.
 	"""
-	Publishes the image on a specified MQTT topic.
 
-	:param binary_image (bytes): The binary data of the image to be published.
-	:param mqtt_broker (str): The address of the MQTT broker.
-	:param mqtt_port (int): The port number of the MQTT broker.
-	:param topic (str): The MQTT topic where the image is to be published.
+	def __init__(self, client_id, broker, port, callback, topics, keepalive=MQTT_KEEPALIVE):
+		"""
+		Initializes the session.
+
+		:param client_id (bytes): The MQTT client ID.
+		:param broker (str): The address of the MQTT broker.
+		:param port (int): The port number of the MQTT broker.
+		:param callback (function): Function called with the topic and message received.
+		:param topics (list): Topics to subscribe to.
+		:param keepalive (int): Keepalive period in seconds.
+		"""
+		self.client = MQTTClient(client_id, broker, port, keepalive=keepalive)
+		self.client.set_callback(callback)
+		self.topics = topics
+		self.keepalive = keepalive
+		self.connected = False
+		self.delay = RECONNECT_DELAY
+		self.retry_at = time.ticks_ms()
+		self.last_sent = time.ticks_ms()
+
+	def connect(self):
+		"""
+		Connects to the broker and subscribes to the topics, unless the next attempt is
+		not due yet.
+
+		:return bool: True if the session is connected, otherwise False.
+		"""
+		if self.connected:
+			return True
+		if time.ticks_diff(time.ticks_ms(), self.retry_at) < 0:
+			return False
+		try:
+			self.client.connect()
+			for topic in self.topics:
+				self.client.subscribe(topic)
+		except Exception as e:
+			self._lost(e)
+			return False
+		print("Connected to the MQTT broker")
+		self.connected = True
+		self.delay = RECONNECT_DELAY
+		self.last_sent = time.ticks_ms()
+		return True
+
+	def _lost(self, error):
+		"""
+		Closes a failed connection and schedules the next attempt.
+
+		:param error (Exception): The error that ended the connection.
+		"""
+		print(f"MQTT connection lost ({error}), retrying in {self.delay} s")
+		try:
+			self.client.sock.close()
+		except Exception:
+			pass
+		self.connected = False
+		self.retry_at = time.ticks_add(time.ticks_ms(), int(self.delay * 1000))
+		self.delay = min(self.delay * 2, RECONNECT_MAX_DELAY)
+
+	def publish(self, topic, msg):
+		"""
+		Publishes a message on the session.
+
+		:param topic (str): The MQTT topic.
+		:param msg (bytes): The message.
+		:return bool: True if the message was sent, False if the broker is unreachable.
+		"""
+		if not self.connect():
+			return False
+		try:
+			self.client.publish(topic, msg)
+		except Exception as e:
+			self._lost(e)
+			return False
+		self.last_sent = time.ticks_ms()
+		return True
+
+	def poll(self):
+		"""
+		Handles the messages received, sends the keepalive ping when due and reconnects
+		when the connection was lost. Never blocks.
+		"""
+		if not self.connect():
+			return
+		try:
+			self.client.check_msg()
+			if time.ticks_diff(time.ticks_ms(), self.last_sent) >= self.keepalive * 500:
+				self.client.ping()
+				self.last_sent = time.ticks_ms()
+		except Exception as e:
+			self._lost(e)
+
+
+def parse_capture_settings(msg, settings):
+	"""
+	Updates the capture settings with a control message of the server.
+
+	A server of a cluster also sends the topic on which it receives the photos of this
+	camera. Without one, the photos are published on CAM_TOPIC.
+
+	:param msg (bytes): JSON message, e.g. b'{"interval": 30, "quality": 20, "framesize": "VGA"}'.
+	:param settings (dict): Capture settings to update.
 	"""
-	mqtt_client = MQTTClient(client_id, mqtt_broker, mqtt_port, keepalive=3600)
 	try:
-		mqtt_client.connect()
-		mqtt_client.publish(topic, binary_image)  # Publish the image
+		control = json.loads(msg)
+		interval = float(control.get('interval', settings['interval']))
+		quality = int(control.get('quality', settings['quality']))
+		framesize = control.get('framesize', settings['framesize'])
+		topic = str(control.get('topic') or CAM_TOPIC)
+	except (ValueError, TypeError, AttributeError) as e:
+		print(f"Invalid control message: {e}")
+		return
+	if framesize is not None and not hasattr(camera, 'FRAME_' + str(framesize)):
+		print("Unknown frame size:", framesize)
+		framesize = settings['framesize']
+	settings['interval'] = max(interval, 0.1)
+	settings['quality'] = min(max(quality, 10), 63)
+	settings['framesize'] = framesize
+	settings['topic'] = topic
+	print("Capture every", settings['interval'], "s, quality", settings['quality'], "size", framesize)
+
+
+def send_photo(session, queue, photo, topic=CAM_TOPIC):
+	"""
+	Publishes a photo straight from the capture buffer. While the broker is unreachable,
+	the photo is queued in flash instead. Queued photos are published first, so the server
+	receives the photos in order.
+
+	:param session (MQTTSession): The MQTT session.
+	:param queue (FrameQueue): The photos waiting for the broker.
+	:param photo (bytes): The data of the photo.
+	:param topic (str): Topic of the photos, given by the server. Default is CAM_TOPIC.
+	"""
+	if queue.flush(session, topic) and session.publish(topic, photo):
 		print("Image successfully published on topic", topic)
-	except Exception as e:
-		print(f"Failed to publish the image: {e}")
-	finally:
-		mqtt_client.disconnect()
+		return
+	print("Broker unreachable, photo queued")
+	queue.push(photo)
+
+
+def wait_for_next_capture(session, settings, started):
+	"""
+	Waits until the next capture is due, handling the MQTT messages meanwhile, so a shorter
+	interval sent by the server applies at once.
+
+	:param session (MQTTSession): The MQTT session subscribed to the server topics.
+	:param settings (dict): Capture settings, updated by the MQTT callback.
+	:param started (int): Time of the last capture, from time.ticks_ms().
+	"""
+	while time.ticks_diff(time.ticks_ms(), started) < settings['interval'] * 1000:
+		session.poll()
+		time.sleep_ms(100)
 
 
 ##################################################
@@ -179,10 +471,16 @@ def main():
 	# Connect to the Wi-Fi network
 	connect_wifi(WIFI_SSID, WIFI_PASSWORD)
 	
-	# Create an instance of the Camera class
+	# Create an instance of the Camera class, releasing a camera left initialized by a
+	# previous run
 	my_camera = Camera()
 	my_camera.deinit()
 
+	# Capture settings, changed by the server according to the motion it detects
+	settings = {'interval': CAPTURE_INTERVAL, 'quality': JPEG_QUALITY, 'framesize': FRAME_SIZE, 'topic': CAM_TOPIC}
+	my_camera.configure(settings['framesize'], settings['quality'])
+	my_camera.init_camera()
+
 	def mqtt_callback(topic, msg):
 		"""
 		Callback for MQTT messages.
@@ -192,39 +490,31 @@ def main():
 		"""
 		if topic == MONITORING_TOPIC.encode():
 			if msg == b"ON":
-				my_camera.turn_on_flash()  # Call the function to turn on the flash
-				time.sleep(1)
-				my_camera.turn_off_flash()
+				my_camera.blink_flash()  # Flash for a second, without pausing the capture
 			elif msg == b"OFF":
 				my_camera.turn_off_flash()  # Call the function to turn off the flash
+		elif topic == CONTROL_TOPIC.encode():
+			parse_capture_settings(msg, settings)
 	    
 
-	# Set up the MQTT client
-	mqtt_client = MQTTClient(CLIENT_ID, MQTT_BROKER, MQTT_PORT, keepalive=3600)
-	mqtt_client.set_callback(mqtt_callback)
-	mqtt_client.connect()
-	mqtt_client.subscribe(MONITORING_TOPIC)
+	# One MQTT session for the images and the server topics. The control message is
+	# retained: the current settings arrive right after subscribing.
+	session = MQTTSession(CLIENT_ID, MQTT_BROKER, MQTT_PORT, mqtt_callback, [MONITORING_TOPIC, CONTROL_TOPIC])
+	session.connect()
+
+	# Photos kept in flash while the broker is unreachable, including before a reboot
+	queue = FrameQueue()
 
-	
 	while True:
-		mqtt_client.check_msg()
-
-		if my_camera.init_camera():
-			photo = my_camera.capture_photo()
-			if photo is not None:
-				save_path = "photo.jpg"
-				my_camera.save_photo(photo, save_path)
-				time.sleep(1)
-				binary_image = Camera.convert_image_to_binary(save_path)
-				publish_image_mqtt(binary_image, CLIENT_ID + "FLASH", MQTT_BROKER, MQTT_PORT, CAM_TOPIC)
-				time.sleep(2)
-				try:
-					os.remove(save_path)
-					print(f"Photo deleted: {save_path}")
-				except Exception as e:
-					print(f"Error deleting photo: {e}")
-		my_camera.deinit()
-		time.sleep(2)
+		session.poll()
+		started = time.ticks_ms()
+
+		# The camera stays initialized: new settings are applied in place
+		my_camera.configure(settings['framesize'], settings['quality'])
+		photo = my_camera.capture_photo()
+		if photo is not None:
+			send_photo(session, queue, photo, settings['topic'])
+		wait_for_next_capture(session, settings, started)
 
 
 ##################################################
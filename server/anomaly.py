@@ -0,0 +1,372 @@
+# Import necessary libraries
+import time
+import logging
+import threading
+import numpy as np
+from timeseries import default_metrics
+
+##################################################
+
+## Initialization
+
+logger = logging.getLogger("anomaly")
+
+# Valid range of each metric of the BME280 (T in °C, H in %, P in hPa): a reading outside
+# it is a sensor fault
+default_ranges = {'T': (-40.0, 85.0), 'H': (0.0, 100.0), 'P': (300.0, 1100.0)}
+
+# Largest plausible change of each metric per minute
+default_max_rates = {'T': 2.0, 'H': 10.0, 'P': 1.0}
+
+# Smallest standard deviation used for the band around the mean, about the resolution of
+# the sensor, so a perfectly steady metric does not alert on its first small change
+default_min_std = {'T': 0.2, 'H': 1.0, 'P': 0.5}
+
+# Kinds of alerts raised per device and metric: reading outside the valid range, outside
+# the band around the mean, or changing too fast. 'silent' is raised per device.
+metric_alert_kinds = ('range', 'band', 'rate')
+
+##################################################
+
+
+def json_number(value):
+    """
+    Converts a NumPy number to a JSON-friendly float.
+
+    :param value: Number.
+    :return: Float, or None for NaN.
+    """
+    value = float(value)
+    return None if np.isnan(value) else round(value, 4)
+
+
+class AnomalyDetector:
+    """
+    Streaming anomaly detection on the sensor readings of every device.
+
+    The statistics are kept in arrays with one row per device and one column per metric:
+    exponentially weighted mean and variance, smoothed rate of change, last value and time.
+    Readings are queued by submit() and processed in batches by process(), which updates
+    all the devices of a batch with a few array operations, whatever their number. Alerts
+    are raised when a condition starts and cleared when it ends, so a lasting anomaly
+    gives a single alert.
+    """
+
+    def __init__(self, metrics=default_metrics, alpha=0.05, band=4.0, warmup=20, ranges=None, max_rates=None,
+                 min_std=None, silence_timeout=300.0, capacity=64):
+        """
+        Initializes the detector.
+
+        :param metrics: Names of the metrics. Default is ('T', 'H', 'P').
+        :param alpha: Weight of a new reading in the moving mean and variance. Default is 0.05.
+        :param band: Width of the band around the mean, in standard deviations. Default is 4.
+        :param warmup: Readings of a metric needed before its band is checked. Default is 20.
+        :param ranges: Dictionary {metric: (min, max)} of the valid values. Default is default_ranges.
+        :param max_rates: Dictionary {metric: largest change per minute}. Default is default_max_rates.
+        :param min_std: Dictionary {metric: smallest standard deviation}. Default is default_min_std.
+        :param silence_timeout: Seconds without readings before a device is reported silent.
+                                Default is 300.
+        :param capacity: Initial number of rows, doubled as devices appear. Default is 64.
+        """
+        self.metrics = tuple(metrics)
+        self.alpha = alpha
+        self.band = band
+        self.warmup = warmup
+        self.silence_timeout = silence_timeout
+        ranges = default_ranges if ranges is None else ranges
+        max_rates = default_max_rates if max_rates is None else max_rates
+        min_std = default_min_std if min_std is None else min_std
+        self.low = np.array([ranges.get(metric, (-np.inf, np.inf))[0] for metric in self.metrics])
+        self.high = np.array([ranges.get(metric, (-np.inf, np.inf))[1] for metric in self.metrics])
+        self.max_rate = np.array([max_rates.get(metric, np.inf) for metric in self.metrics])
+        self.min_std = np.array([min_std.get(metric, 0.0) for metric in self.metrics])
+
+        self.device_ids = []
+        self.rows = {}
+        self._allocate(capacity)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.batches = 0
+        self.alerts = {kind: 0 for kind in metric_alert_kinds + ('silent',)}
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def _allocate(self, capacity):
+        """
+        Creates the arrays of the statistics, keeping the rows already filled.
+
+        :param capacity: Number of rows.
+        """
+        shape = (capacity, len(self.metrics))
+        grow = hasattr(self, 'mean')
+        arrays = {
+            'mean': np.zeros(shape), 'var': np.zeros(shape), 'rate': np.full(shape, np.nan),
+            'last_value': np.full(shape, np.nan), 'last_time': np.full(shape, np.nan),
+            'count': np.zeros(shape, dtype=np.int64), 'last_seen': np.full(capacity, np.nan),
+            'silent': np.zeros(capacity, dtype=bool),
+        }
+        for name, array in arrays.items():
+            if grow:
+                previous = getattr(self, name)
+                array[:len(previous)] = previous
+            setattr(self, name, array)
+
+        # Flags of the alerts going on, per kind
+        active = {kind: np.zeros(shape, dtype=bool) for kind in metric_alert_kinds}
+        for kind, array in active.items():
+            if grow:
+                array[:len(self.active[kind])] = self.active[kind]
+        self.active = active
+        self.capacity = capacity
+
+    def _row(self, device_id):
+        """
+        Returns the row of a device, adding it if needed. Must be called with the lock held.
+        """
+        row = self.rows.get(device_id)
+        if row is None:
+            row = self.rows[device_id] = len(self.device_ids)
+            self.device_ids.append(device_id)
+            if row >= self.capacity:
+                self._allocate(self.capacity * 2)
+        return row
+
+    def submit(self, device_id, timestamp, values):
+        """
+        Queues a reading for the next batch. Cheap, called by the MQTT handler.
+
+        :param device_id: Identifier of the device.
+        :param timestamp: Time of the reading (seconds since the epoch).
+        :param values: Dictionary {metric: value}, missing metrics are skipped.
+        """
+        vector = [values.get(metric, np.nan) for metric in self.metrics]
+        with self.lock:
+            self.pending.append((self._row(device_id), timestamp, vector))
+
+    def track(self, device_id, last_seen):
+        """
+        Starts watching a device that has not sent anything yet, e.g. a device restored
+        after a restart, so it is reported if it stays silent.
+
+        :param device_id: Identifier of the device.
+        :param last_seen: Time of its last reading (seconds since the epoch).
+        """
+        with self.lock:
+            row = self._row(device_id)
+            if np.isnan(self.last_seen[row]):
+                self.last_seen[row] = last_seen
+
+    def process(self, now=None):
+        """
+        Processes the queued readings and checks for silent devices.
+
+        :param now: Current time (seconds since the epoch). Default is the current time.
+        :return: List of the alerts raised or cleared, as dictionaries.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            pending, self.pending = self.pending, []
+            alerts = []
+            if pending:
+                rows = np.array([row for row, _, _ in pending])
+                times = np.array([timestamp for _, timestamp, _ in pending], dtype=np.float64)
+                values = np.array([vector for _, _, vector in pending], dtype=np.float64)
+
+                # A device may have sent several readings since the last batch: they are
+                # applied in rounds, each holding at most one reading per device
+                order = np.argsort(rows, kind='stable')
+                sorted_rows = rows[order]
+                starts = np.flatnonzero(np.r_[True, sorted_rows[1:] != sorted_rows[:-1]])
+                rank = np.empty(len(rows), dtype=np.int64)
+                rank[order] = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+                for round_index in range(rank.max() + 1):
+                    selected = rank == round_index
+                    alerts += self._update(rows[selected], times[selected], values[selected])
+                self.samples += len(pending)
+                self.batches += 1
+            alerts += self._check_silent(now)
+        return alerts
+
+    def _update(self, rows, times, values):
+        """
+        Updates the statistics of distinct devices with one reading each. Must be called
+        with the lock held.
+
+        :param rows: Rows of the devices.
+        :param times: Times of the readings.
+        :param values: Array (readings x metrics), NaN for missing metrics.
+        :return: List of alerts.
+        """
+        present = ~np.isnan(values)
+        mean = self.mean[rows]
+        var = self.var[rows]
+        count = self.count[rows]
+        last_value = self.last_value[rows]
+        elapsed = times[:, None] - self.last_time[rows]
+
+        # Change per minute since the previous reading of the metric
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rate = np.where(elapsed > 0, (values - last_value) / elapsed * 60.0, np.nan)
+        std = np.maximum(np.sqrt(var), self.min_std)
+
+        # Conditions of the alerts. Out-of-range readings are faults: they are neither
+        # compared with the band nor used to update the statistics.
+        out_of_range = present & ((values < self.low) | (values > self.high))
+        valid = present & ~out_of_range
+        conditions = {
+            'range': out_of_range,
+            'band': valid & (count >= self.warmup) & (np.abs(values - mean) > self.band * std),
+            'rate': valid & (np.abs(rate) > self.max_rate),
+        }
+
+        # Incremental exponentially weighted mean and variance, left as they are for a
+        # missing or faulty reading so it does not narrow the band
+        first = valid & (count == 0)
+        diff = values - mean
+        increment = self.alpha * diff
+        self.mean[rows] = np.where(first, values, np.where(valid, mean + increment, mean))
+        self.var[rows] = np.where(first, 0.0, np.where(valid, (1 - self.alpha) * (var + diff * increment), var))
+        smoothed_rate = self.rate[rows]
+        update_rate = valid & ~np.isnan(rate)
+        self.rate[rows] = np.where(update_rate & np.isnan(smoothed_rate), rate,
+                                   np.where(update_rate, smoothed_rate + self.alpha * (rate - smoothed_rate),
+                                            smoothed_rate))
+        self.last_value[rows] = np.where(valid, values, last_value)
+        self.last_time[rows] = np.where(valid, times[:, None], self.last_time[rows])
+        self.count[rows] = count + valid
+
+        # Flags change only when the metric is present in the reading
+        alerts = []
+        for kind, condition in conditions.items():
+            active = self.active[kind]
+            previous = active[rows]
+            current = np.where(present, condition, previous)
+            active[rows] = current
+            for index, column in zip(*np.nonzero(current != previous)):
+                alerts.append(self._alert(kind, rows[index], column, times[index], current[index, column],
+                                          values[index, column], mean[index, column], std[index, column],
+                                          rate[index, column]))
+
+        # A silent device that reports again
+        resumed = self.silent[rows]
+        self.silent[rows] = False
+        self.last_seen[rows] = np.fmax(self.last_seen[rows], times)
+        for index in np.flatnonzero(resumed):
+            alerts.append(self._alert('silent', rows[index], None, times[index], False))
+        return alerts
+
+    def _check_silent(self, now):
+        """
+        Raises the alerts of the devices that stopped reporting. Must be called with the lock held.
+
+        :param now: Current time (seconds since the epoch).
+        :return: List of alerts.
+        """
+        count = len(self.device_ids)
+        with np.errstate(invalid='ignore'):
+            silent = (now - self.last_seen[:count] > self.silence_timeout) & ~self.silent[:count]
+        self.silent[:count] |= silent
+        return [self._alert('silent', row, None, now, True, last_seen=self.last_seen[row])
+                for row in np.flatnonzero(silent)]
+
+    def _alert(self, kind, row, column, timestamp, raised, value=np.nan, mean=np.nan, std=np.nan, rate=np.nan,
+               last_seen=np.nan):
+        """
+        Builds an alert.
+
+        :return: Dictionary of the alert.
+        """
+        if raised:
+            self.alerts[kind] += 1
+        alert = {
+            'device_id': self.device_ids[row],
+            'kind': kind,
+            'state': 'raised' if raised else 'cleared',
+            'timestamp': float(timestamp),
+        }
+        if column is not None:
+            alert.update(metric=self.metrics[column], value=json_number(value), mean=json_number(mean),
+                         std=json_number(std), rate=json_number(rate))
+        if kind == 'silent' and raised:
+            alert['last_seen'] = json_number(last_seen)
+        return alert
+
+    def active_alerts(self):
+        """
+        Lists the conditions going on.
+
+        :return: List of dictionaries (device_id, kind and metric).
+        """
+        with self.lock:
+            count = len(self.device_ids)
+            active = [{'device_id': self.device_ids[row], 'kind': 'silent', 'metric': None}
+                      for row in np.flatnonzero(self.silent[:count])]
+            for kind in metric_alert_kinds:
+                for row, column in zip(*np.nonzero(self.active[kind][:count])):
+                    active.append({'device_id': self.device_ids[row], 'kind': kind, 'metric': self.metrics[column]})
+        return active
+
+    def statistics(self, device_id):
+        """
+        Returns the current statistics of a device.
+
+        :param device_id: Identifier of the device.
+        :return: Dictionary {metric: {'mean', 'std', 'rate', 'count'}}, or None if the
+                 device is unknown.
+        """
+        with self.lock:
+            row = self.rows.get(device_id)
+            if row is None:
+                return None
+            return {metric: {'mean': json_number(self.mean[row, column]),
+                             'std': json_number(np.sqrt(self.var[row, column])),
+                             'rate': json_number(self.rate[row, column]),
+                             'count': int(self.count[row, column])}
+                    for column, metric in enumerate(self.metrics)}
+
+    def start(self, on_alert, interval=1.0):
+        """
+        Starts the thread processing the readings every 'interval' seconds.
+
+        :param on_alert: Function called with each alert.
+        :param interval: Seconds between two batches. Default is 1.
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(on_alert, interval), name="anomaly", daemon=True)
+        self.thread.start()
+
+    def _run(self, on_alert, interval):
+        """
+        Batch loop.
+        """
+        while not self.stop_event.wait(interval):
+            try:
+                for alert in self.process():
+                    on_alert(alert)
+            except Exception:
+                logger.exception("Error while checking the sensor readings")
+
+    def close(self):
+        """
+        Stops the processing thread.
+        """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        """
+        Returns the counters of the detector.
+
+        :return: Dictionary of statistics.
+        """
+        with self.lock:
+            return {
+                'devices': len(self.device_ids),
+                'pending': len(self.pending),
+                'samples': self.samples,
+                'batches': self.batches,
+                'alerts': dict(self.alerts),
+            }
@@ -0,0 +1,13 @@
+"""
+Benchmark of the server_pub ingest pipeline with synthetic devices.
+
+Synthetic cameras and BME280 boards send their messages through an in-process stand-in
+broker (or straight to the frame processing), so no network or hardware is needed. Each
+configuration reports the throughput, latency percentiles, drops, memory use and the mean
+time of each pipeline stage. Run from the server folder:
+
+    python -m benchmark --resolution QVGA VGA --motion 0 0.2 1 --mode broker direct
+"""
+
+from benchmark.synthetic import SyntheticCamera, SyntheticSensor, frame_sizes
+from benchmark.driver import BenchmarkConfig, LocalBroker, LocalClient, run, use_folder
@@ -0,0 +1,80 @@
+# Import necessary libraries
+import json
+import argparse
+import itertools
+import tempfile
+from metrics import setup_logging
+from benchmark.synthetic import frame_sizes
+from benchmark.driver import BenchmarkConfig, close_folder, run, use_folder
+
+##################################################
+
+
+def parse_arguments():
+    """
+    Parses the command line. Options taking several values are combined, one run per combination.
+
+    :return: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Benchmark of the server_pub ingest pipeline.")
+    parser.add_argument("--mode", nargs="+", default=["broker"], choices=["broker", "direct", "disk"],
+                        help="broker: through on_message and the detection workers; direct: frame processing only; "
+                             "disk: legacy file round-trip")
+    parser.add_argument("--resolution", nargs="+", default=["VGA"], choices=sorted(frame_sizes), help="frame size")
+    parser.add_argument("--motion", nargs="+", type=float, default=[0.2], help="fraction of frames with motion")
+    parser.add_argument("--cameras", nargs="+", type=int, default=[1], help="number of cameras")
+    parser.add_argument("--sensors", type=int, default=1, help="number of sensor boards")
+    parser.add_argument("--frames", type=int, default=200, help="frames sent per camera")
+    parser.add_argument("--fps", type=float, default=0, help="frames per second per camera, 0 for as fast as possible")
+    parser.add_argument("--workers", nargs="+", type=int, default=[2], help="detection worker threads")
+    parser.add_argument("--processes", nargs="+", type=int, default=[0],
+                        help="detection processes, 0 to detect in the worker threads")
+    parser.add_argument("--detector", nargs="+", default=["average"], help="motion detector")
+    parser.add_argument("--scale", type=int, default=4, help="detection scale (1, 2, 4 or 8)")
+    parser.add_argument("--trace-memory", action="store_true", help="measure the peak of the Python allocations (slower)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON lines")
+    return parser.parse_args()
+
+
+def format_number(value, digits=1):
+    """
+    Formats a result for the table, '-' when it is not available.
+    """
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+def main():
+    """
+    Runs every combination of the options and prints one result per configuration.
+    """
+    arguments = parse_arguments()
+    setup_logging("WARNING")
+
+    header = f"{'mode':<7}{'res':<6}{'motion':>7}{'cams':>5}{'wrk':>4}{'proc':>5}{'detector':>9}" \
+             f"{'fps':>9}{'p50 ms':>9}{'p99 ms':>9}{'dropped':>8}{'rss MB':>8}  stages (mean ms)"
+    if not arguments.json:
+        print(header)
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as folder:
+        use_folder(folder)
+        combinations = itertools.product(arguments.mode, arguments.resolution, arguments.motion,
+                                         arguments.cameras, arguments.workers, arguments.processes, arguments.detector)
+        for mode, resolution, motion, cameras, workers, processes, detector in combinations:
+            config = BenchmarkConfig(mode, resolution, motion, cameras, arguments.sensors, arguments.frames,
+                                     arguments.fps, workers, processes, detector, arguments.scale,
+                                     arguments.trace_memory)
+            result = run(config)
+            if arguments.json:
+                print(json.dumps(result))
+                continue
+            stages = " ".join(f"{stage}={mean:.2f}" for stage, mean in sorted(result['stage_mean_ms'].items()))
+            print(f"{mode:<7}{resolution:<6}{motion:>7.2f}{cameras:>5}{workers:>4}{processes:>5}{detector:>9}"
+                  f"{format_number(result['throughput']):>9}{format_number(result['latency_p50_ms'], 2):>9}"
+                  f"{format_number(result['latency_p99_ms'], 2):>9}{result['frames_dropped']:>8}"
+                  f"{format_number(result['rss_mb']):>8}  {stages}")
+        # Write the last clips before the scratch folder is removed
+        close_folder()
+
+
+if __name__ == '__main__':
+    main()
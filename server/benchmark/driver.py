@@ -0,0 +1,382 @@
+# Import necessary libraries
+import os
+import time
+import tracemalloc
+from concurrent import futures
+from collections import Counter, namedtuple
+import numpy as np
+import paho.mqtt.client as mqtt
+import server_pub as sp
+from benchmark.synthetic import SyntheticCamera, SyntheticSensor
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+##################################################
+
+## Initialization
+
+# Distinct frames generated per camera. Longer runs cycle through them, so generating
+# and encoding the frames is not part of the measurement.
+frame_cycle = 120
+
+# One benchmark configuration:
+# - mode: 'broker' (MQTT messages through on_message and the detection workers),
+#   'direct' (process_frame_in_memory called in the loop) or 'disk' (legacy file round-trip)
+# - resolution, motion: frame size and motion level of the synthetic cameras
+# - cameras, sensors: number of synthetic devices
+# - frames: frames sent per camera, fps: frames per second per camera (0 = as fast as possible)
+# - workers, processes, detector, scale: detection settings of server_pub (processes > 0
+#   runs the detectors in the detection pool)
+# - trace_memory: also measure the peak of the Python allocations (slower)
+BenchmarkConfig = namedtuple(
+    'BenchmarkConfig',
+    ['mode', 'resolution', 'motion', 'cameras', 'sensors', 'frames', 'fps', 'workers', 'processes', 'detector', 'scale',
+     'trace_memory'],
+    defaults=['broker', 'VGA', 0.2, 1, 1, 200, 0, 2, 0, 'average', 4, False],
+)
+
+##################################################
+
+
+class LocalMessage:
+    """
+    Message delivered by the LocalBroker, with the attributes of a paho-mqtt message.
+    """
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.retain = False
+
+
+class LocalBroker:
+    """
+    In-process stand-in for the MQTT broker.
+
+    Published messages are delivered synchronously, in the publisher's thread, to every
+    subscription whose filter matches the topic ('+' and '#' wildcards are supported).
+    Shared subscriptions ('$share/<group>/<filter>') get each message once per group, the
+    members of a group taking turns.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+        self.shared = {}
+        self.turns = Counter()
+        self.published = 0
+
+    def subscribe(self, topic_filter, callback):
+        """
+        Subscribes a callback to a topic filter.
+
+        :param topic_filter: Topic filter, e.g. 'home/cam/+' or '$share/server/home/cam/+'.
+        :param callback: Function called as callback(message) for each matching message.
+        """
+        if topic_filter.startswith("$share/"):
+            _, group, topic_filter = topic_filter.split("/", 2)
+            self.shared.setdefault((group, topic_filter), []).append(callback)
+        else:
+            self.subscriptions.append((topic_filter, callback))
+
+    def publish(self, topic, payload):
+        """
+        Delivers a message to the matching subscriptions.
+
+        :param topic: Topic of the message.
+        :param payload: Payload of the message.
+        """
+        self.published += 1
+        message = LocalMessage(topic, payload)
+        for topic_filter, callback in self.subscriptions:
+            if mqtt.topic_matches_sub(topic_filter, topic):
+                callback(message)
+        for key, callbacks in self.shared.items():
+            if mqtt.topic_matches_sub(key[1], topic):
+                callbacks[self.turns[key] % len(callbacks)](message)
+                self.turns[key] += 1
+
+
+class LocalClient:
+    """
+    Client of the LocalBroker, used by server_pub in place of the paho-mqtt client.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.alerts = Counter()
+
+    def publish(self, topic, payload, retain=False):
+        """
+        Publishes a message on the broker, counting the motion alerts per topic. The
+        LocalBroker keeps no retained messages.
+        """
+        if payload == "ON":
+            self.alerts[topic] += 1
+        self.broker.publish(topic, payload)
+
+
+class TimedDispatcher(sp.DetectionDispatcher):
+    """
+    Detection dispatcher that records the latency of each frame, from its reception by
+    on_message to the end of its processing (queueing included).
+    """
+
+    def __init__(self, num_workers, max_queue_size):
+        super().__init__(self._process, num_workers, max_queue_size)
+        self.latencies = []
+        self.pending = []
+
+    def submit(self, camera_id, payload):
+        return super().submit(camera_id, (payload, time.perf_counter()))
+
+    def _process(self, camera_id, item):
+        payload, received = item
+        track_latency(sp.process_frame(camera_id, payload), received, self.latencies, self.pending)
+
+
+def track_latency(pending, received, latencies, outstanding):
+    """
+    Records the latency of a frame once it is processed: at once, or when the detection
+    pool replies.
+
+    :param pending: Future returned by the frame processing, or None if it is done.
+    :param received: Reception time of the frame (time.perf_counter()).
+    :param latencies: List receiving the latency.
+    :param outstanding: List receiving the futures, to wait for them at the end of the run.
+    """
+    if pending is None:
+        latencies.append(time.perf_counter() - received)
+        return
+    outstanding.append(pending)
+    pending.add_done_callback(lambda done: latencies.append(time.perf_counter() - received))
+
+##################################################
+
+
+def current_rss():
+    """
+    Current resident memory of the process.
+
+    :return: Resident set size in bytes, or None if it cannot be read.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """
+    Peak resident memory of the process since it started.
+
+    :return: Peak resident set size in bytes, or None if it cannot be read.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def stage_totals():
+    """
+    Snapshot of the per-stage timings of server_pub.
+
+    :return: Dictionary {stage: (total seconds, count)}.
+    """
+    with sp.stage_seconds.lock:
+        return {key[0]: (total, count) for key, (_, total, count) in sp.stage_seconds.values.items()}
+
+
+def close_folder():
+    """
+    Closes the stores of server_pub and stops the recording of the messages, writing
+    what they have queued.
+    """
+    if sp.capture is not None:
+        sp.capture.close()
+        sp.capture = None
+    sp.close_event_store()
+    if sp.sensor_history is not None:
+        sp.sensor_history.close()
+    sp.sensor_history = sp.event_store = sp.event_recorder = sp.image_cache = None
+
+
+def use_folder(folder):
+    """
+    Redirects the files written by server_pub (sensor history, motion events, legacy
+    images) to a scratch folder, so a benchmark never touches the real data. The recording
+    of the messages is stopped, so a replay is never appended to a capture.
+
+    :param folder: Scratch folder.
+    """
+    close_folder()
+    sp.static_image_folder = os.path.join(folder, 'static')
+    sp.output_folder = os.path.join(folder, 'events')
+    sp.timeseries_folder = os.path.join(folder, 'timeseries')
+    sp.image_cache_folder = None
+    sp.capture_file = None
+    os.makedirs(sp.static_image_folder, exist_ok=True)
+    sp.open_stores()
+
+
+class BenchmarkSession:
+    """
+    server_pub wired to a LocalBroker for one run, with the measurements of the run.
+
+    Messages are sent with send(). In 'broker' mode every message goes through on_message
+    and the detection workers. In 'direct' and 'disk' modes camera frames are processed in
+    the caller's thread (in memory or through files) and other messages go through the broker.
+    """
+
+    def __init__(self, mode='broker', workers=2, detector='average', scale=4, trace_memory=False, processes=0):
+        """
+        Configures server_pub and starts the measurements.
+
+        :param mode: 'broker', 'direct' or 'disk'. Default is 'broker'.
+        :param workers: Number of detection worker threads (broker mode). Default is 2.
+        :param detector: Name of the motion detector. Default is 'average'.
+        :param scale: Detection scale (1, 2, 4 or 8). Default is 4.
+        :param trace_memory: Also measure the peak of the Python allocations. Default is False.
+        :param processes: Number of detection processes, 0 to detect in the calling threads. Default is 0.
+        """
+        # Fresh devices, so detectors do not carry a model over from a previous run
+        with sp.devices_lock:
+            sp.devices.clear()
+        sp.motion_detector = detector
+        sp.detection_scale = scale
+        sp.in_memory_frames = mode != 'disk'
+        sp.detection_processes = processes
+        sp.start_detection_pool()
+
+        self.broker = LocalBroker()
+        self.client = LocalClient(self.broker)
+        sp.client = self.client
+        for topic in sp.mqtt_topics:
+            self.broker.subscribe(topic, lambda message: sp.on_message(self.client, None, message))
+
+        self.dispatcher = None
+        self.latencies = []
+        self.pending = []
+        if mode == 'broker':
+            # One worker thread per detection process at least, as in start_detection()
+            self.dispatcher = TimedDispatcher(max(workers, processes), sp.detection_queue_size)
+            self.latencies = self.dispatcher.latencies
+            self.pending = self.dispatcher.pending
+            sp.dispatcher = self.dispatcher
+            sp.register_detection_metrics(self.dispatcher.stats)
+            self.dispatcher.start()
+        self.process = sp.process_frame_in_memory if mode == 'direct' else sp.process_frame_on_disk
+
+        self.frames_sent = 0
+        self.trace_memory = trace_memory
+        self.stages_before = stage_totals()
+        self.events_dropped_before = sp.event_store.dropped
+        self.rss_before = current_rss()
+        if trace_memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+
+    def send(self, topic, payload):
+        """
+        Sends a message to the server.
+
+        :param topic: Topic of the message.
+        :param payload: Raw bytes of the message.
+        """
+        route = sp.parse_topic(topic)
+        if route is None or route[0] != "home/cam":
+            self.broker.publish(topic, payload)
+            return
+
+        self.frames_sent += 1
+        if self.dispatcher is not None:
+            self.broker.publish(topic, payload)
+        else:
+            received = time.perf_counter()
+            track_latency(self.process(self.client, sp.get_device(route[1]), payload), received, self.latencies,
+                          self.pending)
+
+    def finish(self):
+        """
+        Waits for the queued frames to be processed and stops the measurements.
+
+        :return: Dictionary of results: throughput, latency percentiles, drops, motion alerts,
+                 memory and the mean time of each pipeline stage.
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        # Frames still in the detection pool
+        futures.wait(self.pending)
+        elapsed = time.perf_counter() - self.start
+        sp.event_recorder.close()
+        sp.stop_detection_pool()
+
+        traced_peak = None
+        if self.trace_memory:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        stages = {}
+        for stage, (total, count) in stage_totals().items():
+            total_before, count_before = self.stages_before.get(stage, (0.0, 0))
+            if count > count_before:
+                stages[stage] = (total - total_before) / (count - count_before) * 1000
+
+        latencies_ms = np.array(self.latencies) * 1000
+        processed = len(self.latencies)
+        rss_after = current_rss()
+        return {
+            'frames_sent': self.frames_sent,
+            'frames_processed': processed,
+            'frames_dropped': self.dispatcher.stats()['dropped_total'] if self.dispatcher is not None else 0,
+            'elapsed': elapsed,
+            'throughput': processed / elapsed if elapsed else 0.0,
+            'latency_p50_ms': float(np.percentile(latencies_ms, 50)) if processed else None,
+            'latency_p99_ms': float(np.percentile(latencies_ms, 99)) if processed else None,
+            'latency_max_ms': float(latencies_ms.max()) if processed else None,
+            'motion_alerts': sum(self.client.alerts.values()),
+            'motion_alerts_per_topic': dict(self.client.alerts),
+            'events_dropped': sp.event_store.dropped - self.events_dropped_before,
+            'rss_mb': rss_after / 2 ** 20 if rss_after else None,
+            'rss_growth_mb': (rss_after - self.rss_before) / 2 ** 20 if rss_after and self.rss_before else None,
+            'peak_rss_mb': peak_rss() / 2 ** 20 if resource is not None else None,
+            'traced_peak_mb': traced_peak / 2 ** 20 if traced_peak is not None else None,
+            'stage_mean_ms': stages,
+        }
+
+
+def run(config):
+    """
+    Runs one benchmark configuration with synthetic cameras and sensors.
+
+    :param config: BenchmarkConfig.
+    :return: Dictionary of results, see BenchmarkSession.finish(), with the configuration.
+    """
+    cameras = [SyntheticCamera(config.resolution, config.motion, seed=i) for i in range(config.cameras)]
+    frames = [camera.frames(min(config.frames, frame_cycle)) for camera in cameras]
+    sensors = [SyntheticSensor(seed=i) for i in range(config.sensors)]
+    camera_topics = [f"home/cam/cam{i}" for i in range(config.cameras)]
+    sensor_topics = [f"home/data/sensor{i}" for i in range(config.sensors)]
+
+    session = BenchmarkSession(config.mode, config.workers, config.detector, config.scale, config.trace_memory,
+                               config.processes)
+    for index in range(config.frames):
+        # Pace the cameras, or send as fast as possible
+        if config.fps:
+            delay = session.start + index / config.fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        for topic, camera_frames in zip(camera_topics, frames):
+            session.send(topic, camera_frames[index % len(camera_frames)])
+        for topic, sensor in zip(sensor_topics, sensors):
+            session.send(topic, sensor.reading())
+
+    result = session.finish()
+    result['config'] = config._asdict()
+    return result
@@ -0,0 +1,73 @@
+# Import necessary libraries
+import json
+import argparse
+import tempfile
+import server_pub as sp
+from capture import read_capture, replay
+from metrics import setup_logging
+from benchmark.driver import BenchmarkSession, close_folder, use_folder
+
+##################################################
+
+
+def parse_arguments():
+    """
+    Parses the command line of the replay tool.
+
+    :return: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(prog="python -m benchmark.replay",
+                                     description="Replays a capture file recorded by the server through its handlers.")
+    parser.add_argument("capture", help="capture file (see capture_file in server_pub.py)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 for real time, N for N times faster, 0 for as fast as possible")
+    parser.add_argument("--mode", default="broker", choices=["broker", "direct", "disk"],
+                        help="broker: through on_message and the detection workers; direct: frame processing only; "
+                             "disk: legacy file round-trip")
+    parser.add_argument("--workers", type=int, default=sp.detection_workers, help="detection worker threads")
+    parser.add_argument("--processes", type=int, default=sp.detection_processes,
+                        help="detection processes, 0 to detect in the worker threads")
+    parser.add_argument("--detector", default=sp.motion_detector, help="motion detector")
+    parser.add_argument("--scale", type=int, default=sp.detection_scale, help="detection scale (1, 2, 4 or 8)")
+    parser.add_argument("--on-score", type=float, default=sp.motion_on_score, help="motion score starting an alert")
+    parser.add_argument("--off-score", type=float, default=sp.motion_off_score, help="motion score ending an alert")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Replays a capture and prints the throughput, latencies and motion alerts of the run.
+    """
+    arguments = parse_arguments()
+    setup_logging("WARNING")
+    sp.motion_on_score = arguments.on_score
+    sp.motion_off_score = arguments.off_score
+
+    with tempfile.TemporaryDirectory(prefix="replay_") as folder:
+        use_folder(folder)
+        session = BenchmarkSession(arguments.mode, arguments.workers, arguments.detector, arguments.scale,
+                                   processes=arguments.processes)
+        timing = replay(read_capture(arguments.capture), session.send, arguments.speed)
+        result = session.finish()
+        result.update(timing)
+        close_folder()
+
+    if arguments.json:
+        print(json.dumps(result))
+        return
+
+    print(f"{result['messages']} messages ({result['recorded_seconds']:.1f} s recorded) "
+          f"replayed in {result['replay_seconds']:.1f} s")
+    print(f"frames: {result['frames_processed']} processed, {result['frames_dropped']} dropped, "
+          f"{result['throughput']:.1f} frames/s")
+    if result['frames_processed']:
+        print(f"latency: p50 {result['latency_p50_ms']:.2f} ms, p99 {result['latency_p99_ms']:.2f} ms")
+    print(f"motion alerts: {result['motion_alerts']}")
+    for topic, alerts in sorted(result['motion_alerts_per_topic'].items()):
+        print(f"  {topic}: {alerts}")
+    print("stages (mean ms): " + " ".join(f"{stage}={mean:.2f}" for stage, mean in sorted(result['stage_mean_ms'].items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# Import necessary libraries
+import cv2
+import numpy as np
+
+##################################################
+
+# Frame sizes of the ESP32-CAM (OV2640), as (width, height)
+frame_sizes = {
+    'QQVGA': (160, 120),
+    'QVGA': (320, 240),
+    'VGA': (640, 480),
+    'SVGA': (800, 600),
+    'XGA': (1024, 768),
+    'HD': (1280, 720),
+    'SXGA': (1280, 1024),
+    'UXGA': (1600, 1200),
+}
+
+##################################################
+
+
+class SyntheticCamera:
+    """
+    Generates the JPEG frames of a fake ESP32-CAM.
+
+    The scene is a fixed textured background with a bright object. In a fraction of the
+    frames (the motion level) the object moves, bouncing on the edges, and every frame gets
+    some sensor noise, so consecutive still frames are similar but not identical.
+    """
+
+    def __init__(self, resolution='VGA', motion=0.2, noise=2.0, jpeg_quality=80, object_size=0.15, speed=0.03, seed=0):
+        """
+        Initializes the camera.
+
+        :param resolution: Name of a frame size of frame_sizes, or a (width, height) tuple. Default is 'VGA'.
+        :param motion: Fraction of the frames in which the object moves, from 0 to 1. Default is 0.2.
+        :param noise: Standard deviation of the sensor noise, in gray levels. 0 makes still frames identical. Default is 2.
+        :param jpeg_quality: JPEG quality of the frames, from 0 to 100. Default is 80.
+        :param object_size: Size of the object, as a fraction of the frame height. Default is 0.15.
+        :param speed: Distance moved by the object per frame, as a fraction of the frame width. Default is 0.03.
+        :param seed: Seed of the random generator, for reproducible frames. Default is 0.
+        """
+        self.width, self.height = frame_sizes[resolution] if isinstance(resolution, str) else resolution
+        self.motion = motion
+        self.noise = noise
+        self.jpeg_quality = jpeg_quality
+        self.rng = np.random.default_rng(seed)
+
+        # Smooth random texture, so the JPEG encoder and the detectors see a realistic scene
+        texture = self.rng.integers(0, 256, (self.height // 8 + 1, self.width // 8 + 1, 3), dtype=np.uint8)
+        texture = cv2.resize(texture, (self.width, self.height), interpolation=cv2.INTER_CUBIC)
+        self.background = cv2.GaussianBlur(texture, (0, 0), 3)
+
+        self.size = max(2, int(object_size * self.height))
+        self.step = max(1, int(speed * self.width))
+        self.x = self.width // 4
+        self.y = (self.height - self.size) // 2
+        self.direction = 1
+
+    def _move(self):
+        """
+        Moves the object one step, bouncing on the left and right edges.
+        """
+        self.x += self.direction * self.step
+        if self.x < 0 or self.x + self.size > self.width:
+            self.direction = -self.direction
+            self.x = min(max(self.x, 0), self.width - self.size)
+
+    def render(self):
+        """
+        Renders the next frame.
+
+        :return: Tuple (image, moved) with the color image and whether the object moved.
+        """
+        moved = self.rng.random() < self.motion
+        if moved:
+            self._move()
+
+        img = self.background.copy()
+        cv2.rectangle(img, (self.x, self.y), (self.x + self.size, self.y + self.size), (240, 240, 240), -1)
+        if self.noise:
+            noise = self.rng.normal(0, self.noise, img.shape)
+            img = np.clip(img + noise, 0, 255).astype(np.uint8)
+        return img, moved
+
+    def capture(self):
+        """
+        Captures the next frame as the camera would publish it.
+
+        :return: Tuple (payload, moved) with the JPEG bytes and whether the object moved.
+        """
+        img, moved = self.render()
+        ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ok:
+            raise ValueError("The synthetic frame could not be encoded.")
+        return encoded.tobytes(), moved
+
+    def frames(self, count):
+        """
+        Pre-generates frames, so encoding them is not measured by the benchmark.
+
+        :param count: Number of frames.
+        :return: List of JPEG payloads.
+        """
+        return [self.capture()[0] for _ in range(count)]
+
+
+class SyntheticSensor:
+    """
+    Generates the readings of a fake BME280 sensor board.
+
+    Temperature, humidity and pressure follow slow random walks and are formatted like the
+    messages of ESP32.py, e.g. b"T = 21.53 ; H = 40.12 ; P = 1013.25".
+    """
+
+    def __init__(self, temperature=21.0, humidity=40.0, pressure=1013.0, seed=0):
+        """
+        Initializes the sensor.
+
+        :param temperature: Initial temperature (C). Default is 21.
+        :param humidity: Initial relative humidity (%). Default is 40.
+        :param pressure: Initial pressure (hPa). Default is 1013.
+        :param seed: Seed of the random generator. Default is 0.
+        """
+        self.values = np.array([temperature, humidity, pressure])
+        self.steps = np.array([0.05, 0.2, 0.1])
+        self.rng = np.random.default_rng(seed)
+
+    def reading(self):
+        """
+        Takes the next reading.
+
+        :return: Payload of the reading.
+        """
+        self.values += self.rng.normal(0, 1, 3) * self.steps
+        self.values[1] = min(max(self.values[1], 0.0), 100.0)
+        temperature, humidity, pressure = self.values
+        return "T = {:.2f} ; H = {:.2f} ; P = {:.2f}".format(temperature, humidity, pressure).encode()
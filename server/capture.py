@@ -0,0 +1,203 @@
+# Import necessary libraries
+import os
+import time
+import queue
+import struct
+import logging
+import threading
+from collections import namedtuple
+
+##################################################
+
+# A capture file starts with this marker, followed by one record per message: a header
+# (reception time, topic length, payload length), the topic in UTF-8 and the payload
+capture_magic = b"MQTTCAP1"
+record_header = struct.Struct("<dHI")
+
+# Message read from a capture file
+CaptureRecord = namedtuple('CaptureRecord', ['timestamp', 'topic', 'payload'])
+
+logger = logging.getLogger("capture")
+
+##################################################
+
+
+def valid_length(capture_file, size):
+    """
+    Finds the end of the last complete record of a capture file.
+
+    :param capture_file: Capture file opened in binary mode, positioned after the marker.
+    :param size: Size of the file in bytes.
+    :return: Offset of the end of the last complete record.
+    """
+    offset = capture_file.tell()
+    while offset + record_header.size <= size:
+        header = capture_file.read(record_header.size)
+        _, topic_length, payload_length = record_header.unpack(header)
+        end = offset + record_header.size + topic_length + payload_length
+        if end > size:
+            break
+        offset = end
+        capture_file.seek(offset)
+    return offset
+
+
+class CaptureWriter:
+    """
+    Records incoming MQTT messages to an append-only capture file.
+
+    Messages are queued by the MQTT callback and written by a background thread, so
+    recording never blocks the reception. If the writer falls behind, messages are dropped
+    and counted. A record cut by a crash is removed when the file is reopened.
+    """
+
+    def __init__(self, path, queue_size=256):
+        """
+        Opens the capture file, creating it if needed.
+
+        :param path: Path of the capture file.
+        :param queue_size: Maximum number of messages waiting to be written. Default is 256.
+        """
+        self.path = path
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.recorded = 0
+        self.dropped = 0
+        self.thread = None
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        # Check the marker of an existing file and drop a partial last record
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "r+b") as capture_file:
+                if capture_file.read(len(capture_magic)) != capture_magic:
+                    raise ValueError(f"{path} is not a capture file.")
+                end = valid_length(capture_file, os.path.getsize(path))
+                capture_file.truncate(end)
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "wb")
+            self.file.write(capture_magic)
+
+    def start(self):
+        """
+        Starts the background writer thread.
+        """
+        self.thread = threading.Thread(target=self._writer, name="capture-writer", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Writes the queued messages, stops the writer thread and closes the file.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.file.close()
+
+    def record(self, topic, payload, timestamp=None):
+        """
+        Queues a message for recording. Never blocks the caller.
+
+        :param topic: Topic of the message.
+        :param payload: Raw bytes of the message.
+        :param timestamp: Reception time (seconds since the epoch). Default is now.
+        :return: True if the message was queued, False if it was dropped.
+        """
+        try:
+            self.queue.put_nowait((time.time() if timestamp is None else timestamp, topic, bytes(payload)))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _writer(self):
+        """
+        Writer loop: appends the queued messages, flushing whenever the queue is empty.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.file.flush()
+                return
+            timestamp, topic, payload = item
+            try:
+                encoded_topic = topic.encode("utf-8")
+                self.file.write(record_header.pack(timestamp, len(encoded_topic), len(payload)))
+                self.file.write(encoded_topic)
+                self.file.write(payload)
+                self.recorded += 1
+                if self.queue.empty():
+                    self.file.flush()
+            except (OSError, struct.error) as e:
+                logger.error("Error while recording a message on %s: %s", topic, e)
+
+    def stats(self):
+        """
+        Returns the counters of the recording.
+
+        :return: Dictionary of statistics.
+        """
+        return {
+            'path': self.path,
+            'recorded': self.recorded,
+            'dropped': self.dropped,
+            'queue_depth': self.queue.qsize(),
+        }
+
+
+def read_capture(path):
+    """
+    Reads the messages of a capture file in order. A partial last record is ignored.
+
+    :param path: Path of the capture file.
+    :return: Iterator of CaptureRecord.
+    """
+    with open(path, "rb") as capture_file:
+        if capture_file.read(len(capture_magic)) != capture_magic:
+            raise ValueError(f"{path} is not a capture file.")
+        while True:
+            header = capture_file.read(record_header.size)
+            if len(header) < record_header.size:
+                return
+            timestamp, topic_length, payload_length = record_header.unpack(header)
+            topic = capture_file.read(topic_length)
+            payload = capture_file.read(payload_length)
+            if len(topic) < topic_length or len(payload) < payload_length:
+                return
+            yield CaptureRecord(timestamp, topic.decode("utf-8"), payload)
+
+
+def replay(records, handler, speed=1.0):
+    """
+    Feeds recorded messages to a handler, keeping their original spacing in time.
+
+    :param records: Iterable of CaptureRecord, e.g. read_capture(path).
+    :param handler: Function called as handler(topic, payload) for each message.
+    :param speed: Replay speed: 1 for real time, 10 for ten times faster, 0 for as fast as possible. Default is 1.
+    :return: Dictionary with the number of messages replayed, the recorded duration and the replay duration.
+    """
+    count = 0
+    first = last = None
+    start = time.perf_counter()
+    for record in records:
+        if first is None:
+            first = record.timestamp
+        last = record.timestamp
+
+        # Wait until the message is due
+        if speed:
+            delay = start + (record.timestamp - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        handler(record.topic, record.payload)
+        count += 1
+
+    return {
+        'messages': count,
+        'recorded_seconds': (last - first) if count else 0.0,
+        'replay_seconds': time.perf_counter() - start,
+    }
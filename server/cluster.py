@@ -0,0 +1,318 @@
+# Import necessary libraries
+import json
+import time
+import bisect
+import hashlib
+import logging
+import threading
+
+##################################################
+
+logger = logging.getLogger("cluster")
+
+##################################################
+
+
+def ring_hash(key):
+    """
+    Position of a key on the hash ring.
+
+    :param key: String to hash.
+    :return: 64-bit integer.
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of devices to server instances.
+
+    Each instance is placed on the ring at several points (replicas), and a device belongs
+    to the first instance after its own position. When an instance joins or leaves, only
+    the devices of the ring segments it gains or loses change owner.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        """
+        Initializes the ring.
+
+        :param nodes: Identifiers of the instances.
+        :param replicas: Points per instance on the ring. Default is 64.
+        """
+        self.replicas = replicas
+        self.rebuild(nodes)
+
+    def rebuild(self, nodes):
+        """
+        Places a new set of instances on the ring.
+
+        :param nodes: Identifiers of the instances.
+        """
+        points = sorted((ring_hash(f"{node}#{replica}"), node) for node in nodes for replica in range(self.replicas))
+        self.positions = [position for position, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def owner(self, key):
+        """
+        Finds the instance a device belongs to.
+
+        :param key: Identifier of the device.
+        :return: Identifier of the instance, or None if the ring is empty.
+        """
+        if not self.positions:
+            return None
+        index = bisect.bisect(self.positions, ring_hash(key)) % len(self.positions)
+        return self.nodes[index]
+
+
+class Cluster:
+    """
+    Clustered mode: several server instances share the devices of a site.
+
+    Devices are consistently hashed to instances, so the frames of a camera (and its
+    detector) stay on one instance. The routing is done by the subscriptions: each
+    instance only subscribes to its own direct topics, and the owner of a camera tells it
+    in its retained control message to publish on them (see direct_topic()). Every
+    instance follows the control messages, so when the members change, the new owner of a
+    camera moves it to its own direct topics.
+
+    The plain device topics are consumed through an MQTT shared subscription, so the
+    broker spreads the devices that do not use a direct topic (sensors, older firmware, a
+    camera before its first control message) over the instances. Those messages reach
+    the owner of their device only half of the time with two instances: the others are
+    forwarded to the owner on its own topic, and cross the broker twice. The 'forwarded'
+    and 'direct' counters of stats() measure this overhead.
+
+    Instances announce themselves, with the URL of their web server, in retained messages
+    cleared by their last will, so every instance knows the members and can send a web
+    client to the owner of any device.
+    """
+
+    def __init__(self, instance_id, http_url, device_of, group="server", prefix="home/cluster", replicas=64,
+                 control_prefix=None):
+        """
+        Initializes the cluster membership of this instance.
+
+        :param instance_id: Unique identifier of this instance.
+        :param http_url: Base URL of the web server of this instance, e.g. 'http://10.0.0.2:5001'.
+        :param device_of: Function returning the device ID of a topic, or None for other topics.
+        :param group: Name of the shared subscription group. Default is 'server'.
+        :param prefix: Prefix of the cluster topics. Default is 'home/cluster'.
+        :param replicas: Points per instance on the hash ring. Default is 64.
+        :param control_prefix: Prefix of the control topics of the cameras, e.g. 'home/control',
+                               None if the cameras are not told a direct topic.
+        """
+        self.instance_id = instance_id
+        self.http_url = http_url.rstrip('/')
+        self.device_of = device_of
+        self.group = group
+        self.members_prefix = f"{prefix}/members/"
+        self.forward_prefix = f"{prefix}/forward/"
+        self.direct_prefix = f"{prefix}/direct/"
+        self.control_prefix = control_prefix
+        self.controls = {}
+        self.members = {instance_id: self.http_url}
+        self.ring = HashRing(self.members, replicas)
+        self.lock = threading.Lock()
+        self.forwarded = 0
+        self.received_forwarded = 0
+        self.direct = 0
+
+    def member_topic(self):
+        """
+        Topic of the retained announcement of this instance (and of its last will).
+        """
+        return self.members_prefix + self.instance_id
+
+    def announcement(self):
+        """
+        Payload of the announcement of this instance.
+        """
+        return json.dumps({'url': self.http_url, 'started': time.time()})
+
+    def direct_topic(self, topic):
+        """
+        Topic on which a device publishes straight to this instance.
+
+        :param topic: Plain topic of the device, e.g. 'home/cam/abc'.
+        :return: Direct topic, e.g. 'home/cluster/direct/<instance>/home/cam/abc'.
+        """
+        return f"{self.direct_prefix}{self.instance_id}/{topic}"
+
+    def subscriptions(self, topics):
+        """
+        Topics to subscribe to: the device topics through the shared subscription, the
+        direct topics and the forwarded messages of this instance, the announcements of the
+        members and the control messages of the cameras.
+
+        Brokers do not send retained messages to shared subscriptions: the server reads
+        them separately at startup.
+
+        :param topics: Device topics of a standalone server.
+        :return: List of topic filters.
+        """
+        subscriptions = [f"$share/{self.group}/{topic}" for topic in topics] + [
+            f"{self.direct_prefix}{self.instance_id}/#",
+            f"{self.forward_prefix}{self.instance_id}/#",
+            f"{self.members_prefix}+",
+        ]
+        if self.control_prefix:
+            subscriptions += [self.control_prefix, f"{self.control_prefix}/+"]
+        return subscriptions
+
+    def route(self, client, topic, payload):
+        """
+        Decides what to do with a received message.
+
+        :param client: MQTT client, used to forward messages.
+        :param topic: Topic of the message.
+        :param payload: Raw bytes of the message.
+        :return: Topic of a device message to handle on this instance, or None if the
+                 message was forwarded or was a cluster message.
+        """
+        if topic.startswith(self.members_prefix):
+            if self.update_member(topic[len(self.members_prefix):], payload):
+                self.reassign(client)
+            return None
+
+        if self.control_prefix and (topic == self.control_prefix or topic.startswith(self.control_prefix + '/')):
+            self.update_control(topic, payload)
+            return None
+
+        if topic.startswith(self.forward_prefix):
+            # Forwarded messages are handled here even if the ring changed meanwhile,
+            # so a message never travels more than once between instances
+            instance, _, original = topic[len(self.forward_prefix):].partition('/')
+            if instance != self.instance_id or not original:
+                return None
+            self.received_forwarded += 1
+            return original
+
+        if topic.startswith(self.direct_prefix):
+            # A camera still publishing to this instance after the ring changed, until
+            # its new owner tells it its own direct topic
+            instance, _, original = topic[len(self.direct_prefix):].partition('/')
+            if instance != self.instance_id or not original:
+                return None
+            self.direct += 1
+            topic = original
+
+        device_id = self.device_of(topic)
+        owner = self.owner(device_id) if device_id is not None else None
+        if owner is None or owner == self.instance_id:
+            return topic
+
+        client.publish(f"{self.forward_prefix}{owner}/{topic}", payload)
+        self.forwarded += 1
+        return None
+
+    def update_member(self, instance_id, payload):
+        """
+        Applies the announcement of an instance: an empty payload means it left.
+
+        :param instance_id: Identifier of the instance.
+        :param payload: Raw bytes of the announcement.
+        :return: True if the members changed.
+        """
+        if instance_id == self.instance_id or not instance_id:
+            return False
+        url = None
+        if payload:
+            try:
+                url = json.loads(payload)['url'].rstrip('/')
+            except (ValueError, KeyError, TypeError, AttributeError):
+                logger.warning("Invalid announcement of instance %s", instance_id)
+                return False
+
+        with self.lock:
+            if url is None:
+                if self.members.pop(instance_id, None) is None:
+                    return False
+                logger.info("Instance %s left the cluster", instance_id)
+            else:
+                if self.members.get(instance_id) == url:
+                    return False
+                self.members[instance_id] = url
+                logger.info("Instance %s joined the cluster at %s", instance_id, url)
+            self.ring.rebuild(self.members)
+        return True
+
+    def update_control(self, topic, payload):
+        """
+        Keeps the retained control message of a camera, which holds its direct topic.
+
+        :param topic: Control topic of the camera.
+        :param payload: Raw bytes of the control message, empty if it was cleared.
+        """
+        try:
+            control = json.loads(payload) if payload else None
+        except ValueError:
+            control = None
+        with self.lock:
+            if isinstance(control, dict):
+                self.controls[topic] = control
+            else:
+                self.controls.pop(topic, None)
+
+    def reassign(self, client):
+        """
+        Tells the cameras whose owner became this instance, after a change of the members,
+        to publish on the direct topics of this instance. Their other settings are kept.
+
+        :param client: MQTT client, used to publish the control messages.
+        """
+        moved = []
+        with self.lock:
+            for topic, control in self.controls.items():
+                direct = control.get('topic')
+                if not isinstance(direct, str) or not direct.startswith(self.direct_prefix):
+                    continue
+                instance, _, original = direct[len(self.direct_prefix):].partition('/')
+                device_id = self.device_of(original)
+                if instance == self.instance_id or device_id is None:
+                    continue
+                if self.ring.owner(device_id) == self.instance_id:
+                    moved.append((topic, dict(control, topic=self.direct_topic(original))))
+        for topic, control in moved:
+            logger.info("Moving the camera of %s to this instance", topic)
+            client.publish(topic, json.dumps(control), retain=True)
+
+    def owner(self, device_id):
+        """
+        Instance owning a device.
+
+        :param device_id: Identifier of the device.
+        :return: Identifier of the instance.
+        """
+        with self.lock:
+            return self.ring.owner(device_id)
+
+    def owner_url(self, device_id):
+        """
+        Base URL of the web server owning a device, if it is not this instance.
+
+        :param device_id: Identifier of the device.
+        :return: Base URL, or None if the device belongs to this instance.
+        """
+        with self.lock:
+            owner = self.ring.owner(device_id)
+            if owner is None or owner == self.instance_id:
+                return None
+            return self.members[owner]
+
+    def stats(self):
+        """
+        Returns the members and counters of the cluster.
+
+        :return: Dictionary of statistics.
+        """
+        with self.lock:
+            members = dict(self.members)
+        return {
+            'instance': self.instance_id,
+            'group': self.group,
+            'members': members,
+            'forwarded': self.forwarded,
+            'received_forwarded': self.received_forwarded,
+            'direct': self.direct,
+        }
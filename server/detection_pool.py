@@ -0,0 +1,472 @@
+# Import necessary libraries
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import deque
+from concurrent.futures import Future
+import cv2
+import numpy as np
+from detectors import MotionResult, motion_detectors
+
+##################################################
+
+logger = logging.getLogger("detection_pool")
+
+##################################################
+
+
+def worker_main(connection, memory_name, offset, slot_bytes, detector_name, detector_options):
+    """
+    Loop of a detection process: runs the detectors of its cameras on the frames found in
+    its ring of shared memory slots, and returns the motion results in the order of the
+    requests.
+
+    Requests are ('detect', camera, shape, slot, frame): frame is None when the frame is in
+    the slot, or the frame itself when it was too large for a slot. ('get_state', camera)
+    and ('set_state', camera, state) save and restore the model of a camera's detector.
+    Replies are (result, timings, error).
+
+    :param connection: Pipe to the server process.
+    :param memory_name: Name of the shared memory block of the frames.
+    :param offset: Offset of the first slot of this process in the block.
+    :param slot_bytes: Size of a slot.
+    :param detector_name: Name of the motion detector, a key of motion_detectors.
+    :param detector_options: Options passed to the detector class.
+    """
+    # Interrupts are handled by the server, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Parallelism comes from the processes, not from OpenCV threads
+    cv2.setNumThreads(1)
+
+    memory = shared_memory.SharedMemory(name=memory_name)
+    detectors = {}
+    connection.send("ready")
+    try:
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                return
+            if request is None:
+                return
+
+            command, camera, *args = request
+            frame = None
+            try:
+                detector = detectors.get(camera)
+                if detector is None:
+                    detector = detectors[camera] = motion_detectors[detector_name](**detector_options)
+                if command == 'get_state':
+                    reply = (detector.get_state(), {}, None)
+                elif command == 'set_state':
+                    detector.set_state(args[0])
+                    reply = (None, {}, None)
+                else:
+                    shape, slot, frame = args
+                    if frame is None:
+                        # Zero-copy view of the frame written by the server
+                        frame = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf, offset=offset + slot * slot_bytes)
+                    result = detector.update(frame)
+                    reply = (tuple(result) if result is not None else None, detector.timings, None)
+            except Exception as e:
+                reply = (None, {}, f"{type(e).__name__}: {e}")
+            # The view must be released before the memory can be closed
+            frame = None
+            connection.send(reply)
+    finally:
+        memory.close()
+
+
+class PoolWorker:
+    """
+    Detection process of the pool, with its pipe, its ring of shared memory slots and the
+    requests waiting for its reply.
+    """
+
+    def __init__(self, index, slots):
+        """
+        Initializes the worker. The process is started by DetectionPool._spawn().
+
+        :param index: Index of the process.
+        :param slots: Number of shared memory slots of the process.
+        """
+        self.index = index
+        self.process = None
+        self.connection = None
+        self.collector = None
+        self.free_slots = queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+        # Requests sent and not answered yet, in order: (slot, future, command, camera).
+        # Sending a request and queuing it happen under the lock, so they stay in order.
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+
+class RemoteDetector:
+    """
+    Stand-in for the motion detector of a camera whose model lives in a detection process.
+    It has the update() method and 'timings' attribute of MotionDetector.
+    """
+
+    def __init__(self, pool, camera):
+        """
+        Initializes the detector.
+
+        :param pool: DetectionPool running the detector.
+        :param camera: Identifier of the camera.
+        """
+        self.pool = pool
+        self.camera = camera
+        self.timings = {}
+
+    def update(self, gray):
+        """
+        Feeds a detection frame to the camera's detector in its process and waits for the result.
+
+        :param gray: Grayscale detection frame.
+        :return: MotionResult, or None while the model is warming up.
+        """
+        result, self.timings = self.pool.detect(self.camera, gray)
+        return result
+
+    def submit(self, gray):
+        """
+        Feeds a detection frame to the camera's detector in its process, without waiting.
+
+        :param gray: Grayscale detection frame.
+        :return: Future of the tuple (MotionResult or None, timings of the stages).
+        """
+        return self.pool.submit(self.camera, gray)
+
+    def get_state(self):
+        """
+        Returns a copy of the model of the camera's detector in its process.
+
+        :return: Dictionary of the model, or None if it is empty or cannot be saved.
+        """
+        return self.pool.get_state(self.camera)
+
+    def set_state(self, state):
+        """
+        Restores the model of the camera's detector in its process.
+
+        :param state: Dictionary of the model, returned by get_state().
+        """
+        self.pool.set_state(self.camera, state)
+
+
+class DetectionPool:
+    """
+    Runs the motion detectors in separate processes, so detection uses several cores.
+
+    Each camera is assigned to one process, which keeps its detector. Each process has a
+    ring of shared memory slots: submit() copies a detection frame into a free slot of the
+    camera's process and sends a small request through the pipe, without waiting for the
+    reply. A collector thread per process receives the replies in order, frees the slots
+    and completes the futures of the requests, so up to 'slots' frames per process are in
+    flight and the callers are never held by a pipe round-trip. A process that dies is
+    restarted, and its cameras' detectors warm up again.
+    """
+
+    def __init__(self, num_processes=2, slot_bytes=1600 * 1200, detector='average', detector_options=None, slots=4):
+        """
+        Initializes the pool.
+
+        :param num_processes: Number of detection processes. Default is 2.
+        :param slot_bytes: Largest frame passed through shared memory, in bytes. Larger frames
+                           are sent through the pipe. Default is a full-resolution UXGA frame.
+        :param detector: Name of the motion detector, a key of motion_detectors. Default is 'average'.
+        :param detector_options: Options passed to the detector class.
+        :param slots: Shared memory slots per process, the most frames in flight per process.
+                      Default is 4.
+        """
+        self.num_processes = num_processes
+        self.slot_bytes = slot_bytes
+        self.slots = slots
+        self.detector_name = detector
+        self.detector_options = detector_options or {}
+        self.context = multiprocessing.get_context('spawn')
+        self.memory = None
+        self.workers = []
+        self.assignments = {}
+        self.restored = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.requests = 0
+        self.restarts = 0
+
+    def start(self):
+        """
+        Allocates the shared memory, starts the detection processes and their collector threads.
+        """
+        self.stopping = False
+        self.memory = shared_memory.SharedMemory(create=True, size=self.num_processes * self.slots * self.slot_bytes)
+        self.workers = [PoolWorker(index, self.slots) for index in range(self.num_processes)]
+        for worker in self.workers:
+            self._spawn(worker)
+        for worker in self.workers:
+            self._wait_ready(worker)
+            worker.collector = threading.Thread(target=self._collect, args=(worker,),
+                                                name=f"detection-collector-{worker.index}", daemon=True)
+            worker.collector.start()
+
+    @staticmethod
+    def _wait_ready(worker):
+        """
+        Waits until a detection process has started, so the first frames are not delayed.
+        """
+        if worker.connection.recv() != "ready":
+            raise RuntimeError(f"Detection process {worker.process.name} did not start.")
+
+    def _spawn(self, worker):
+        """
+        Starts the detection process of a worker.
+
+        :param worker: PoolWorker.
+        """
+        connection, child_connection = self.context.Pipe()
+        process = self.context.Process(
+            target=worker_main,
+            args=(child_connection, self.memory.name, self._slot_offset(worker.index, 0), self.slot_bytes,
+                  self.detector_name, self.detector_options),
+            name=f"detection-process-{worker.index}",
+            daemon=True,
+        )
+        process.start()
+        child_connection.close()
+        worker.process = process
+        worker.connection = connection
+
+    def _slot_offset(self, index, slot):
+        """
+        Offset of a slot of a process in the shared memory block.
+        """
+        return (index * self.slots + slot) * self.slot_bytes
+
+    def stop(self):
+        """
+        Stops the detection processes once they have answered the requests sent, and frees
+        the shared memory.
+        """
+        self.stopping = True
+        for worker in self.workers:
+            with worker.lock:
+                try:
+                    worker.connection.send(None)
+                except OSError:
+                    pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.collector.join()
+            worker.connection.close()
+        self.workers = []
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+    def detector(self, camera):
+        """
+        Creates the detector of a camera.
+
+        :param camera: Identifier of the camera.
+        :return: RemoteDetector.
+        """
+        return RemoteDetector(self, camera)
+
+    def _assign(self, camera):
+        """
+        Returns the process of a camera, assigning a new camera to the least loaded process.
+        Called for the frames only, so only cameras that send frames take a place.
+
+        :param camera: Identifier of the camera.
+        :return: Tuple (index of the process, model restored by set_state() to load first or None).
+        """
+        with self.lock:
+            index = self.assignments.get(camera)
+            if index is not None:
+                return index, None
+            loads = [0] * self.num_processes
+            for assigned in self.assignments.values():
+                loads[assigned] += 1
+            index = self.assignments[camera] = loads.index(min(loads))
+            return index, self.restored.pop(camera, None)
+
+    def submit(self, camera, gray):
+        """
+        Sends a frame to the detector of a camera, without waiting for the result. Only
+        waits for a free slot when the camera's process already has 'slots' frames in flight.
+
+        :param camera: Identifier of the camera.
+        :param gray: Grayscale detection frame.
+        :return: Future of the tuple (MotionResult or None, timings of the stages). Its
+                 callbacks run in the collector thread, in the order of the frames.
+        """
+        index, restored = self._assign(camera)
+        with self.lock:
+            self.requests += 1
+        worker = self.workers[index]
+        if restored is not None:
+            self._send(worker, ('set_state', camera, restored), None, 'set_state', camera)
+
+        if gray.dtype == np.uint8 and gray.nbytes <= self.slot_bytes:
+            slot = worker.free_slots.get()
+            view = np.ndarray(gray.shape, dtype=np.uint8, buffer=self.memory.buf,
+                              offset=self._slot_offset(index, slot))
+            np.copyto(view, gray)
+            del view
+            return self._send(worker, ('detect', camera, gray.shape, slot, None), slot, 'detect', camera)
+        return self._send(worker, ('detect', camera, gray.shape, None, gray), None, 'detect', camera)
+
+    def detect(self, camera, gray):
+        """
+        Runs the detector of a camera on a frame and waits for the result.
+
+        :param camera: Identifier of the camera.
+        :param gray: Grayscale detection frame.
+        :return: Tuple (MotionResult or None, timings of the stages).
+        """
+        return self.submit(camera, gray).result()
+
+    def get_state(self, camera):
+        """
+        Returns a copy of the model of a camera's detector.
+
+        :param camera: Identifier of the camera.
+        :return: Dictionary of the model, or None if it is empty or cannot be saved.
+        """
+        with self.lock:
+            index = self.assignments.get(camera)
+            if index is None:
+                # No frame yet: the model is the one restored, if any
+                return self.restored.get(camera)
+        return self._send(self.workers[index], ('get_state', camera), None, 'get_state', camera).result()
+
+    def set_state(self, camera, state):
+        """
+        Restores the model of a camera's detector. For a camera without frames yet, the
+        model is loaded in its process with its first frame.
+
+        :param camera: Identifier of the camera.
+        :param state: Dictionary of the model, returned by get_state().
+        """
+        with self.lock:
+            index = self.assignments.get(camera)
+            if index is None:
+                self.restored[camera] = state
+                return
+        self._send(self.workers[index], ('set_state', camera, state), None, 'set_state', camera).result()
+
+    def _send(self, worker, request, slot, command, camera):
+        """
+        Sends a request to a detection process and queues it for the collector thread.
+
+        :param worker: PoolWorker of the process.
+        :param request: Request tuple, see worker_main().
+        :param slot: Slot holding the frame, freed with the reply, or None.
+        :param command: Command of the request.
+        :param camera: Identifier of the camera.
+        :return: Future of the reply.
+        """
+        future = Future()
+        with worker.lock:
+            try:
+                worker.connection.send(request)
+            except (OSError, ValueError) as e:
+                error = e
+            else:
+                worker.pending.append((slot, future, command, camera))
+                return future
+        # The process died: the collector thread restarts it
+        if slot is not None:
+            worker.free_slots.put(slot)
+        future.set_exception(RuntimeError(f"Detection process {worker.index} failed: {error}"))
+        return future
+
+    def _collect(self, worker):
+        """
+        Collector loop of a process: completes the futures of the requests with the replies.
+
+        :param worker: PoolWorker.
+        """
+        while True:
+            try:
+                result, timings, error = worker.connection.recv()
+            except (EOFError, OSError) as e:
+                if self.stopping:
+                    with worker.lock:
+                        pending = list(worker.pending)
+                        worker.pending.clear()
+                    self._fail(worker, pending, "The detection pool stopped.")
+                    return
+                self._restart(worker, e)
+                continue
+
+            with worker.lock:
+                slot, future, command, camera = worker.pending.popleft()
+            if slot is not None:
+                worker.free_slots.put(slot)
+            if error is not None:
+                future.set_exception(RuntimeError(f"Detection ({command}) failed for {camera}: {error}"))
+            elif command == 'detect':
+                future.set_result(((MotionResult(*result) if result is not None else None), timings))
+            else:
+                future.set_result(result)
+
+    def _restart(self, worker, error):
+        """
+        Replaces a detection process that died. Its pending requests fail, and the
+        detectors of its cameras start over.
+
+        :param worker: PoolWorker.
+        :param error: Error raised by the pipe.
+        """
+        logger.error("Detection process %d failed (%s), restarting it", worker.index, error)
+        with worker.lock:
+            pending = list(worker.pending)
+            worker.pending.clear()
+            worker.connection.close()
+            self._spawn(worker)
+            self._wait_ready(worker)
+            self.restarts += 1
+        self._fail(worker, pending, f"Detection process {worker.index} failed.")
+
+    @staticmethod
+    def _fail(worker, pending, message):
+        """
+        Fails requests that will never be answered, freeing their slots.
+
+        :param worker: PoolWorker of the requests.
+        :param pending: List of the requests, as in PoolWorker.pending.
+        :param message: Error message.
+        """
+        for slot, future, _, _ in pending:
+            if slot is not None:
+                worker.free_slots.put(slot)
+            future.set_exception(RuntimeError(message))
+
+    def stats(self):
+        """
+        Returns the number of cameras of each process and the counters of the pool.
+
+        :return: Dictionary of statistics.
+        """
+        with self.lock:
+            loads = [0] * self.num_processes
+            for assigned in self.assignments.values():
+                loads[assigned] += 1
+            return {
+                'processes': self.num_processes,
+                'slots': self.slots,
+                'cameras_per_process': loads,
+                'in_flight': sum(len(worker.pending) for worker in self.workers),
+                'requests': self.requests,
+                'restarts': self.restarts,
+            }
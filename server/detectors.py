@@ -0,0 +1,253 @@
+# Import necessary libraries
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+
+##################################################
+
+def mask_to_boxes(mask, min_area=0):
+    """
+    Extracts the bounding boxes of the areas of movement in a binary mask.
+
+    :param mask: Binary image where changed pixels are 255.
+    :param min_area: Minimum area of a box, smaller ones are ignored. Default is 0.
+    :return: List of bounding boxes (x, y, w, h).
+    """
+
+    # Find contours in the binary image
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    boxes = [cv2.boundingRect(contour) for contour in contours]
+    if min_area:
+        boxes = [box for box in boxes if box[2] * box[3] >= min_area]
+    return boxes
+
+
+def scale_boxes(boxes, from_shape, to_shape):
+    """
+    Maps bounding boxes found on a reduced frame back to the full-resolution frame.
+
+    :param boxes: List of bounding boxes (x, y, w, h) on the reduced frame.
+    :param from_shape: Shape of the reduced frame.
+    :param to_shape: Shape of the full-resolution frame.
+    :return: List of bounding boxes on the full-resolution frame.
+    """
+    scale_x = to_shape[1] / from_shape[1]
+    scale_y = to_shape[0] / from_shape[0]
+    return [(int(x * scale_x), int(y * scale_y), int(round(w * scale_x)), int(round(h * scale_y)))
+            for (x, y, w, h) in boxes]
+
+
+def draw_movement(img, boxes):
+    """
+    Draws red rectangles around areas of movement, in place.
+
+    :param img: Color image to mark.
+    :param boxes: List of bounding boxes (x, y, w, h).
+    """
+    for (x, y, w, h) in boxes:
+        cv2.rectangle(img, (x, y), (x + w, y + h), (0, 0, 255), 2)
+
+
+##################################################
+
+# Result of a motion detector for one frame: fraction of changed pixels and
+# bounding boxes (x, y, w, h) of the areas of movement on the detection frame
+MotionResult = namedtuple('MotionResult', ['score', 'boxes'])
+
+
+class MotionDetector:
+    """
+    Base class of the motion detectors.
+
+    A detector is kept per camera and fed with its detection frames one by one. Subclasses
+    implement foreground_mask(), which compares a frame with the model and updates it.
+    The time spent in the diff and contour stages of the last frame is kept in 'timings',
+    for the caller to record.
+    """
+
+    # Number of frames used to build the model before any result is returned
+    warmup_frames = 1
+
+    def __init__(self, threshold=30, min_area=0):
+        """
+        Initializes the detector.
+
+        :param threshold: Difference in gray level for a pixel to count as changed. Default is 30.
+        :param min_area: Minimum area of a reported bounding box. Default is 0.
+        """
+        self.threshold = threshold
+        self.min_area = min_area
+        self.timings = {}
+
+        # The model exists from the start, so get_state() can be called before any frame
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the model, e.g. when the camera resolution changes.
+        """
+        self.frames_seen = 0
+        self.shape = None
+
+    def update(self, gray):
+        """
+        Feeds a detection frame to the detector.
+
+        :param gray: Grayscale detection frame.
+        :return: MotionResult, or None while the model is warming up.
+        """
+        if gray.shape != self.shape:
+            self.reset()
+            self.shape = gray.shape
+
+        start = time.perf_counter()
+        mask = self.foreground_mask(gray)
+        self.timings = {'diff': time.perf_counter() - start}
+        self.frames_seen += 1
+        if self.frames_seen <= self.warmup_frames:
+            return None
+
+        score = cv2.countNonZero(mask) / mask.size
+        if not score:
+            return MotionResult(score, [])
+        start = time.perf_counter()
+        boxes = mask_to_boxes(mask, self.min_area)
+        self.timings['contour'] = time.perf_counter() - start
+        return MotionResult(score, boxes)
+
+    def foreground_mask(self, gray):
+        """
+        Compares a frame with the model and updates the model.
+
+        :param gray: Grayscale detection frame.
+        :return: Binary mask where changed pixels are 255.
+        """
+        raise NotImplementedError
+
+    def get_state(self):
+        """
+        Returns a copy of the model, to be saved and restored after a restart.
+
+        :return: Dictionary of the model, or None if it is empty or cannot be saved.
+        """
+        return None
+
+    def set_state(self, state):
+        """
+        Restores a model returned by get_state(). The detector is then warmed up.
+
+        :param state: Dictionary of the model.
+        """
+        self.reset()
+        self.shape = tuple(state['shape'])
+        self.frames_seen = max(state['frames_seen'], self.warmup_frames)
+
+
+class FrameDiffDetector(MotionDetector):
+    """
+    Compares each frame with the previous one (the original pairwise detector).
+    """
+
+    def reset(self):
+        super().reset()
+        self.previous = None
+
+    def foreground_mask(self, gray):
+        # A frame read from shared memory is overwritten by the next one: keep a copy
+        previous, self.previous = self.previous, gray if gray.flags.owndata else gray.copy()
+        if previous is None:
+            return np.zeros_like(gray)
+        _, mask = cv2.threshold(cv2.absdiff(previous, gray), self.threshold, 255, cv2.THRESH_BINARY)
+        return mask
+
+    def get_state(self):
+        previous = self.previous
+        if previous is None:
+            return None
+        return {'shape': list(previous.shape), 'frames_seen': self.frames_seen, 'previous': previous.copy()}
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.previous = np.ascontiguousarray(state['previous'], dtype=np.uint8)
+
+
+class RunningAverageDetector(MotionDetector):
+    """
+    Compares each frame with a running average of the previous frames.
+
+    Slow changes such as lighting drift are absorbed by the average, while moving objects
+    stand out from it.
+    """
+
+    def __init__(self, threshold=30, min_area=0, alpha=0.05):
+        """
+        Initializes the detector.
+
+        :param threshold: Difference in gray level for a pixel to count as changed. Default is 30.
+        :param min_area: Minimum area of a reported bounding box. Default is 0.
+        :param alpha: Weight of a new frame in the running average. Default is 0.05.
+        """
+        self.alpha = alpha
+        super().__init__(threshold, min_area)
+
+    def reset(self):
+        super().reset()
+        self.background = None
+
+    def foreground_mask(self, gray):
+        if self.background is None:
+            self.background = gray.astype(np.float32)
+            return np.zeros_like(gray)
+
+        diff = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        _, mask = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+        return mask
+
+    def get_state(self):
+        background = self.background
+        if background is None:
+            return None
+        return {'shape': list(self.shape), 'frames_seen': self.frames_seen, 'background': background.copy()}
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.background = np.array(state['background'], dtype=np.float32)
+
+
+class MOG2Detector(MotionDetector):
+    """
+    Uses the OpenCV MOG2 background subtractor, which models each pixel with a mixture of
+    Gaussians and copes with repetitive changes such as flicker. Its model cannot be
+    saved, so it warms up again after a restart.
+    """
+
+    warmup_frames = 10
+
+    def __init__(self, threshold=30, min_area=0, history=500):
+        """
+        Initializes the detector.
+
+        :param threshold: Squared Mahalanobis distance for a pixel to count as changed. Default is 30.
+        :param min_area: Minimum area of a reported bounding box. Default is 0.
+        :param history: Number of frames that make up the background model. Default is 500.
+        """
+        self.history = history
+        super().__init__(threshold, min_area)
+
+    def reset(self):
+        super().reset()
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(self.history, self.threshold, False)
+
+    def foreground_mask(self, gray):
+        return self.subtractor.apply(gray)
+
+
+# Available motion detectors, selected by the 'motion_detector' setting of server_pub
+motion_detectors = {
+    'average': RunningAverageDetector,
+    'mog2': MOG2Detector,
+    'diff': FrameDiffDetector,
+}
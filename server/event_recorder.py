@@ -0,0 +1,191 @@
+# Import necessary libraries
+import time
+import threading
+from collections import deque
+
+##################################################
+
+
+class CameraRecording:
+    """
+    Recording state of a camera: recent frames, and the clip being recorded if any.
+    """
+
+    def __init__(self, max_buffered):
+        """
+        Initializes the state of a camera.
+
+        :param max_buffered: Maximum number of frames kept for the pre-roll.
+        """
+        self.buffer = deque(maxlen=max_buffered)
+        self.clip = None
+        self.last_motion = None
+        self.last_frame = None
+        self.interval = None
+
+    def fps(self):
+        """
+        Frame rate of the camera, estimated from the intervals between its frames.
+
+        :return: Frames per second, between 1 and 30.
+        """
+        if not self.interval:
+            return 5.0
+        return round(min(max(1 / self.interval, 1.0), 30.0), 1)
+
+
+class EventRecorder:
+    """
+    Groups the motion frames of each camera into video clips, one event per clip.
+
+    The latest frames of every camera are kept in a small ring buffer, as the received
+    JPEG bytes. When motion starts, a clip is opened in the EventStore with the frames of
+    the last pre_roll seconds, and every following frame is added to it until post_roll
+    seconds after the motion ended. Long events are split into clips of max_seconds.
+    Only bytes are queued here: decoding, marking and encoding happen in the writer
+    thread of the store. Once started, a timer ends the clips of the cameras that went
+    offline, even if no other camera sends a frame.
+    """
+
+    def __init__(self, store, pre_roll=2.0, post_roll=3.0, max_seconds=120.0, max_buffered=64, idle_timeout=30.0):
+        """
+        Initializes the recorder.
+
+        :param store: EventStore writing the clips.
+        :param pre_roll: Seconds of video kept before the motion. Default is 2.
+        :param post_roll: Seconds of video kept after the motion. Default is 3.
+        :param max_seconds: Longest clip, longer events are split. Default is 120.
+        :param max_buffered: Maximum number of frames kept for the pre-roll. Default is 64.
+        :param idle_timeout: A clip is ended when its camera sends nothing for this many
+                             seconds. Default is 30.
+        """
+        self.store = store
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        self.max_seconds = max_seconds
+        self.max_buffered = max_buffered
+        self.idle_timeout = idle_timeout
+        self.cameras = {}
+        self.lock = threading.Lock()
+        self.clips = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def update(self, camera, payload, timestamp, motion, score=None, boxes=None, boxes_shape=None):
+        """
+        Feeds a processed frame of a camera.
+
+        :param camera: Identifier of the camera.
+        :param payload: Received JPEG bytes of the frame.
+        :param timestamp: Reception time of the frame (seconds since the epoch).
+        :param motion: Whether motion is going on at this frame.
+        :param score: Motion score of the frame.
+        :param boxes: Bounding boxes (x, y, w, h) of the areas of movement on the detection frame.
+        :param boxes_shape: Shape of the detection frame.
+        """
+        with self.lock:
+            recording = self.cameras.get(camera)
+            if recording is None:
+                recording = self.cameras[camera] = CameraRecording(self.max_buffered)
+            if recording.last_frame is not None and timestamp > recording.last_frame:
+                interval = timestamp - recording.last_frame
+                recording.interval = interval if recording.interval is None else 0.8 * recording.interval + 0.2 * interval
+            recording.last_frame = timestamp
+
+            # Clips of cameras that stopped sending, and this camera's clip once it is over
+            ended = self._idle_clips(timestamp)
+            clip = recording.clip
+            if clip is not None and (timestamp - clip.timestamp > self.max_seconds
+                                     or not motion and timestamp - recording.last_motion > self.post_roll):
+                ended.append(clip)
+                recording.clip = clip = None
+
+            frames = []
+            if clip is None and motion:
+                clip = recording.clip = self.store.open_clip(camera, timestamp, recording.fps())
+                frames = [(clip, buffered, buffered_time, None, None, None)
+                          for buffered_time, buffered in recording.buffer
+                          if buffered_time >= timestamp - self.pre_roll]
+                recording.buffer.clear()
+                self.clips += 1
+
+            if clip is None:
+                recording.buffer.append((timestamp, payload))
+            elif motion:
+                recording.last_motion = timestamp
+                frames.append((clip, payload, timestamp, score, boxes, boxes_shape))
+            else:
+                frames.append((clip, payload, timestamp, None, None, None))
+
+            for frame in frames:
+                self.store.add_clip_frame(*frame)
+
+        # Ending a clip may wait for the writer: not while holding the lock
+        for clip in ended:
+            self.store.close_clip(clip)
+
+    def _idle_clips(self, now):
+        """
+        Detaches the clips of the cameras that sent nothing for idle_timeout seconds.
+
+        :param now: Current time (seconds since the epoch).
+        :return: List of the detached clips.
+        """
+        ended = []
+        for recording in self.cameras.values():
+            if recording.clip is not None and now - recording.last_frame > self.idle_timeout:
+                ended.append(recording.clip)
+                recording.clip = None
+        return ended
+
+    def end_idle_clips(self, now=None):
+        """
+        Ends the clips of the cameras that sent nothing for idle_timeout seconds.
+
+        :param now: Current time (seconds since the epoch). Default is the current time.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            ended = self._idle_clips(now)
+        for clip in ended:
+            self.store.close_clip(clip)
+
+    def start(self):
+        """
+        Starts the timer ending the clips of the cameras that went offline.
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="event-recorder", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """
+        Timer loop, checking the cameras twice per idle_timeout.
+        """
+        while not self.stop_event.wait(self.idle_timeout / 2):
+            self.end_idle_clips()
+
+    def close(self):
+        """
+        Stops the timer and ends the clips being recorded.
+        """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            ended = [recording.clip for recording in self.cameras.values() if recording.clip is not None]
+            for recording in self.cameras.values():
+                recording.clip = None
+        for clip in ended:
+            self.store.close_clip(clip)
+
+    def stats(self):
+        """
+        Returns the number of clips started and being recorded.
+
+        :return: Dictionary of statistics.
+        """
+        with self.lock:
+            recording = sum(1 for state in self.cameras.values() if state.clip is not None)
+        return {'clips': self.clips, 'recording': recording}
@@ -0,0 +1,505 @@
+# Import necessary libraries
+import os
+import re
+import json
+import queue
+import sqlite3
+import datetime
+import threading
+import logging
+import itertools
+import cv2
+import numpy as np
+from detectors import draw_movement, scale_boxes
+from metrics import stage_seconds
+
+##################################################
+
+logger = logging.getLogger("event_store")
+
+# Columns added to the index after its first version, with their definition
+added_columns = {
+    'end_timestamp': "REAL",
+    'frames': "INTEGER NOT NULL DEFAULT 1",
+    'key_frame': "INTEGER NOT NULL DEFAULT 0",
+}
+
+# Columns of the index, in the order of the queries
+event_columns = "id, camera, timestamp, score, boxes, path, size, end_timestamp, frames, key_frame"
+
+# Marked images saved straight in the folder by the server before the index existed
+legacy_image_pattern = re.compile(r"monitor_image_(\d{8}_\d{6})\.jpg")
+
+
+class Clip:
+    """
+    Motion clip being recorded: one video file and one index row for the whole event.
+
+    The frames are queued with EventStore.add_clip_frame() and the clip is ended with
+    EventStore.close_clip(). The other attributes belong to the writer thread.
+    """
+
+    def __init__(self, event_id, camera, timestamp, fps):
+        """
+        Initializes the clip.
+
+        :param event_id: ID of the event.
+        :param camera: Identifier of the camera.
+        :param timestamp: Time of the start of the motion (seconds since the epoch).
+        :param fps: Frame rate of the video.
+        """
+        self.event_id = event_id
+        self.camera = camera
+        self.timestamp = timestamp
+        self.fps = fps
+
+        # Video file, opened with the first frame
+        self.writer = None
+        self.relative_path = None
+        self.frame_size = None
+        self.finished = False
+
+        # Bytes of the video file already counted in the disk usage of the store
+        self.size = 0
+
+        # Frame count, end time, and the frame of highest motion with its boxes
+        self.frames = 0
+        self.end_timestamp = timestamp
+        self.score = 0.0
+        self.boxes = []
+        self.key_frame = 0
+
+
+class EventStore:
+    """
+    Bounded, indexed store of motion events.
+
+    An event is a video clip (or, for single frames, a marked JPEG image) saved in a per-day
+    folder, plus a row in a SQLite index with its camera, start and end time, motion score
+    and the bounding boxes of its frame of highest motion. Frames are decoded, marked and
+    encoded by a background thread, so the detection path only queues the received bytes.
+    When the files exceed the disk budget, the oldest events are evicted first.
+    """
+
+    def __init__(self, folder, max_bytes=1024 ** 3, queue_size=64, jpeg_quality=85, clip_fourcc="MJPG",
+                 legacy_camera="default"):
+        """
+        Initializes the event store. Images left in the folder by older versions of the
+        server are indexed, and the oldest events are evicted if the files exceed the budget.
+
+        :param folder: Folder holding the files and the index database.
+        :param max_bytes: Disk budget for the files, in bytes. Default is 1 GiB.
+        :param queue_size: Maximum number of frames waiting to be written. Default is 64.
+        :param jpeg_quality: JPEG quality of the saved images and MJPG clips. Default is 85.
+        :param clip_fourcc: Codec of the AVI clips, e.g. 'MJPG' or 'XVID'. Default is 'MJPG'.
+        :param legacy_camera: Camera of the images of older versions. Default is 'default'.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.jpeg_quality = jpeg_quality
+        self.clip_fourcc = clip_fourcc
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.sequence = itertools.count()
+        self.dropped = 0
+        self.evicted = 0
+        self.thread = None
+
+        # Create the folder if it doesn't exist
+        os.makedirs(folder, exist_ok=True)
+
+        # The connection is shared by the writer thread and the web requests
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(folder, "events.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "id TEXT PRIMARY KEY, camera TEXT NOT NULL, timestamp REAL NOT NULL, "
+            "score REAL NOT NULL, boxes TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL)"
+        )
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(events)")}
+        for column, definition in added_columns.items():
+            if column not in existing:
+                self.db.execute(f"ALTER TABLE events ADD COLUMN {column} {definition}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_camera ON events (camera, timestamp)")
+        self._index_legacy_images(legacy_camera)
+        self.db.commit()
+
+        # Current disk usage, kept up to date as events are added and evicted
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM events").fetchone()[0]
+        self._evict()
+
+    def _index_legacy_images(self, camera):
+        """
+        Indexes the marked images of older versions of the server, saved straight in the
+        folder as monitor_image_<YYYYmmdd_HHMMSS>.jpg, so they are listed and evicted like
+        the other events. Their motion score and boxes are unknown. Images already indexed
+        are skipped, so this is cheap on the next starts.
+        """
+        rows = []
+        for entry in os.scandir(self.folder):
+            match = legacy_image_pattern.fullmatch(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            try:
+                timestamp = datetime.datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").timestamp()
+            except ValueError:
+                timestamp = stat.st_mtime
+            rows.append((f"{match.group(1)}_000000_legacy", camera, timestamp, 0.0, "[]", entry.name, stat.st_size,
+                         timestamp, 1, 0))
+        if not rows:
+            return
+        changes = self.db.total_changes
+        self.db.executemany(f"INSERT OR IGNORE INTO events ({event_columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            rows)
+        if self.db.total_changes > changes:
+            logger.info("Indexed %d images of an older version in %s", self.db.total_changes - changes, self.folder)
+
+    def start(self):
+        """
+        Starts the background writer thread.
+        """
+        self.thread = threading.Thread(target=self._writer, name="event-writer", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Writes the queued frames, stops the writer thread and closes the index.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.db.close()
+
+    def new_event_id(self, timestamp):
+        """
+        Generates a unique, time-sortable event ID.
+
+        :param timestamp: Time of the event (seconds since the epoch).
+        :return: Event ID such as '20240113_234401_123456_000042'.
+        """
+        moment = datetime.datetime.fromtimestamp(timestamp)
+        return f"{moment.strftime('%Y%m%d_%H%M%S_%f')}_{next(self.sequence):06d}"
+
+    def add(self, camera, image, score, boxes, timestamp):
+        """
+        Queues a single-image motion event for writing. Never blocks the caller.
+
+        :param camera: Identifier of the camera.
+        :param image: Marked color image of the event.
+        :param score: Motion score of the frame.
+        :param boxes: List of bounding boxes (x, y, w, h) on the image.
+        :param timestamp: Time of the event (seconds since the epoch).
+        :return: Event ID, or None if the writer is behind and the event was dropped.
+        """
+        event_id = self.new_event_id(timestamp)
+        try:
+            self.queue.put_nowait((self._write, (event_id, camera, image, score, boxes, timestamp)))
+        except queue.Full:
+            self.dropped += 1
+            return None
+        return event_id
+
+    def open_clip(self, camera, timestamp, fps):
+        """
+        Starts a motion clip. The video file is created with its first frame.
+
+        :param camera: Identifier of the camera.
+        :param timestamp: Time of the start of the motion (seconds since the epoch).
+        :param fps: Frame rate of the video.
+        :return: Clip.
+        """
+        return Clip(self.new_event_id(timestamp), camera, timestamp, fps)
+
+    def add_clip_frame(self, clip, payload, timestamp, score=None, boxes=None, boxes_shape=None):
+        """
+        Queues a frame of a clip for writing. Never blocks the caller.
+
+        :param clip: Clip returned by open_clip().
+        :param payload: Received JPEG bytes of the frame.
+        :param timestamp: Reception time of the frame (seconds since the epoch).
+        :param score: Motion score of the frame, None for the frames around the motion.
+        :param boxes: Bounding boxes (x, y, w, h) of the areas of movement, drawn on the frame.
+        :param boxes_shape: Shape of the detection frame the boxes were found on.
+        :return: True if the frame was queued, False if it was dropped.
+        """
+        try:
+            self.queue.put_nowait((self._write_clip_frame, (clip, payload, timestamp, score, boxes, boxes_shape)))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close_clip(self, clip):
+        """
+        Ends a clip: the video file is finished and indexed once its frames are written.
+        Waits for room in the queue, so the end of a clip is never dropped.
+
+        :param clip: Clip returned by open_clip().
+        """
+        self.queue.put((self._finish_clip, (clip,)))
+
+    def _writer(self):
+        """
+        Writer loop: encodes and saves queued events and frames, then enforces the disk budget.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            method, arguments = item
+            try:
+                method(*arguments)
+            except Exception:
+                logger.exception("Error while saving a motion event")
+
+    def _write(self, event_id, camera, image, score, boxes, timestamp):
+        """
+        Encodes an event image, saves it and indexes it.
+        """
+        with stage_seconds.time(stage="save"):
+            ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                raise ValueError("The image could not be encoded.")
+
+            # One folder per day keeps every directory small
+            relative_path = os.path.join(event_id[:8], f"monitor_image_{event_id}.jpg")
+            path = os.path.join(self.folder, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as image_file:
+                image_file.write(encoded.tobytes())
+
+        self._index(event_id, camera, timestamp, score, boxes, relative_path, len(encoded))
+
+    def _write_clip_frame(self, clip, payload, timestamp, score, boxes, boxes_shape):
+        """
+        Decodes a frame of a clip, marks the areas of movement and appends it to the video.
+        """
+        if clip.finished:
+            return
+        with stage_seconds.time(stage="save"):
+            img = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError("The frame could not be decoded.")
+            if clip.writer is None:
+                self._open_video(clip, img)
+            elif (img.shape[1], img.shape[0]) != clip.frame_size:
+                # The video keeps the size of its first frame
+                img = cv2.resize(img, clip.frame_size)
+            if boxes:
+                boxes = scale_boxes(boxes, boxes_shape, img.shape)
+                draw_movement(img, boxes)
+            clip.writer.write(img)
+        self._count_clip_bytes(clip)
+
+        if score is not None and score > clip.score:
+            clip.score = score
+            clip.boxes = boxes or []
+            clip.key_frame = clip.frames
+        clip.frames += 1
+        clip.end_timestamp = timestamp
+
+    def _open_video(self, clip, img):
+        """
+        Creates the video file of a clip, with the size of its first frame.
+        """
+        # One folder per day keeps every directory small
+        clip.relative_path = os.path.join(clip.event_id[:8], f"monitor_clip_{clip.event_id}.avi")
+        path = os.path.join(self.folder, clip.relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        clip.frame_size = (img.shape[1], img.shape[0])
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.clip_fourcc), clip.fps, clip.frame_size)
+        if not writer.isOpened():
+            # Later frames of the clip are ignored
+            clip.finished = True
+            raise ValueError(f"The video could not be created with the codec {self.clip_fourcc}.")
+        writer.set(cv2.VIDEOWRITER_PROP_QUALITY, self.jpeg_quality)
+        clip.writer = writer
+
+    def _count_clip_bytes(self, clip):
+        """
+        Adds the bytes written to the video of a clip since the last frame to the disk usage,
+        so the budget is enforced while a long clip is still being recorded.
+        """
+        size = os.path.getsize(os.path.join(self.folder, clip.relative_path))
+        with self.lock:
+            self.total_bytes += size - clip.size
+        clip.size = size
+        self._evict()
+
+    def _finish_clip(self, clip):
+        """
+        Closes the video file of a clip and indexes it.
+        """
+        clip.finished = True
+        if clip.writer is None:
+            return
+        clip.writer.release()
+        clip.writer = None
+        size = os.path.getsize(os.path.join(self.folder, clip.relative_path))
+
+        # The bytes counted while recording are counted again by the index
+        with self.lock:
+            self.total_bytes -= clip.size
+        clip.size = 0
+        self._index(clip.event_id, clip.camera, clip.timestamp, clip.score, clip.boxes, clip.relative_path, size,
+                    clip.end_timestamp, clip.frames, clip.key_frame)
+
+    def _index(self, event_id, camera, timestamp, score, boxes, relative_path, size,
+               end_timestamp=None, frames=1, key_frame=0):
+        """
+        Adds a saved event to the index, then enforces the disk budget.
+        """
+        with self.lock:
+            self.db.execute(
+                f"INSERT INTO events ({event_columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (event_id, camera, timestamp, score, json.dumps(boxes), relative_path, size,
+                 end_timestamp if end_timestamp is not None else timestamp, frames, key_frame),
+            )
+            self.db.commit()
+            self.total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        """
+        Deletes the oldest events until the files fit in the disk budget.
+        """
+        while self.total_bytes > self.max_bytes:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT id, path, size FROM events ORDER BY timestamp LIMIT 64"
+                ).fetchall()
+                if not rows:
+                    return
+
+                # Never evict more than needed to get back under the budget
+                excess = self.total_bytes - self.max_bytes
+                victims = []
+                for row in rows:
+                    victims.append(row)
+                    excess -= row[2]
+                    if excess <= 0:
+                        break
+
+                self.db.executemany("DELETE FROM events WHERE id = ?", [(row[0],) for row in victims])
+                self.db.commit()
+                self.total_bytes -= sum(row[2] for row in victims)
+                self.evicted += len(victims)
+
+            for _, relative_path, _ in victims:
+                try:
+                    os.remove(os.path.join(self.folder, relative_path))
+                except OSError as e:
+                    logger.warning("Error while removing evicted event %s: %s", relative_path, e)
+
+    @staticmethod
+    def _row_to_event(row):
+        """
+        Converts an index row to a dictionary.
+        """
+        event_id, camera, timestamp, score, boxes, path, size, end_timestamp, frames, key_frame = row
+        return {'id': event_id, 'camera': camera, 'kind': 'clip' if path.endswith('.avi') else 'image',
+                'timestamp': timestamp, 'end_timestamp': end_timestamp if end_timestamp is not None else timestamp,
+                'score': score, 'boxes': json.loads(boxes), 'frames': frames, 'key_frame': key_frame,
+                'path': path, 'size': size}
+
+    def list(self, camera=None, start=None, end=None, limit=100):
+        """
+        Lists events from the index, most recent first.
+
+        :param camera: Only events of this camera if given.
+        :param start: Only events at or after this time (seconds since the epoch) if given.
+        :param end: Only events before this time if given.
+        :param limit: Maximum number of events. Default is 100.
+        :return: List of event dictionaries.
+        """
+        conditions = []
+        parameters = []
+        if camera is not None:
+            conditions.append("camera = ?")
+            parameters.append(camera)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(end)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {event_columns} FROM events {where} "
+                "ORDER BY timestamp DESC LIMIT ?",
+                parameters + [limit],
+            ).fetchall()
+        return [self._row_to_event(row) for row in rows]
+
+    def get(self, event_id):
+        """
+        Looks up an event by ID.
+
+        :param event_id: ID of the event.
+        :return: Event dictionary, or None if the event does not exist (or was evicted).
+        """
+        with self.lock:
+            row = self.db.execute(
+                f"SELECT {event_columns} FROM events WHERE id = ?",
+                (event_id,),
+            ).fetchone()
+        return self._row_to_event(row) if row else None
+
+    def media_path(self, event):
+        """
+        Absolute path of the file of an event.
+
+        :param event: Event dictionary.
+        :return: Path of the AVI clip or JPEG image.
+        """
+        return os.path.join(self.folder, event['path'])
+
+    def key_frame(self, event):
+        """
+        Reads the image of an event: the saved image, or the frame of highest motion of a clip.
+
+        :param event: Event dictionary.
+        :return: JPEG bytes, or None if the file cannot be read (e.g. evicted meanwhile).
+        """
+        path = self.media_path(event)
+        if event['kind'] == 'image':
+            try:
+                with open(path, "rb") as image_file:
+                    return image_file.read()
+            except OSError:
+                return None
+
+        capture = cv2.VideoCapture(path)
+        try:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, event['key_frame'])
+            ok, img = capture.read()
+        finally:
+            capture.release()
+        if not ok:
+            return None
+        ok, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return encoded.tobytes() if ok else None
+
+    def stats(self):
+        """
+        Returns the disk usage and counters of the store.
+
+        :return: Dictionary of statistics.
+        """
+        with self.lock:
+            count = self.db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+        return {
+            'events': count,
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'queue_depth': self.queue.qsize(),
+            'dropped': self.dropped,
+            'evicted': self.evicted,
+        }
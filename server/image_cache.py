@@ -0,0 +1,289 @@
+# Import necessary libraries
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import cv2
+import numpy as np
+
+##################################################
+
+logger = logging.getLogger("image_cache")
+
+# Decoding flags dividing the size of a JPEG image by 2, 4 or 8 while decoding
+reduced_color_flags = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# JPEG markers starting a frame (SOF0 to SOF15, except DHT, JPG and DAC), which hold the image size
+sof_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+##################################################
+
+
+def jpeg_size(data):
+    """
+    Reads the size of a JPEG image from its header, without decoding it.
+
+    :param data: Encoded image.
+    :return: Tuple (width, height), or None if the data is not a readable JPEG image.
+    """
+    if not data.startswith(b'\xff\xd8'):
+        return None
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            offset += 1
+            continue
+        length = int.from_bytes(data[offset + 2:offset + 4], 'big')
+        if marker in sof_markers:
+            height = int.from_bytes(data[offset + 5:offset + 7], 'big')
+            width = int.from_bytes(data[offset + 7:offset + 9], 'big')
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def resize_image(data, width, quality=80):
+    """
+    Creates a smaller JPEG variant of an image, keeping its aspect ratio. Images are never
+    enlarged.
+
+    A JPEG image much larger than the variant is decoded directly at 1/2, 1/4 or 1/8 of
+    its size, which is several times faster than decoding it in full.
+
+    :param data: Encoded image (JPEG or PNG).
+    :param width: Width of the variant, in pixels.
+    :param quality: JPEG quality of the variant. Default is 80.
+    :return: JPEG bytes of the variant.
+    """
+    size = jpeg_size(data)
+    factor = 1
+    if size is not None:
+        while factor < 8 and size[0] // (factor * 2) >= width:
+            factor *= 2
+
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), reduced_color_flags[factor])
+    if img is None:
+        raise ValueError("The image could not be decoded.")
+    if img.shape[1] > width:
+        height = max(1, round(img.shape[0] * width / img.shape[1]))
+        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+    ok, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("The image could not be encoded.")
+    return encoded.tobytes()
+
+
+class VariantCache:
+    """
+    Byte-bounded LRU cache of generated images, such as the thumbnails of the camera
+    frames and motion events.
+
+    Images are generated on demand by the function given to get(), and the least recently
+    used ones are evicted once the cache exceeds its memory budget. With a spill folder,
+    evicted images are written there (within a separate disk budget) and read back
+    instead of being generated again. Keys must identify the content, e.g. a frame digest
+    or an event ID, so a cached image never goes stale. Concurrent requests for the same
+    missing image wait for a single generation, e.g. every MJPEG client woken by a new frame.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 ** 2, folder=None, folder_max_bytes=256 * 1024 ** 2):
+        """
+        Initializes the cache.
+
+        :param max_bytes: Memory budget, in bytes. Default is 32 MiB.
+        :param folder: Folder receiving the images evicted from memory, None to drop them.
+        :param folder_max_bytes: Disk budget of the folder, in bytes. Default is 256 MiB.
+        """
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.folder_max_bytes = folder_max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.files = OrderedDict()
+        self.file_bytes = 0
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if folder is not None:
+            # Images spilled before a restart are still valid: reuse them, oldest first
+            os.makedirs(folder, exist_ok=True)
+            spilled = sorted((entry for entry in os.scandir(folder) if entry.is_file() and entry.name.endswith('.jpg')),
+                             key=lambda entry: entry.stat().st_mtime)
+            for entry in spilled:
+                self.files[entry.name] = entry.stat().st_size
+                self.file_bytes += self.files[entry.name]
+            self._trim_folder()
+
+    @staticmethod
+    def file_name(key):
+        """
+        Name of the spill file of a key.
+
+        :param key: Tuple identifying the image.
+        :return: File name.
+        """
+        return hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).hexdigest() + ".jpg"
+
+    def get(self, key, generate):
+        """
+        Returns a cached image, generating it if needed.
+
+        :param key: Tuple identifying the image, e.g. ('event', event_id, 'thumb').
+        :param generate: Function returning the image bytes, or None if the source is missing.
+        :return: Image bytes, or None if generate() returned None.
+        """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+            # Another thread is already generating the image: wait for its result
+            waiting = self.pending.get(key)
+            if waiting is not None:
+                self.hits += 1
+            else:
+                future = self.pending[key] = Future()
+        if waiting is not None:
+            return waiting.result()
+
+        try:
+            data = self._read_spilled(key) if self.folder is not None else None
+            if data is not None:
+                self.disk_hits += 1
+            else:
+                data = generate()
+                if data is not None:
+                    self.misses += 1
+            if data is not None:
+                self._store(key, data)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+
+    def _store(self, key, data):
+        """
+        Adds an image to the memory, evicting (and spilling) the least recently used ones.
+        """
+        if len(data) > self.max_bytes:
+            return
+        evicted = []
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= len(previous)
+            self.entries[key] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                evicted.append(self.entries.popitem(last=False))
+                self.total_bytes -= len(evicted[-1][1])
+            self.evictions += len(evicted)
+
+        if self.folder is not None:
+            for evicted_key, evicted_data in evicted:
+                self._spill(evicted_key, evicted_data)
+
+    def _spill(self, key, data):
+        """
+        Writes an image evicted from memory to the spill folder.
+        """
+        name = self.file_name(key)
+        with self.lock:
+            if name in self.files:
+                self.files.move_to_end(name)
+                return
+        if len(data) > self.folder_max_bytes:
+            return
+
+        path = os.path.join(self.folder, name)
+        try:
+            # Written under a temporary name, so a reader never sees a partial file
+            with open(path + ".tmp", "wb") as spill_file:
+                spill_file.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning("Error while spilling a cached image to %s: %s", path, e)
+            return
+
+        with self.lock:
+            self.files[name] = len(data)
+            self.file_bytes += len(data)
+        self._trim_folder()
+
+    def _read_spilled(self, key):
+        """
+        Reads an image from the spill folder.
+
+        :return: Image bytes, or None if the image was not spilled.
+        """
+        name = self.file_name(key)
+        with self.lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+        try:
+            with open(os.path.join(self.folder, name), "rb") as spill_file:
+                return spill_file.read()
+        except OSError:
+            with self.lock:
+                size = self.files.pop(name, None)
+                if size is not None:
+                    self.file_bytes -= size
+            return None
+
+    def _trim_folder(self):
+        """
+        Deletes the least recently used spill files until the folder fits in its budget.
+        """
+        victims = []
+        with self.lock:
+            while self.file_bytes > self.folder_max_bytes and self.files:
+                name, size = self.files.popitem(last=False)
+                self.file_bytes -= size
+                victims.append(name)
+        for name in victims:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError as e:
+                logger.warning("Error while removing spilled image %s: %s", name, e)
+
+    def stats(self):
+        """
+        Returns the size and counters of the cache.
+
+        :return: Dictionary of statistics.
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'spilled_files': len(self.files),
+                'spilled_bytes': self.file_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
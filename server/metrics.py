@@ -0,0 +1,391 @@
+# Import necessary libraries
+import math
+import time
+import bisect
+import logging
+import threading
+
+##################################################
+
+logger = logging.getLogger("metrics")
+
+# Buckets of the duration histograms (seconds), from 0.5 ms to 5 s
+default_time_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Buckets of the payload size histograms (bytes), from 64 B to 1 MiB
+default_size_buckets = (64, 256, 1024, 4096, 16384, 65536, 131072, 262144, 524288, 1048576)
+
+##################################################
+
+
+def format_value(value):
+    """
+    Formats a sample value for the Prometheus text format.
+
+    :param value: Number to format.
+    :return: String such as '12', '0.25' or '+Inf'.
+    """
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def escape_label_value(value):
+    """
+    Escapes a label value: backslashes, double quotes and line feeds.
+
+    :param value: Label value.
+    :return: Escaped string.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=None):
+    """
+    Formats the labels of a sample, e.g. '{topic="home/cam",device="cam1"}'.
+
+    :param names: Label names.
+    :param values: Label values, in the same order.
+    :param extra: Optional additional (name, value) pair, such as the 'le' label of a bucket.
+    :return: Label string, empty if there are no labels.
+    """
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """
+    Base class of the metrics: a named family of samples, one per combination of label values.
+    """
+
+    type_name = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        """
+        Initializes the metric.
+
+        :param name: Metric name, e.g. 'mqtt_messages_total'.
+        :param help_text: Description shown in the HELP line.
+        :param labelnames: Names of the labels of the samples.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.function = None
+
+    def key(self, labels):
+        """
+        Converts keyword labels to the tuple of label values used as key.
+        """
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects the labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function):
+        """
+        Reads the value from a function when the metrics are collected, instead of storing it.
+
+        :param function: Function returning the value, or a dictionary {label values tuple: value}.
+        """
+        self.function = function
+
+    def samples(self):
+        """
+        Returns the current samples of the metric.
+
+        :return: List of (suffix, label string, value) tuples.
+        """
+        if self.function is not None:
+            value = self.function()
+            values = value if isinstance(value, dict) else {(): value}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [("", format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+    def render(self):
+        """
+        Renders the metric in the Prometheus text format.
+
+        :return: List of lines.
+        """
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count, e.g. of received messages.
+    """
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Increments the counter.
+
+        :param amount: Increment. Default is 1.
+        :param labels: Label values of the sample.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, e.g. a queue depth.
+    """
+
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        """
+        Sets the gauge.
+
+        :param value: New value.
+        :param labels: Label values of the sample.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Timer:
+    """
+    Context manager observing the time spent in its block in a histogram.
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (durations, sizes) in cumulative buckets.
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=default_time_buckets):
+        """
+        Initializes the histogram.
+
+        :param name: Metric name, e.g. 'pipeline_stage_seconds'.
+        :param help_text: Description shown in the HELP line.
+        :param labelnames: Names of the labels of the samples.
+        :param buckets: Increasing upper bounds of the buckets. A +Inf bucket is added.
+        """
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        """
+        Records a value.
+
+        :param value: Observed value.
+        :param labels: Label values of the sample.
+        """
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            # Counts are stored per bucket and accumulated when rendered
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """
+        Times a block of code, e.g. 'with histogram.time(stage="decode"):'.
+
+        :param labels: Label values of the sample.
+        :return: Timer context manager.
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        samples = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", format_labels(self.labelnames, key, ("le", format_value(float(bound)))), cumulative))
+            labels = format_labels(self.labelnames, key)
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics exposed together, e.g. by a /metrics endpoint.
+    """
+
+    # Content type of the Prometheus text exposition format
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Adds a metric, or returns the existing metric of the same name.
+
+        :param metric: Metric to add.
+        :return: The registered metric.
+        """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=default_time_buckets):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        """
+        Renders all the metrics in the Prometheus text format.
+
+        :return: Text of the exposition.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning("Could not collect metric %s: %s", metric.name, e)
+        return "\n".join(lines) + "\n"
+
+
+##################################################
+
+## Logging
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most a few records of each kind through per interval.
+
+    Records are of the same kind when they come from the same logger with the same level
+    and message template, so a frame error repeated at the camera rate is logged a few
+    times per interval. The filter never changes the records, which the other handlers
+    see too: RateLimitedHandler adds the number of records suppressed in between.
+    """
+
+    def __init__(self, burst=5, interval=60):
+        """
+        Initializes the filter.
+
+        :param burst: Records of one kind let through per interval. Default is 5.
+        :param interval: Length of the interval, in seconds. Default is 60.
+        """
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def check(self, record):
+        """
+        Counts a record in the window of its kind.
+
+        :param record: Log record.
+        :return: Number of records of the same kind suppressed since the previous one let
+                 through, or None if this record is suppressed.
+        """
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            start, emitted, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, emitted = now, 0
+            if emitted >= self.burst:
+                self.windows[key] = (start, emitted, suppressed + 1)
+                return None
+            self.windows[key] = (start, emitted + 1, 0)
+        return suppressed
+
+    def filter(self, record):
+        return self.check(record) is not None
+
+
+class RateLimitedHandler(logging.StreamHandler):
+    """
+    Stream handler letting at most a few records of each kind through per interval (see
+    RateLimitFilter). A record following suppressed ones is emitted as a copy mentioning
+    their number, so the original record is left as the other handlers see it.
+    """
+
+    def __init__(self, burst=5, interval=60, stream=None):
+        """
+        Initializes the handler.
+
+        :param burst: Records of one kind let through per interval. Default is 5.
+        :param interval: Length of the interval, in seconds. Default is 60.
+        :param stream: Output stream. Default is stderr.
+        """
+        super().__init__(stream)
+        self.limiter = RateLimitFilter(burst, interval)
+
+    def handle(self, record):
+        suppressed = self.limiter.check(record)
+        if suppressed is None:
+            return False
+        if suppressed and isinstance(record.args, tuple):
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = f"{record.msg} (%d similar messages suppressed)"
+            record.args = record.args + (suppressed,)
+        return super().handle(record)
+
+
+def setup_logging(level="INFO", burst=5, interval=60):
+    """
+    Configures the root logger: leveled output on stderr, rate-limited per kind of record.
+
+    :param level: Name or number of the minimum level. Default is 'INFO'.
+    :param burst: Records of one kind let through per interval. Default is 5.
+    :param interval: Length of the rate limiting interval, in seconds. Default is 60.
+    """
+    handler = RateLimitedHandler(burst, interval)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+
+# Metrics of the server, shared by all its modules
+registry = MetricsRegistry()
+
+# Time spent in each stage of the ingest pipeline: decode, diff, contour, save and publish
+stage_seconds = registry.histogram(
+    "pipeline_stage_seconds", "Time spent in each stage of the frame pipeline.", ["stage"])
@@ -0,0 +1,684 @@
+# Import necessary libraries
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager, suppress
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+import aiomqtt
+import uvicorn
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from starlette.templating import Jinja2Templates
+import server_pub as pipeline
+
+##################################################
+
+## Initialization
+
+# Async server mode: the HTTP layer (ASGI) and the MQTT client share one asyncio event
+# loop. Decoding and motion detection run in a thread pool, so the loop only routes
+# messages and serves requests. Devices, detectors and stores are the ones of
+# server_pub, so both modes behave the same.
+
+# The settings (broker, reconnection delays, HTTP address...) are the ones of server_pub,
+# read by create_app() from the configuration file and the environment.
+
+templates = Jinja2Templates(directory=os.path.join(pipeline.get_current_script_directory(), "templates"))
+
+logger = logging.getLogger("server_async")
+
+##################################################
+
+
+class AsyncPublisher:
+    """
+    Lets the detection threads publish through the asyncio MQTT client.
+
+    It has the publish(topic, payload, retain) method used by the pipeline functions of server_pub,
+    and schedules the actual publication on the event loop.
+    """
+
+    def __init__(self, loop):
+        """
+        Initializes the publisher.
+
+        :param loop: Event loop running the MQTT client.
+        """
+        self.loop = loop
+        self.client = None
+
+    def publish(self, topic, payload, retain=False):
+        """
+        Publishes a message from any thread. Dropped while the broker is disconnected.
+
+        :param topic: MQTT topic.
+        :param payload: Message payload.
+        :param retain: Whether the broker keeps the message for new subscribers. Default is False.
+        """
+        client = self.client
+        if client is None:
+            logger.warning("Not connected to the broker, message on %s dropped", topic)
+            return
+        asyncio.run_coroutine_threadsafe(client.publish(topic, payload, retain=retain), self.loop)
+
+
+class AsyncDetection:
+    """
+    Runs motion detection in a thread pool, one frame at a time per camera.
+
+    Each camera has at most one frame waiting: a new frame replaces the waiting one (which
+    is counted as dropped), so a camera faster than the detection never builds a backlog.
+    All bookkeeping happens on the event loop, so it needs no lock. Sensor readings are
+    handled by a separate thread, in their order of arrival, as storing them touches the
+    disk.
+    """
+
+    def __init__(self, publisher, num_workers=2):
+        """
+        Initializes the detection.
+
+        :param publisher: AsyncPublisher used to publish the monitoring status.
+        :param num_workers: Number of detection threads.
+        """
+        self.publisher = publisher
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="detection")
+        self.readings = ThreadPoolExecutor(max_workers=1, thread_name_prefix="readings")
+        self.pending = {}
+        self.active = set()
+        self.dropped = {}
+        self.processed = 0
+
+    def submit(self, device_id, payload):
+        """
+        Queues a frame of a camera. Must be called from the event loop.
+
+        :param device_id: Identifier of the camera.
+        :param payload: Raw bytes of the frame.
+        """
+        if device_id in self.pending:
+            self.dropped[device_id] = self.dropped.get(device_id, 0) + 1
+        self.pending[device_id] = payload
+        if device_id not in self.active:
+            self.active.add(device_id)
+            asyncio.get_running_loop().create_task(self._run(device_id))
+
+    def submit_reading(self, prefix, device_id, payload):
+        """
+        Queues a sensor reading.
+
+        :param prefix: Topic prefix, e.g. 'home/data'.
+        :param device_id: Identifier of the sensor.
+        :param payload: Raw bytes of the reading.
+        """
+        self.readings.submit(self._handle_reading, prefix, device_id, payload)
+
+    @staticmethod
+    def _handle_reading(prefix, device_id, payload):
+        """
+        Handles a sensor reading in the readings thread.
+        """
+        try:
+            pipeline.topic_handlers[prefix](device_id, payload)
+        except Exception:
+            logger.exception("Error while handling reading from %s", device_id)
+
+    async def _run(self, device_id):
+        """
+        Processes the waiting frames of a camera until there are none left.
+        """
+        loop = asyncio.get_running_loop()
+        state = pipeline.get_device(device_id)
+        process = pipeline.process_frame_in_memory if pipeline.in_memory_frames else pipeline.process_frame_on_disk
+        try:
+            while device_id in self.pending:
+                payload = self.pending.pop(device_id)
+                try:
+                    await loop.run_in_executor(self.executor, process, self.publisher, state, payload)
+                except Exception:
+                    logger.exception("Error while processing frame from %s", device_id)
+                self.processed += 1
+        finally:
+            self.active.discard(device_id)
+
+    def stats(self):
+        """
+        Returns the number of waiting frames and the drop counters.
+
+        :return: Dictionary of statistics, with the same keys as DetectionDispatcher.stats().
+        """
+        return {
+            'queue_depth': len(self.pending),
+            'max_queue_size': None,
+            'workers': self.num_workers,
+            'processed': self.processed,
+            'dropped': dict(self.dropped),
+            'dropped_total': sum(self.dropped.values()),
+        }
+
+    def shutdown(self):
+        """
+        Stops the detection threads, and the readings thread once the queued readings are
+        stored.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.readings.shutdown(wait=True)
+
+
+##################################################
+
+
+def handle_message(detection, message):
+    """
+    Routes an MQTT message received by the asyncio client.
+
+    Camera frames are queued for detection and sensor readings for the readings thread,
+    so the event loop never waits for the disk.
+
+    :param detection: AsyncDetection instance.
+    :param message: aiomqtt message.
+    """
+    topic = str(message.topic)
+    if pipeline.cluster is not None:
+        # Messages of devices owned by another instance are forwarded to it
+        topic = pipeline.cluster.route(detection.publisher, topic, message.payload)
+        if topic is None:
+            return
+    # Recorded on the device topic. Retained messages are old messages sent again by the
+    # broker, not live traffic.
+    if pipeline.capture is not None and not message.retain:
+        pipeline.capture.record(topic, message.payload)
+
+    route = pipeline.parse_topic(topic)
+    if route is None:
+        pipeline.mqtt_messages_ignored_total.inc()
+        logger.warning("Ignoring message on unexpected topic %s", topic)
+        return
+
+    prefix, device_id = route
+    pipeline.record_message(prefix, device_id, message.payload)
+    try:
+        if message.retain:
+            pipeline.handle_retained_message(prefix, device_id, bytes(message.payload))
+        elif prefix == "home/cam":
+            pipeline.get_device(device_id).last_seen = time.time()
+            detection.submit(device_id, bytes(message.payload))
+        else:
+            detection.submit_reading(prefix, device_id, bytes(message.payload))
+    except Exception:
+        logger.exception("Error while handling message on %s", topic)
+
+
+async def run_mqtt(publisher, detection):
+    """
+    Connects to the broker, subscribes to the device topics and routes the messages,
+    reconnecting with an increasing delay when the connection is lost.
+
+    :param publisher: AsyncPublisher to attach to the connected client.
+    :param detection: AsyncDetection instance.
+    """
+    cluster = pipeline.cluster
+    # In clustered mode, the broker clears the announcement of this instance if it disappears
+    will = aiomqtt.Will(cluster.member_topic(), b"", retain=True) if cluster is not None else None
+    delay = pipeline.mqtt_reconnect_delay
+    while True:
+        try:
+            async with aiomqtt.Client(pipeline.mqtt_broker_host, pipeline.mqtt_broker_port, keepalive=60,
+                                      will=will) as client:
+                publisher.client = client
+                for topic in pipeline.subscription_topics():
+                    await client.subscribe(topic)
+                if cluster is not None:
+                    await client.publish(cluster.member_topic(), cluster.announcement(), retain=True)
+                logger.info("Connected to the broker %s", pipeline.mqtt_broker_host)
+                pipeline.mqtt_connected.set(1)
+                delay = pipeline.mqtt_reconnect_delay
+                async for message in client.messages:
+                    handle_message(detection, message)
+        except aiomqtt.MqttError as e:
+            logger.warning("Connection to the broker lost (%s), retrying in %d s", e, delay)
+        finally:
+            publisher.client = None
+            pipeline.mqtt_connected.set(0)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, pipeline.mqtt_reconnect_max_delay)
+
+
+async def start_pipeline(publisher, detection):
+    """
+    Opens the stores, starts the detection processes and restores the state of the devices
+    in the thread pool, then starts the anomaly detection and connects to the broker. Run
+    as a task, so the web server answers while the stores are loading.
+
+    :param publisher: AsyncPublisher to attach to the connected client.
+    :param detection: AsyncDetection instance.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, pipeline.open_stores)
+        await loop.run_in_executor(None, pipeline.start_detection_pool)
+        await loop.run_in_executor(None, pipeline.restore_state)
+    except Exception:
+        logger.exception("Error while starting the server")
+        return
+    pipeline.startup_complete.set()
+    pipeline.start_anomaly_detection(publisher)
+    if pipeline.cluster is not None:
+        # The shared subscription never receives the retained messages
+        loop.run_in_executor(None, pipeline.restore_retained_messages)
+    await run_mqtt(publisher, detection)
+
+
+##################################################
+
+## HTTP layer
+
+
+async def wait_for_startup():
+    """
+    Waits until the stores are open, for at most startup_wait seconds.
+
+    :raises HTTPException: 503 if the stores are still not open.
+    """
+    if pipeline.startup_complete.is_set():
+        return
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, pipeline.startup_complete.wait, pipeline.startup_wait):
+        raise HTTPException(503, "Starting up, retry shortly.", headers={'Retry-After': '5'})
+
+
+def http_date(timestamp):
+    """
+    Formats a time as an HTTP date.
+    """
+    return formatdate(timestamp, usegmt=True)
+
+
+def conditional_response(request, body, media_type, etag, last_modified):
+    """
+    Builds a response that is answered with 304 Not Modified when the client already has it.
+
+    :param request: Starlette request.
+    :param body: Body of the full response.
+    :param media_type: Content type.
+    :param etag: Entity tag (without quotes).
+    :param last_modified: Time of the last change (seconds since the epoch), or None.
+    :return: Starlette response.
+    """
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        if headers['ETag'] in tags or '*' in tags:
+            return Response(status_code=304, headers=headers)
+    elif last_modified is not None and 'if-modified-since' in request.headers:
+        try:
+            since = parsedate_to_datetime(request.headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        # HTTP dates have a one-second resolution
+        if since is not None and int(last_modified) <= since:
+            return Response(status_code=304, headers=headers)
+
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def query_variant(request):
+    """
+    Reads the 'size' query parameter of an image request.
+
+    :return: Name of the image variant, or None for the original image.
+    """
+    size = request.query_params.get('size')
+    try:
+        pipeline.check_variant(size)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return size
+
+
+def query_number(request, name, default, kind=float):
+    """
+    Reads a numeric query parameter.
+
+    :return: Value of the parameter, or the default if it is missing.
+    """
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        raise HTTPException(400, f"Invalid value for '{name}'.")
+
+
+def redirect_to_owner(request, device_id):
+    """
+    Sends the client to the instance owning a device, in clustered mode. Returns normally
+    when the request is answered by this instance.
+    """
+    path = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+    location = pipeline.owner_location(device_id, path)
+    if location is not None:
+        raise HTTPException(307, headers={'Location': location})
+
+
+async def index(request):
+    """
+    Main page, same template and variables as the threaded server.
+    """
+    redirect_to_owner(request, request.query_params.get('camera'))
+    context = pipeline.dashboard_context(request.query_params.get('camera'), request.query_params.get('sensor'),
+                                         request.query_params.get('size'))
+    return templates.TemplateResponse(request, 'indexFinal.html', context)
+
+
+def camera_with_frame(device_id):
+    """
+    DeviceState of a camera that has a frame, or 404.
+    """
+    camera = pipeline.devices.get(device_id) if device_id is not None \
+        else pipeline.find_device(None, 'latest_frame')
+    if camera is None or camera.latest_frame is None:
+        raise HTTPException(404)
+    return camera
+
+
+async def frame(request):
+    """
+    Latest frame of a camera from memory (or a smaller variant), with conditional GET support.
+    """
+    redirect_to_owner(request, request.path_params.get('device_id'))
+    size = query_variant(request)
+    camera = camera_with_frame(request.path_params.get('device_id'))
+    current = camera.latest_frame
+    data = current.data
+    if size is not None:
+        # Resizing decodes the frame: keep it off the event loop
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, pipeline.frame_image, camera.device_id, current, size)
+    return conditional_response(request, data, pipeline.image_mimetype(data),
+                                current.digest.hex() + (f"-{size}" if size else ""), current.timestamp)
+
+
+async def latest(request):
+    """
+    Latest reading, motion flag and frame information, with conditional GET support.
+    """
+    redirect_to_owner(request, request.query_params.get('device'))
+    snapshot = pipeline.latest_snapshot(request.query_params.get('device'))
+    if snapshot is None:
+        raise HTTPException(404)
+    data, last_modified = snapshot
+    response = JSONResponse(data)
+    etag = pipeline.payload_hash(response.body).hex()
+    return conditional_response(request, response.body, 'application/json', etag, last_modified)
+
+
+async def devices(request):
+    """
+    Summary of the known devices.
+    """
+    return JSONResponse(pipeline.device_summaries())
+
+
+async def cluster_state(request):
+    """
+    Members of the cluster, forwarding counters and owners of the devices.
+    """
+    return JSONResponse(pipeline.cluster_summary())
+
+
+async def detection_stats(request):
+    """
+    Detection backlog and drop counters.
+    """
+    return JSONResponse(pipeline.with_pool_stats(request.app.state.detection.stats()))
+
+
+async def history(request):
+    """
+    Downsampled sensor history of a device (same parameters as the threaded server).
+    """
+    redirect_to_owner(request, request.path_params['device_id'])
+    end = query_number(request, 'end', time.time())
+    start = query_number(request, 'start', end - 24 * 3600)
+    points = min(max(query_number(request, 'points', 500, int), 3), 5000)
+    method = request.query_params.get('method', 'minmax')
+    metrics = request.query_params.get('metrics')
+    metrics = metrics.split(',') if metrics else None
+    await wait_for_startup()
+
+    # The downsampling is NumPy work: keep it off the event loop
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(None, pipeline.history_snapshot,
+                                            request.path_params['device_id'], start, end, points, method, metrics)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if result is None:
+        raise HTTPException(404)
+    # Dashboards served by another instance of the cluster fetch the history from here
+    return JSONResponse(result, headers={'Access-Control-Allow-Origin': '*'})
+
+
+async def stream(request):
+    """
+    Server-Sent Events: the current state, then only the changes.
+    """
+    async def generate():
+        subscriber = pipeline.broadcaster.subscribe_async({'reading', 'motion', 'frame'})
+        try:
+            for kind, data in pipeline.initial_stream_events():
+                yield pipeline.format_sse(kind, data)
+            while True:
+                try:
+                    kind, data = await asyncio.wait_for(subscriber.get(), pipeline.stream_keepalive)
+                except asyncio.TimeoutError:
+                    yield pipeline.sse_keepalive
+                    continue
+                yield pipeline.format_sse(kind, data)
+        finally:
+            pipeline.broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def mjpeg(request):
+    """
+    Multipart MJPEG stream of a camera (or of smaller variants of its frames), a frame
+    being sent only when a new one arrives.
+    """
+    device_id = request.path_params['device_id']
+    redirect_to_owner(request, device_id)
+    size = query_variant(request)
+    state = pipeline.devices.get(device_id)
+    if state is None:
+        raise HTTPException(404)
+
+    async def generate():
+        subscriber = pipeline.broadcaster.subscribe_async({'frame'})
+        try:
+            sent = None
+            while True:
+                latest_frame = state.latest_frame
+                if latest_frame is not None and latest_frame is not sent:
+                    data = latest_frame.data
+                    if size is not None:
+                        data = await asyncio.get_running_loop().run_in_executor(
+                            None, pipeline.frame_image, device_id, latest_frame, size)
+                    yield pipeline.mjpeg_part(data)
+                    sent = latest_frame
+                # Wait for the next frame of this camera
+                try:
+                    while True:
+                        _, data = await asyncio.wait_for(subscriber.get(), pipeline.stream_keepalive)
+                        if data['device_id'] == device_id:
+                            break
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            pipeline.broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(generate(), media_type='multipart/x-mixed-replace; boundary=frame',
+                             headers={'Cache-Control': 'no-cache'})
+
+
+async def events(request):
+    """
+    Motion events from the index, most recent first.
+    """
+    redirect_to_owner(request, request.query_params.get('camera'))
+    start = query_number(request, 'start', None)
+    end = query_number(request, 'end', None)
+    limit = query_number(request, 'limit', 100, int)
+    await wait_for_startup()
+
+    # SQLite calls block: keep them off the event loop
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(None, lambda: pipeline.event_store.list(
+        camera=request.query_params.get('camera'), start=start, end=end, limit=limit))
+    return JSONResponse(result)
+
+
+async def event_image(request):
+    """
+    Marked image of a motion event (the key frame of a clip), or a smaller variant.
+    """
+    size = query_variant(request)
+    await wait_for_startup()
+    loop = asyncio.get_running_loop()
+    event = await loop.run_in_executor(None, pipeline.event_store.get, request.path_params['event_id'])
+    # Reading the frame of a clip decodes video: keep it off the event loop
+    image = await loop.run_in_executor(None, pipeline.event_image_data, event, size) if event is not None else None
+    if image is None:
+        raise HTTPException(404)
+    # Events never change: browsers may keep their images
+    return Response(image, media_type='image/jpeg', headers={'Cache-Control': 'max-age=86400'})
+
+
+async def event_clip(request):
+    """
+    Video clip of a motion event.
+    """
+    await wait_for_startup()
+    loop = asyncio.get_running_loop()
+    event = await loop.run_in_executor(None, pipeline.event_store.get, request.path_params['event_id'])
+    if event is None or event['kind'] != 'clip':
+        raise HTTPException(404)
+    return FileResponse(pipeline.event_store.media_path(event), media_type='video/x-msvideo')
+
+
+async def metrics(request):
+    """
+    Server metrics in the Prometheus text format.
+    """
+    # Rendered on the event loop, which owns the state of the async detection
+    return Response(pipeline.registry.render(), headers={'Content-Type': pipeline.registry.content_type})
+
+
+async def alerts(request):
+    """
+    Sensor anomalies going on, with the moving statistics of a device with '?device=<id>'.
+    """
+    detector = pipeline.anomaly_detector
+    if detector is None:
+        raise HTTPException(404)
+    result = {'active': detector.active_alerts(), 'stats': detector.stats()}
+    device_id = request.query_params.get('device')
+    if device_id is not None:
+        result['statistics'] = detector.statistics(device_id)
+    return JSONResponse(result)
+
+
+async def image_stats(request):
+    """
+    Size and counters of the image variant cache.
+    """
+    await wait_for_startup()
+    return JSONResponse(pipeline.image_cache.stats())
+
+
+async def event_stats(request):
+    """
+    Disk usage and counters of the motion event store.
+    """
+    await wait_for_startup()
+    loop = asyncio.get_running_loop()
+    return JSONResponse(await loop.run_in_executor(None, pipeline.event_store.stats))
+
+
+##################################################
+
+
+def create_app(config_file=None):
+    """
+    Creates the ASGI application, e.g. 'uvicorn server_async:create_app --factory'. The
+    settings are read as by server_pub (configuration file, then environment). The stores
+    and the MQTT client are started in the background with the application and stopped
+    with it.
+
+    :param config_file: Path of a JSON configuration file (see server_pub.load_config()).
+    :return: Starlette application.
+    """
+    pipeline.load_config(config_file)
+    pipeline.setup_logging(pipeline.log_level, pipeline.log_burst, pipeline.log_interval)
+    pipeline.setup_cluster()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        loop = asyncio.get_running_loop()
+        publisher = AsyncPublisher(loop)
+        app.state.detection = AsyncDetection(publisher, max(pipeline.detection_workers, pipeline.detection_processes))
+        pipeline.register_detection_metrics(app.state.detection.stats)
+        mqtt_task = loop.create_task(start_pipeline(publisher, app.state.detection))
+        try:
+            yield
+        finally:
+            # Stopped before the stores close, so no message is handled after them
+            mqtt_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await mqtt_task
+            pipeline.stop_anomaly_detection()
+            app.state.detection.shutdown()
+            # Saved before the detection processes stop, as they hold the detector models
+            pipeline.close_snapshot()
+            pipeline.stop_detection_pool()
+            pipeline.close_event_store()
+
+    routes = [
+        Route('/', index),
+        Route('/latest_image', frame),
+        Route('/latest_image/{device_id}', frame),
+        Route('/api/frame/{device_id}', frame),
+        Route('/api/latest', latest),
+        Route('/api/history/{device_id}', history),
+        Route('/api/stream', stream),
+        Route('/api/mjpeg/{device_id}', mjpeg),
+        Route('/devices', devices),
+        Route('/api/cluster', cluster_state),
+        Route('/api/alerts', alerts),
+        Route('/stats/detection', detection_stats),
+        Route('/events', events),
+        Route('/events/{event_id}.jpg', event_image),
+        Route('/events/{event_id}.avi', event_clip),
+        Route('/stats/events', event_stats),
+        Route('/stats/images', image_stats),
+        Route('/metrics', metrics),
+        Mount('/static', app=StaticFiles(directory=pipeline.static_image_folder), name='static'),
+    ]
+    return Starlette(routes=routes, lifespan=lifespan)
+
+
+if __name__ == '__main__':
+    # Start the async web application and MQTT client in one event loop
+    uvicorn.run(create_app(), host=pipeline.http_host, port=pipeline.http_port, log_config=None)
@@ -1,11 +1,25 @@
 # Import necessary libraries
-from flask import Flask, render_template
+from flask import Flask, Response, abort, jsonify, redirect, render_template, request, send_file
 import paho.mqtt.client as mqtt
 import os
 import time
-import cv2
-import numpy as np
+import json
+import queue
+import asyncio
+import threading
+from collections import deque, namedtuple
 import datetime
+from urllib.parse import quote
+import hashlib
+import logging
+from capture import CaptureWriter
+from cluster import Cluster
+from event_recorder import EventRecorder
+from metrics import default_size_buckets, registry, setup_logging, stage_seconds
+
+# OpenCV, NumPy and the modules using them (detectors, detection_pool, event_store,
+# image_cache, timeseries) are imported where they are first needed: importing this
+# module stays fast, and the web server answers while they load in the background.
 
 ##################################################
 
@@ -14,19 +28,88 @@ import datetime
 # Create a Flask web application
 app = Flask(__name__)
 
-# MQTT Configuration
+# MQTT Configuration. The client connects in the background and retries with a delay
+# doubling from mqtt_reconnect_delay up to mqtt_reconnect_max_delay seconds.
 mqtt_broker_host = "172.20.10.2"
-mqtt_topics = ["home/cam", "home/data"]
+mqtt_broker_port = 1883
+mqtt_reconnect_delay = 1
+mqtt_reconnect_max_delay = 30
+
+# Devices publish on device-scoped topics such as 'home/cam/<client_id>' and
+# 'home/data/<client_id>'. The bare 'home/cam' and 'home/data' topics are still
+# accepted for older firmware and are mapped to the default device.
+mqtt_topics = ["home/cam/+", "home/data/+", "home/cam", "home/data"]
+default_device_id = "default"
+
+# Clustered mode: give each server of the site a unique cluster_instance name to share
+# the devices between them (see cluster.py). Each camera is told in its control message
+# the topic of the server owning it, the other device topics are consumed through the
+# shared subscription group cluster_group, and cluster_url is the address of this
+# server's web interface, where the other servers send the clients of its devices.
+# None runs a standalone server. Brokers do not send retained messages to shared
+# subscriptions: they are read at startup by a separate client, for retained_read_time
+# seconds.
+cluster_instance = None
+cluster_url = "http://localhost:5001"
+cluster_group = "server"
+retained_read_time = 2.0
+
+# In-memory frame mode: camera payloads are decoded straight from the MQTT bytes
+# and the previous frame is kept decoded, so the disk is only touched when a
+# marked motion image is saved. Set to False to use the legacy file round-trip.
+in_memory_frames = True
+
+# Motion detection runs on a reduced-resolution grayscale frame decoded directly by
+# the JPEG decoder (1, 2, 4 or 8 times smaller), smoothed by a Gaussian blur to
+# remove sensor and JPEG noise. The full-resolution color frame is only decoded
+# when movement is confirmed, to mark and save it.
+detection_scale = 4
+detection_blur_kernel = 5
+
+# Motion detector kept per camera: 'average' (running-average background), 'mog2'
+# (OpenCV MOG2 background subtractor) or 'diff' (difference with the previous
+# frame). Options are passed to the detector class.
+motion_detector = 'average'
+motion_detector_options = {}
+
+# The motion score is the fraction of changed pixels. Motion starts when the score
+# reaches motion_on_score and only stops once it falls to motion_off_score, so
+# flicker around a single threshold does not toggle the alert.
+motion_on_score = 0.01
+motion_off_score = 0.003
+
+# Motion detection runs on a pool of worker threads fed by a bounded queue, so the
+# MQTT network thread only enqueues frames. When the queue is full the oldest
+# frame of the same camera is dropped.
+detection_workers = 2
+detection_queue_size = 8
 
-# Initialize global variables to store the latest data
-latest_image_path = ''
-latest_data = ''
+# Motion detection can also run in separate processes, to use several cores: the worker
+# threads decode the frames into the shared memory slots of the process that keeps the
+# camera's detector and move on, and the result is handled when the process replies.
+# 0 keeps the detection in the worker threads. Each process has detection_slots slots,
+# the most frames it has in flight, and at least one worker thread per process is
+# started. Detection frames larger than detection_slot_bytes are sent through a pipe
+# instead of the shared memory.
+detection_processes = 0
+detection_slots = 4
+detection_slot_bytes = 1600 * 1200
 
-# Flag to detect motion, initially set to False
-detect_mouv = False
+# Logging: minimum level ('DEBUG' shows every message and reading), and at most
+# log_burst records of the same kind per log_interval seconds
+log_level = "INFO"
+log_burst = 5
+log_interval = 60
+
+# Address of the web server
+http_host = "0.0.0.0"
+http_port = 5001
+
+logger = logging.getLogger("server_pub")
 
 ##################################################
 
+
 def get_current_script_directory():
     """
     Get the directory path of the currently running script.
@@ -39,13 +122,117 @@ def get_current_script_directory():
     script_directory = os.path.dirname(script_path)
     return script_directory
 
-# Directories for saving received images and data
+# Directories for saving received images and data. Unless it is set too, load_config()
+# moves output_folder into a configured static_image_folder.
 static_image_folder = get_current_script_directory() + "/static"
 image_filename = "received_image.png"
 output_folder = static_image_folder+'/MONITORING/'
 
+# Motion events are indexed in a SQLite database in the output folder. Their files
+# are written by a background thread and the oldest ones are evicted once they
+# exceed the disk budget. event_queue_size is the number of frames waiting to be written.
+event_store_max_bytes = 1024 ** 3
+event_queue_size = 64
+
+# A motion event is recorded as one video clip: the frames from event_pre_roll seconds
+# before the motion to event_post_roll seconds after it. Longer events are split every
+# event_clip_max_seconds. event_clip_fourcc is the codec of the AVI files: 'MJPG' works
+# with every OpenCV build, 'XVID' gives much smaller files where it is available.
+event_pre_roll = 2.0
+event_post_roll = 3.0
+event_clip_max_seconds = 120
+event_clip_fourcc = "MJPG"
+
+# Smaller variants of the camera frames and event images, served with '?size=thumb' or
+# '?size=medium' (widths in pixels). They are generated on demand and kept in a cache of
+# image_cache_max_bytes in memory. Variants evicted from memory are written to
+# image_cache_folder, within image_cache_folder_max_bytes, or dropped when it is None.
+image_variants = {'thumb': 160, 'medium': 640}
+image_variant_quality = 80
+image_cache_max_bytes = 32 * 1024 ** 2
+image_cache_folder = None
+image_cache_folder_max_bytes = 256 * 1024 ** 2
+
+# History of the sensor readings, one append-only sample file per device
+timeseries_folder = get_current_script_directory() + "/timeseries"
+
+# Optional recording of every incoming MQTT message (reception time, topic, payload) to an
+# append-only capture file, which 'python -m benchmark.replay' feeds back through the
+# handlers. None disables the recording.
+capture_file = None
+
+# Periodic snapshot of the state of the devices (latest reading and frame, motion flag and
+# background model of the motion detectors), reloaded at startup so the dashboard and the
+# detection resume where they stopped. Models older than snapshot_max_age seconds are not
+# restored, as the scene may have changed. None disables the snapshots.
+snapshot_file = get_current_script_directory() + "/state/snapshot.npz"
+snapshot_interval = 60
+snapshot_max_age = 3600
+
+# Streaming anomaly detection on the sensor readings. Each device and metric has an
+# exponentially weighted mean and variance (weight anomaly_alpha) and a rate of change.
+# An alert is published on anomaly_topic/<device_id> when a reading leaves the valid
+# range of the sensor, is more than anomaly_band standard deviations from the mean (after
+# anomaly_warmup readings), or changes faster than its limit per minute, and when a device
+# sends nothing for anomaly_silence_timeout seconds. None in anomaly_ranges and
+# anomaly_max_rates uses the BME280 defaults of the anomaly module. Readings are processed
+# in batches every anomaly_interval seconds.
+anomaly_detection = True
+anomaly_topic = "home/alerts"
+anomaly_alpha = 0.05
+anomaly_band = 4.0
+anomaly_warmup = 20
+anomaly_ranges = None
+anomaly_max_rates = None
+anomaly_silence_timeout = 300
+anomaly_interval = 1.0
+
+# Capture rate control: each camera is told on capture_control_topic/<device_id> (retained,
+# so it gets it again on reconnection) its capture interval in seconds and JPEG quality
+# (10 is the best, 63 the worst, as for the ESP32-CAM driver). The step used is the last one
+# whose 'after' is at most the seconds since the last motion of the camera: fast while
+# something moves, then slower as the scene stays still. A camera without motion yet uses
+# the last step. A step may also set the resolution with 'framesize', the name of an
+# ESP32-CAM frame size (e.g. 'VGA'); the camera changes it without restarting its sensor.
+capture_rate_control = True
+capture_control_topic = "home/control"
+capture_rate_steps = [
+    {'after': 0, 'interval': 1.0, 'quality': 12},
+    {'after': 60, 'interval': 5.0, 'quality': 15},
+    {'after': 600, 'interval': 30.0, 'quality': 20},
+]
+
+# Settings that load_config() reads from the configuration file and the environment
+config_settings = (
+    'mqtt_broker_host', 'mqtt_broker_port', 'mqtt_reconnect_delay', 'mqtt_reconnect_max_delay', 'mqtt_topics',
+    'default_device_id', 'cluster_instance', 'cluster_url', 'cluster_group', 'retained_read_time',
+    'in_memory_frames',
+    'detection_scale', 'detection_blur_kernel', 'motion_detector', 'motion_detector_options',
+    'motion_on_score', 'motion_off_score', 'detection_workers', 'detection_queue_size',
+    'detection_processes', 'detection_slots', 'detection_slot_bytes', 'log_level', 'log_burst', 'log_interval',
+    'http_host', 'http_port', 'static_image_folder', 'output_folder', 'event_store_max_bytes',
+    'event_queue_size', 'event_pre_roll', 'event_post_roll', 'event_clip_max_seconds', 'event_clip_fourcc',
+    'image_variants', 'image_variant_quality', 'image_cache_max_bytes', 'image_cache_folder',
+    'image_cache_folder_max_bytes', 'timeseries_folder', 'capture_file', 'snapshot_file', 'snapshot_interval',
+    'snapshot_max_age', 'anomaly_detection', 'anomaly_topic', 'anomaly_alpha', 'anomaly_band', 'anomaly_warmup',
+    'anomaly_ranges', 'anomaly_max_rates', 'anomaly_silence_timeout', 'anomaly_interval', 'capture_rate_control',
+    'capture_control_topic', 'capture_rate_steps', 'stream_keepalive',
+)
+
+# Settings disabled by None, although their default is set
+nullable_settings = ('snapshot_file',)
+
+# Environment variables overriding the settings are named with this prefix and the name
+# of the setting in upper case, e.g. SERVER_PUB_MQTT_BROKER_HOST. SERVER_PUB_CONFIG names
+# the configuration file.
+config_env_prefix = "SERVER_PUB_"
+
+# Seconds a request needing the stores waits for them at startup before getting a 503
+startup_wait = 5
+
 ##################################################
 
+
 def detect_movement(image1_path, image2_path, threshold=30):
     """
     Detects movement between two images with resizing to match their sizes.
@@ -55,6 +242,8 @@ def detect_movement(image1_path, image2_path, threshold=30):
     :param threshold: Threshold value to determine movement. Default is 30.
     :return: True if movement is detected, False otherwise.
     """
+    import cv2
+    import numpy as np
 
     # Load the images from the provided file paths
     img1 = cv2.imread(image1_path, cv2.IMREAD_GRAYSCALE)
@@ -64,11 +253,12 @@ def detect_movement(image1_path, image2_path, threshold=30):
     if img1 is None or img2 is None:
         raise ValueError("One or both images could not be loaded. Check the file paths.")
 
-    # Resize img2 to match img1's size
-    img2_resized = cv2.resize(img2, (img1.shape[1], img1.shape[0]))
+    # Resize img2 to match img1's size, only when they differ
+    if img2.shape != img1.shape:
+        img2 = cv2.resize(img2, (img1.shape[1], img1.shape[0]))
 
     # Compute the absolute difference between the two grayscale images
-    diff = cv2.absdiff(img1, img2_resized)
+    diff = cv2.absdiff(img1, img2)
 
     # Threshold the difference image to create a binary image
     _, thresh = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
@@ -79,21 +269,118 @@ def detect_movement(image1_path, image2_path, threshold=30):
     return movement_detected
 
 
-def detect_and_mark_movement(image1_path, image2_path, output_folder, threshold=30):
+# Names of the JPEG decoder flags producing a grayscale image reduced by the given factor
+reduced_grayscale_flags = {
+    1: 'IMREAD_GRAYSCALE',
+    2: 'IMREAD_REDUCED_GRAYSCALE_2',
+    4: 'IMREAD_REDUCED_GRAYSCALE_4',
+    8: 'IMREAD_REDUCED_GRAYSCALE_8',
+}
+
+
+def decode_frame(payload, flags=None):
+    """
+    Decodes a JPEG payload received over MQTT, directly from memory.
+
+    :param payload: Raw bytes of the encoded image.
+    :param flags: OpenCV imread flags. Default is a full-resolution color image.
+    :return: Decoded image.
+    """
+    import cv2
+    import numpy as np
+    if flags is None:
+        flags = cv2.IMREAD_COLOR
+
+    # Decode the image directly from memory, without going through a file
+    buffer = np.frombuffer(payload, dtype=np.uint8)
+    img = cv2.imdecode(buffer, flags)
+
+    # Check if the image is decoded successfully, if not, raise an exception
+    if img is None:
+        raise ValueError("The payload could not be decoded as an image.")
+
+    return img
+
+
+def decode_detection_frame(payload, scale=4, blur_kernel=5):
+    """
+    Decodes a payload into the small, smoothed grayscale frame used for motion detection.
+
+    The JPEG decoder skips the detail that is not needed for a reduced image, so this is
+    much cheaper than decoding in full resolution and resizing.
+
+    :param payload: Raw bytes of the encoded image.
+    :param scale: Reduction factor, one of 1, 2, 4 or 8. Default is 4.
+    :param blur_kernel: Size of the Gaussian blur kernel (odd), 0 to disable. Default is 5.
+    :return: Grayscale detection frame.
+    """
+    import cv2
+    if scale not in reduced_grayscale_flags:
+        raise ValueError(f"Unsupported detection scale {scale}, use one of 1, 2, 4 or 8.")
+
+    gray = decode_frame(payload, getattr(cv2, reduced_grayscale_flags[scale]))
+    if blur_kernel:
+        gray = cv2.GaussianBlur(gray, (blur_kernel, blur_kernel), 0)
+    return gray
+
+
+def payload_hash(payload):
+    """
+    Computes a short digest of a payload, used to skip frames identical to the previous one.
+
+    :param payload: Raw bytes of the message.
+    :return: Digest bytes.
+    """
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def find_movement(gray1, gray2, threshold=30):
+    """
+    Finds the areas that changed between two grayscale frames of the same size.
+
+    :param gray1: Grayscale version of the first frame.
+    :param gray2: Grayscale version of the second frame.
+    :param threshold: Threshold value to determine movement. Default is 30.
+    :return: MotionResult (fraction of changed pixels, bounding boxes (x, y, w, h) of the
+             areas of movement).
+    """
+    import cv2
+    from detectors import MotionResult, mask_to_boxes
+
+    # Frames of different sizes (e.g. after a camera resolution change) cannot be compared
+    if gray1.shape != gray2.shape:
+        return MotionResult(0.0, [])
+
+    with stage_seconds.time(stage="diff"):
+        # Compute the absolute difference between the two grayscale images
+        diff = cv2.absdiff(gray1, gray2)
+
+        # Threshold the difference image to create a binary image
+        _, thresh = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
+
+    with stage_seconds.time(stage="contour"):
+        return MotionResult(cv2.countNonZero(thresh) / thresh.size, mask_to_boxes(thresh))
+
+
+def detect_and_mark_movement(image1_path, image2_path, store=None, camera=None, threshold=30):
     """
     Detects movement between two images, highlights the areas of movement with a red rectangle,
-    and optionally saves the marked image.
+    and optionally records the marked image as a motion event.
 
     :param image1_path: Path to the first image.
     :param image2_path: Path to the second image.
+    :param store: EventStore recording the marked image, None to only detect.
+    :param camera: Identifier of the camera, stored with the event.
     :param threshold: Threshold value to determine movement. Default is 30.
-    :param output_folder: Folder to save the marked image.
     :return: True if movement is detected, False otherwise.
     """
+    import cv2
+    from detectors import draw_movement
 
     # Load the images from the provided file paths
-    img1 = cv2.imread(image1_path)
-    img2 = cv2.imread(image2_path)
+    with stage_seconds.time(stage="decode"):
+        img1 = cv2.imread(image1_path)
+        img2 = cv2.imread(image2_path)
 
     # Check if images are loaded successfully, if not, raise an exception
     if img1 is None or img2 is None:
@@ -103,138 +390,2041 @@ def detect_and_mark_movement(image1_path, image2_path, output_folder, threshold=
     gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
     gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
 
-    # Compute the absolute difference between the two grayscale images
-    diff = cv2.absdiff(gray1, gray2)
+    # Draw red rectangles around areas of movement
+    score, boxes = find_movement(gray1, gray2, threshold)
+    draw_movement(img2, boxes)
 
-    # Threshold the difference image to create a binary image
-    _, thresh = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
+    # Check for movement by counting the number of detected areas
+    movement_detected = len(boxes) > 0
 
-    # Find contours in the binary image
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Queue the marked image in the event store (encoded and indexed by its writer thread)
+    if store is not None and movement_detected:
+        store.add(camera, img2, score, boxes, time.time())
 
-    # Draw red rectangles around areas of movement
-    for contour in contours:
-        (x, y, w, h) = cv2.boundingRect(contour)
-        cv2.rectangle(img2, (x, y), (x + w, y + h), (0, 0, 255), 2)
+    return movement_detected
+
+##################################################
 
-    # Check for movement by counting the number of detected contours
-    movement_detected = len(contours) > 0
+# Latest frame of a camera: raw bytes, digest of the payload and reception time
+Frame = namedtuple('Frame', ['data', 'digest', 'timestamp'])
 
-    # Save the marked image if a folder is provided
-    if output_folder is not None and movement_detected:
-        # Create the folder if it doesn't exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
 
-        # Generate a timestamp
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+def create_detector(device_id=None):
+    """
+    Creates a motion detector for a new camera, according to the settings.
 
-        # Construct the file path
-        output_path = os.path.join(output_folder, f"monitor_image_{timestamp}.jpg")
+    :param device_id: Identifier of the camera, needed to run its detector in the detection pool.
+    :return: MotionDetector instance, or RemoteDetector when the detection pool is running.
+    """
+    from detectors import motion_detectors
+    if detection_pool is not None and device_id is not None:
+        return detection_pool.detector(device_id)
+    return motion_detectors[motion_detector](**motion_detector_options)
 
-        # Save the image
-        cv2.imwrite(output_path, img2)
-    
-    return movement_detected
+
+def apply_hysteresis(active, score):
+    """
+    Decides whether motion is going on, with separate start and stop thresholds.
+
+    :param active: Whether motion was going on at the previous frame.
+    :param score: Motion score of the current frame.
+    :return: True if motion is going on, False otherwise.
+    """
+    if active:
+        return score > motion_off_score
+    return score >= motion_on_score
 
 ##################################################
 
-# Callback for when a PUBLISH message is received from the server.
-def on_message(client, userdata, message):
+
+class DeviceState:
+    """
+    State kept by the server for each device (camera or sensor board).
     """
-    Callback for handling PUBLISH messages received from the server.
 
-    This function is called when a PUBLISH message is received from the MQTT server. 
-    It processes two types of messages related to camera and data topics separately.
-    
-    For camera-related messages:
+    def __init__(self, device_id):
+        """
+        Initializes the state of a device.
+
+        :param device_id: Identifier of the device, taken from its MQTT topic.
+        """
+        self.device_id = device_id
+
+        # Camera state: motion detector holding the background model, latest frame and
+        # path of the latest image in legacy disk mode
+        self.detector = None
+        self.motion_score = 0.0
+        self.latest_frame = None
+        self.latest_image_path = ''
+
+        # Latest sensor reading and motion flag
+        self.latest_data = {}
+        self.detect_mouv = False
+        self.last_seen = None
+
+        # Capture rate control: time of the last motion, and step and direct topic (in
+        # clustered mode) last sent to the camera
+        self.last_motion = None
+        self.capture_step = None
+        self.direct_topic = None
+
+        # Topics of the camera and topics used to reply to the device, the bare topics for
+        # older firmware
+        if device_id == default_device_id:
+            self.cam_topic = "home/cam"
+            self.monitoring_topic = "home/monitoring"
+            self.control_topic = capture_control_topic
+        else:
+            self.cam_topic = f"home/cam/{device_id}"
+            self.monitoring_topic = f"home/monitoring/{device_id}"
+            self.control_topic = f"{capture_control_topic}/{device_id}"
+
+    def image_filename(self):
+        """
+        Name of the latest image file in legacy disk mode.
+
+        :return: File name in the static folder.
+        """
+        if self.device_id == default_device_id:
+            return image_filename
+        return f"received_image_{self.device_id}.png"
+
+    def snapshot(self):
+        """
+        Returns the state of the device saved in the snapshots.
+
+        :return: Dictionary of the state.
+        """
+        frame = self.latest_frame
+        model = None
+        if self.detector is not None:
+            try:
+                model = self.detector.get_state()
+            except RuntimeError as e:
+                logger.warning("Could not save the motion detector of %s: %s", self.device_id, e)
+        return {
+            'latest_data': self.latest_data,
+            'last_seen': self.last_seen,
+            'detect_mouv': self.detect_mouv,
+            'motion_score': self.motion_score,
+            'last_motion': self.last_motion,
+            'frame': {'data': frame.data, 'digest': frame.digest.hex(), 'timestamp': frame.timestamp}
+            if frame is not None else None,
+            'motion_detector': motion_detector,
+            'detector': model,
+        }
+
+    def restore(self, saved, age):
+        """
+        Restores the state of the device from a snapshot. The model of the motion detector
+        is only restored if the snapshot is recent and was taken with the same detector.
+
+        :param saved: Dictionary of the state, returned by snapshot().
+        :param age: Age of the snapshot, in seconds.
+        """
+        self.latest_data = saved['latest_data']
+        self.last_seen = saved['last_seen']
+        self.last_motion = saved.get('last_motion')
+        frame = saved['frame']
+        if frame is not None:
+            self.latest_frame = Frame(frame['data'], bytes.fromhex(frame['digest']), frame['timestamp'])
+
+        if saved['detector'] is None or saved['motion_detector'] != motion_detector or age > snapshot_max_age:
+            return
+        self.detector = create_detector(self.device_id)
+        self.detector.set_state(saved['detector'])
+        self.detect_mouv = saved['detect_mouv']
+        self.motion_score = saved['motion_score']
+
+
+# State of every known device, indexed by device ID
+devices = {}
+devices_lock = threading.Lock()
+
+
+def get_device(device_id):
+    """
+    Returns the state of a device, creating it on its first message.
+
+    :param device_id: Identifier of the device.
+    :return: DeviceState of the device.
+    """
+    state = devices.get(device_id)
+    if state is None:
+        with devices_lock:
+            state = devices.setdefault(device_id, DeviceState(device_id))
+    return state
+
+
+def collect_state():
+    """
+    Collects the state of every device for a snapshot.
+
+    :return: Dictionary of the state of each device, by device ID.
+    """
+    with devices_lock:
+        states = list(devices.values())
+    return {state.device_id: state.snapshot() for state in states}
+
+
+def find_device(device_id, attribute):
+    """
+    Looks up a device for the web page: the requested one, or else the first device
+    that has a value for the given attribute.
+
+    :param device_id: Requested device ID, or None.
+    :param attribute: Attribute that the device must have set (e.g. 'latest_data').
+    :return: DeviceState, or None if no device matches.
+    """
+    if device_id is not None:
+        return devices.get(device_id)
+    for state in list(devices.values()):
+        if getattr(state, attribute):
+            return state
+    return None
+
+##################################################
+
+
+class Broadcaster:
+    """
+    Fans out change notifications (new readings, motion changes, new frames) to the web
+    clients connected to the push endpoints.
+
+    Each subscriber has its own bounded queue. A client that does not keep up loses its
+    oldest notifications instead of slowing down the MQTT or detection threads.
+    """
+
+    def __init__(self, max_pending=32):
+        """
+        Initializes the broadcaster.
+
+        :param max_pending: Maximum number of notifications waiting for a subscriber.
+        """
+        self.max_pending = max_pending
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, kinds=None):
+        """
+        Registers a subscriber reading its notifications from a thread.
+
+        :param kinds: Set of notification kinds to receive, all of them if None.
+        :return: Queue receiving (kind, data) tuples.
+        """
+        subscriber = queue.Queue(maxsize=self.max_pending)
+        with self.lock:
+            self.subscribers[subscriber] = (kinds, None)
+        return subscriber
+
+    def subscribe_async(self, kinds=None):
+        """
+        Registers a subscriber reading its notifications from the running asyncio event loop.
+
+        :param kinds: Set of notification kinds to receive, all of them if None.
+        :return: asyncio.Queue receiving (kind, data) tuples.
+        """
+        subscriber = asyncio.Queue(maxsize=self.max_pending)
+        with self.lock:
+            self.subscribers[subscriber] = (kinds, asyncio.get_running_loop())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Removes a subscriber.
+
+        :param subscriber: Queue returned by subscribe() or subscribe_async().
+        """
+        with self.lock:
+            self.subscribers.pop(subscriber, None)
+
+    def publish(self, kind, data):
+        """
+        Sends a notification to the interested subscribers. Never blocks, and can be called
+        from any thread.
+
+        :param kind: Kind of notification, e.g. 'reading', 'motion' or 'frame'.
+        :param data: JSON-serializable data of the notification.
+        """
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for subscriber, (kinds, loop) in subscribers:
+            if kinds is not None and kind not in kinds:
+                continue
+            if loop is None:
+                self._offer(subscriber, (kind, data))
+            else:
+                # asyncio queues may only be used from their event loop
+                try:
+                    loop.call_soon_threadsafe(self._offer, subscriber, (kind, data))
+                except RuntimeError:
+                    # The event loop was closed without unsubscribing
+                    self.unsubscribe(subscriber)
+
+    @staticmethod
+    def _offer(subscriber, item):
+        """
+        Puts a notification in a subscriber queue, dropping its oldest one if it is full.
+        """
+        try:
+            subscriber.put_nowait(item)
+        except (queue.Full, asyncio.QueueFull):
+            try:
+                subscriber.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                pass
+            try:
+                subscriber.put_nowait(item)
+            except (queue.Full, asyncio.QueueFull):
+                pass
+
+
+# Notifications of the push endpoints (Server-Sent Events and MJPEG streams)
+broadcaster = Broadcaster()
+
+##################################################
+
+
+class DetectionDispatcher:
+    """
+    Hands camera frames from the MQTT callback to a pool of detection worker threads.
+
+    Frames wait in a bounded queue. When the queue is full, the oldest frame of the same
+    camera is dropped (or the oldest frame overall if that camera has nothing queued).
+    A camera is processed by at most one worker at a time, so its frames stay in order.
+    """
+
+    def __init__(self, handler, num_workers=2, max_queue_size=8):
+        """
+        Initializes the dispatcher.
+
+        :param handler: Function called as handler(camera_id, payload) by the workers.
+        :param num_workers: Number of detection worker threads.
+        :param max_queue_size: Maximum number of frames waiting in the queue.
+        """
+        self.handler = handler
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.queue = deque()
+        self.busy_cameras = set()
+        self.dropped = {}
+        self.processed = 0
+        self.condition = threading.Condition()
+        self.threads = []
+        self.running = False
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        self.running = True
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._worker, name=f"detection-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the worker threads once they have finished their current frame.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, camera_id, payload):
+        """
+        Queues a frame for detection. Called from the MQTT network thread, never blocks.
+
+        :param camera_id: Identifier of the camera that sent the frame.
+        :param payload: Raw bytes of the frame.
+        :return: True if a queued frame had to be dropped to make room, False otherwise.
+        """
+        dropped = False
+        with self.condition:
+            if len(self.queue) >= self.max_queue_size:
+                self._drop_oldest(camera_id)
+                dropped = True
+            self.queue.append((camera_id, payload))
+            self.condition.notify()
+        return dropped
+
+    def _drop_oldest(self, camera_id):
+        """
+        Removes the oldest queued frame of a camera, or the oldest frame overall.
+        Must be called with the condition held.
+
+        :param camera_id: Camera whose oldest frame should be dropped first.
+        """
+        for index, (queued_id, _) in enumerate(self.queue):
+            if queued_id == camera_id:
+                del self.queue[index]
+                break
+        else:
+            queued_id, _ = self.queue.popleft()
+        self.dropped[queued_id] = self.dropped.get(queued_id, 0) + 1
+
+    def _next_frame(self):
+        """
+        Takes the oldest queued frame whose camera is not being processed by another worker.
+        Must be called with the condition held.
+
+        :return: Tuple (camera_id, payload), or None if no frame can be taken.
+        """
+        for index, (camera_id, payload) in enumerate(self.queue):
+            if camera_id not in self.busy_cameras:
+                del self.queue[index]
+                self.busy_cameras.add(camera_id)
+                return camera_id, payload
+        return None
+
+    def _worker(self):
+        """
+        Worker loop: takes frames from the queue and runs the handler on them.
+        """
+        while True:
+            with self.condition:
+                item = self._next_frame()
+                while item is None and self.running:
+                    self.condition.wait()
+                    item = self._next_frame()
+                if item is None:
+                    return
+
+            camera_id, payload = item
+            try:
+                self.handler(camera_id, payload)
+            except Exception:
+                logger.exception("Error while processing frame from %s", camera_id)
+            finally:
+                with self.condition:
+                    self.busy_cameras.discard(camera_id)
+                    self.processed += 1
+                    # Frames of this camera may have been waiting for it to be released
+                    self.condition.notify_all()
+
+    def stats(self):
+        """
+        Returns the current queue depth and drop counters.
+
+        :return: Dictionary with the queue depth, processed frames and dropped frames per camera.
+        """
+        with self.condition:
+            return {
+                'queue_depth': len(self.queue),
+                'max_queue_size': self.max_queue_size,
+                'workers': self.num_workers,
+                'processed': self.processed,
+                'dropped': dict(self.dropped),
+                'dropped_total': sum(self.dropped.values()),
+            }
+
+##################################################
+
+
+def process_frame_in_memory(client, state, payload):
+    """
+    Handles a camera frame without touching the disk.
+
+    A payload identical to the previous one (e.g. a retransmission) is skipped without
+    changing the state of the camera: it is not a new observation of the scene, so the
+    motion flag and score, the capture rate and the event recorder keep following the
+    previous frame.
+
+    Otherwise a reduced grayscale frame is decoded from memory and fed to the camera's
+    motion detector. The frame is then passed to the event recorder, which keeps it for the
+    pre-roll or adds it to the motion clip; the full-resolution frame is only decoded by
+    the writer of the clip.
+
+    :param client: The MQTT client instance.
+    :param state: DeviceState of the camera.
+    :param payload: Raw bytes of the received image.
+    :return: Future of the detection when it runs in the detection pool, None otherwise.
+    """
+
+    # Identical payload (e.g. a retransmission): already handled
+    digest = payload_hash(payload)
+    if state.latest_frame is not None and digest == state.latest_frame.digest:
+        return
+
+    try:
+        with stage_seconds.time(stage="decode"):
+            gray = decode_detection_frame(payload, detection_scale, detection_blur_kernel)
+    except ValueError as e:
+        logger.warning("Invalid camera frame from %s: %s", state.device_id, e)
+        return
+
+    # Keep the raw bytes so the web page can serve the latest image from memory
+    state.latest_frame = Frame(bytes(payload), digest, time.time())
+    broadcaster.publish('frame', {'device_id': state.device_id, 'timestamp': state.latest_frame.timestamp})
+
+    # Update the camera's background model, which needs a few frames to warm up
+    if state.detector is None:
+        state.detector = create_detector(state.device_id)
+    frame = state.latest_frame
+    submit = getattr(state.detector, 'submit', None)
+    if submit is not None:
+        # Detection in the pool: the result is handled when the process replies, while
+        # this worker thread moves on to the next frame
+        pending = submit(gray)
+        pending.add_done_callback(lambda done: finish_pool_detection(client, state, frame, gray.shape, done))
+        return pending
+    result = state.detector.update(gray)
+    apply_motion_result(client, state, frame, gray.shape, result, state.detector.timings)
+
+
+def apply_motion_result(client, state, frame, shape, result, timings):
+    """
+    Applies the motion result of a frame: hysteresis, motion clip and monitoring status.
+
+    :param client: The MQTT client instance.
+    :param state: DeviceState of the camera.
+    :param frame: Frame the result was computed on.
+    :param shape: Shape of the detection frame.
+    :param result: MotionResult, or None while the model is warming up.
+    :param timings: Seconds spent in each detection stage.
+    :return: None
+    """
+    for stage, seconds in timings.items():
+        stage_seconds.observe(seconds, stage=stage)
+    if result is None:
+        return
+
+    state.motion_score = result.score
+    movement_detected = apply_hysteresis(state.detect_mouv, result.score)
+
+    # Motion frames go to a clip, with the frames around them
+    if event_recorder is not None:
+        event_recorder.update(state.device_id, frame.data, frame.timestamp, movement_detected, result.score,
+                              result.boxes, shape)
+
+    publish_movement_status(client, state, movement_detected)
+
+
+def finish_pool_detection(client, state, frame, shape, pending):
+    """
+    Handles the reply of the detection pool for a frame. Called in the collector thread of
+    the camera's process, in the order of the frames.
+
+    :param client: The MQTT client instance.
+    :param state: DeviceState of the camera.
+    :param frame: Frame sent to the pool.
+    :param shape: Shape of the detection frame.
+    :param pending: Completed future returned by DetectionPool.submit().
+    :return: None
+    """
+    try:
+        result, timings = pending.result()
+        apply_motion_result(client, state, frame, shape, result, timings)
+    except Exception:
+        logger.exception("Error while processing frame from %s", state.device_id)
+
+
+def reading_event(state):
+    """
+    Builds the push notification of a device's latest reading.
+
+    :param state: DeviceState of the sensor board.
+    :return: Dictionary of the notification.
+    """
+    return {'device_id': state.device_id, 'data': state.latest_data, 'timestamp': state.last_seen}
+
+
+def motion_event(state):
+    """
+    Builds the push notification of a camera's motion flag.
+
+    :param state: DeviceState of the camera.
+    :return: Dictionary of the notification.
+    """
+    return {'device_id': state.device_id, 'mouv': state.detect_mouv, 'motion_score': state.motion_score}
+
+
+def publish_movement_status(client, state, movement_detected):
+    """
+    Updates the motion flag of a camera and publishes its monitoring status when it changes.
+    The capture rate of the camera follows its motion.
+
+    :param client: The MQTT client instance.
+    :param state: DeviceState of the camera.
+    :param movement_detected: Result of the motion detection.
+    :return: None
+    """
+
+    if movement_detected:
+        state.last_motion = time.time()
+    if capture_rate_control or cluster is not None:
+        update_capture_rate(client, state)
+    if movement_detected == state.detect_mouv:
+        return
+
+    state.detect_mouv = movement_detected
+    broadcaster.publish('motion', motion_event(state))
+    if movement_detected:
+        logger.info("Movement detected between the images of %s", state.device_id)
+        motion_events_total.inc(device=state.device_id)
+    else:
+        logger.info("No significant movement detected for %s", state.device_id)
+    with stage_seconds.time(stage="publish"):
+        client.publish(state.monitoring_topic, "ON" if movement_detected else "OFF")
+
+
+def capture_step(state, now):
+    """
+    Chooses the capture rate step of a camera from the time since its last motion.
+
+    :param state: DeviceState of the camera.
+    :param now: Current time (seconds since the epoch).
+    :return: Index of the step in capture_rate_steps.
+    """
+    if state.last_motion is None:
+        return len(capture_rate_steps) - 1
+    still = now - state.last_motion
+    step = 0
+    for index, candidate in enumerate(capture_rate_steps):
+        if candidate['after'] <= still:
+            step = index
+    return step
+
+
+def update_capture_rate(client, state):
+    """
+    Sends a camera its capture interval and JPEG quality when its step changes. Called on
+    every processed frame: a camera slows down at its first frame after the delay of the
+    next step, and speeds up as soon as motion is detected. In clustered mode, the control
+    message also holds the direct topic of this instance, on which the camera then
+    publishes its frames.
+
+    :param client: The MQTT client instance.
+    :param state: DeviceState of the camera.
+    :return: None
+    """
+    step = capture_step(state, time.time()) if capture_rate_control else None
+    direct_topic = cluster.direct_topic(state.cam_topic) if cluster is not None else None
+    if step == state.capture_step and direct_topic == state.direct_topic:
+        return
+    state.capture_step = step
+    state.direct_topic = direct_topic
+    control = {}
+    if step is not None:
+        settings = capture_rate_steps[step]
+        logger.info("Capture interval of %s set to %s s (quality %s)", state.device_id, settings['interval'],
+                    settings['quality'])
+        control = {'interval': settings['interval'], 'quality': settings['quality']}
+        if settings.get('framesize'):
+            control['framesize'] = settings['framesize']
+    if direct_topic is not None:
+        control['topic'] = direct_topic
+    client.publish(state.control_topic, json.dumps(control), retain=True)
+
+
+def process_frame_on_disk(client, state, payload):
+    """
+    Handles a camera frame through files in the static folder (legacy mode).
+
     - Saves a received image.
     - Compares it with the previous image to detect movement.
     - Publishes a status message based on the movement detection result.
     - Manages image files by renaming and deleting old images.
-    
-    For data-related messages:
-    - Decodes and stores received data.
-    
+
     :param client: The MQTT client instance.
-    :param userdata: User-specific data passed to the MQTT client.
-    :param message: The received MQTT message.
+    :param state: DeviceState of the camera.
+    :param payload: Raw bytes of the received image.
     :return: None
     """
-        
-    global latest_image_path, latest_data, detect_mouv
 
-    # Check if the received message is related to the camera topic
-    if message.topic == "home/cam":
-        new_image_path = os.path.join(static_image_folder, "new_image.jpg")
-        latest_image_path = os.path.join(static_image_folder, image_filename)
-        
-        # Save the newly received image
-        print(message.payload)
+    new_image_path = os.path.join(static_image_folder, f"new_image_{state.device_id}.jpg")
+    latest_image_path = os.path.join(static_image_folder, state.image_filename())
+    state.latest_image_path = latest_image_path
+
+    # Save the newly received image
+    with stage_seconds.time(stage="save"):
         with open(new_image_path, 'wb') as image_file:
-            image_file.write(message.payload)
-        print("New image temporarily saved")
-
-        # Compare it with the old image if it exists
-        if latest_image_path and os.path.exists(latest_image_path):
-            movement_detected = detect_and_mark_movement(latest_image_path, new_image_path, output_folder)
-            if movement_detected:
-                detect_mouv = True
-                print("Movement detected between the images")
-                client.publish("home/monitoring", "ON")
-            else:
-                detect_mouv = False
-                print("No significant movement detected")
-                client.publish("home/monitoring", "OFF")
+            image_file.write(payload)
+    logger.debug("New image of %s temporarily saved (%d bytes)", state.device_id, len(payload))
 
-            print(detect_mouv)
+    # Compare it with the old image if it exists
+    if latest_image_path and os.path.exists(latest_image_path):
+        movement_detected = detect_and_mark_movement(latest_image_path, new_image_path, event_store,
+                                                     state.device_id)
+        publish_movement_status(client, state, movement_detected)
 
-            # Remove the old image
-            os.remove(latest_image_path)
-            print(f"Old image removed: {latest_image_path}")
+        # Remove the old image
+        os.remove(latest_image_path)
+        logger.debug("Old image removed: %s", latest_image_path)
 
-        # Rename the new image with the name of the old one
-        # Check if the file exists before renaming
-        if os.path.exists(new_image_path):
-            try:
-                os.rename(new_image_path, latest_image_path)
-            except Exception as e:
-                print(f"Error while renaming file: {e}")
-            print(f"New image renamed: {latest_image_path}")
-
-    # Check if the received message is related to the data topic
-    elif message.topic == "home/data":
-        print("Received data")
-        data_str = message.payload.decode("utf-8")
-        data_parts = data_str.split(';')
-        data_dict = {p.split('=')[0].strip(): p.split('=')[1].strip() for p in data_parts}
-        latest_data = data_dict
-        print(f"Data received on 'home/data': {latest_data}")  # Add this line to display received data
+    # Rename the new image with the name of the old one
+    # Check if the file exists before renaming
+    if os.path.exists(new_image_path):
+        try:
+            os.rename(new_image_path, latest_image_path)
+        except Exception as e:
+            logger.error("Error while renaming file: %s", e)
+            return
+        logger.debug("New image renamed: %s", latest_image_path)
 
-##################################################
-        
-# Setup MQTT Client
-client = mqtt.Client()
-client.on_message = on_message
-client.connect(mqtt_broker_host, 1883, 60)
-for topic in mqtt_topics:
-    client.subscribe(topic)
+        # The dashboards reload the image file from its URL
+        broadcaster.publish('frame', {'device_id': state.device_id, 'timestamp': time.time(),
+                                      'image': f"/static/{quote(state.image_filename())}"})
 
-# Run the MQTT client in a separate thread
-client.loop_start()
 
-@app.route('/')
-def index():
+def handle_cam_message(device_id, payload):
     """
-    Flask route for the web application's main page.
+    Handles a message on a camera topic by queuing the frame for detection.
 
-    This route renders an HTML template with the latest image, data, and motion detection status.
+    :param device_id: Identifier of the camera.
+    :param payload: Raw bytes of the received image.
+    :return: None
+    """
+    # Only queue the frame here: detection runs on the dispatcher's worker threads
+    get_device(device_id).last_seen = time.time()
+    dispatcher.submit(device_id, payload)
 
-    :return: Rendered HTML template.
+
+def parse_reading(payload):
     """
-    # Render template with the latest image and data
-    return render_template('indexFinal.html', image_path=latest_image_path, data=latest_data, mouv=detect_mouv)
+    Decodes a sensor reading.
+
+    :param payload: Raw bytes of the message, e.g. b"T = 21.5 ; H = 40.2 ; P = 1013.1".
+    :return: Dictionary of the values, as strings, by metric name.
+    """
+    data_str = payload.decode("utf-8")
+    data_parts = data_str.split(';')
+    return {p.split('=')[0].strip(): p.split('=')[1].strip() for p in data_parts}
+
+
+def handle_data_message(device_id, payload):
+    """
+    Handles a message on a data topic by decoding and storing the sensor reading.
+
+    :param device_id: Identifier of the sensor board.
+    :param payload: Raw bytes of the message, e.g. b"T = 21.5 ; H = 40.2 ; P = 1013.1".
+    :return: None
+    """
+    state = get_device(device_id)
+    data_dict = parse_reading(payload)
+    changed = data_dict != state.latest_data
+    state.latest_data = data_dict
+    state.last_seen = time.time()
+    logger.debug("Data received from %s: %s", device_id, data_dict)
+
+    # Push the reading to the dashboards only when it changed
+    if changed:
+        broadcaster.publish('reading', reading_event(state))
+
+    # Record the numeric values in the sensor history
+    values = {}
+    for name, value in data_dict.items():
+        try:
+            values[name] = float(value)
+        except ValueError:
+            pass
+    sensor_history.append(device_id, state.last_seen, values)
+
+    # Checked for anomalies with the readings of the other devices, in the next batch
+    if anomaly_detector is not None:
+        anomaly_detector.submit(device_id, state.last_seen, values)
+
+
+def handle_retained_message(prefix, device_id, payload):
+    """
+    Handles a retained message: the last message of a device, sent again by the broker
+    when the server subscribes. Its age is unknown, so it only fills the dashboard: a
+    reading is not added to the history, and a frame is not checked for motion, so an old
+    frame can never raise an alert or record an event.
+
+    :param prefix: Topic prefix, e.g. 'home/cam'.
+    :param device_id: Identifier of the device.
+    :param payload: Raw bytes of the message.
+    :return: None
+    """
+    state = get_device(device_id)
+    if prefix == "home/cam":
+        digest = payload_hash(payload)
+        if state.latest_frame is not None and state.latest_frame.digest == digest:
+            return
+        state.latest_frame = Frame(bytes(payload), digest, time.time())
+        broadcaster.publish('frame', {'device_id': device_id, 'timestamp': state.latest_frame.timestamp})
+    elif prefix == "home/data":
+        data_dict = parse_reading(payload)
+        if data_dict != state.latest_data:
+            state.latest_data = data_dict
+            broadcaster.publish('reading', reading_event(state))
+
+
+# Handlers indexed by topic prefix, so routing a message is a dictionary lookup
+topic_handlers = {
+    "home/cam": handle_cam_message,
+    "home/data": handle_data_message,
+}
+
+
+def record_message(prefix, device_id, payload):
+    """
+    Counts a routed message and its size in the metrics.
+
+    :param prefix: Topic prefix, e.g. 'home/cam'.
+    :param device_id: Identifier of the device.
+    :param payload: Raw bytes of the message.
+    :return: None
+    """
+    mqtt_messages_total.inc(topic=prefix, device=device_id)
+    mqtt_payload_bytes.observe(len(payload), topic=prefix)
+
+
+def parse_topic(topic):
+    """
+    Splits a topic into its prefix and device ID, e.g. 'home/cam/abc' -> ('home/cam', 'abc').
+    Bare 'home/cam' and 'home/data' topics are mapped to the default device.
+
+    :param topic: MQTT topic of a message.
+    :return: Tuple (prefix, device_id), or None if no handler is registered for the topic.
+    """
+    if topic in topic_handlers:
+        return topic, default_device_id
+    prefix, _, device_id = topic.rpartition('/')
+    if prefix not in topic_handlers or not device_id:
+        return None
+    return prefix, device_id
+
+
+def device_of_topic(topic):
+    """
+    Device ID of a device topic.
+
+    :param topic: MQTT topic.
+    :return: Device ID, or None if the topic is not a device topic.
+    """
+    route = parse_topic(topic)
+    return route[1] if route is not None else None
+
+
+def subscription_topics():
+    """
+    Topics the MQTT client subscribes to: the device topics, or the cluster subscriptions
+    in clustered mode.
+
+    :return: List of topic filters.
+    """
+    return cluster.subscriptions(mqtt_topics) if cluster is not None else mqtt_topics
+
+
+def read_retained_messages(topics, wait):
+    """
+    Reads the retained messages of some topics with a separate, short-lived MQTT client.
+
+    :param topics: Topic filters.
+    :param wait: Seconds to wait for the retained messages after connecting.
+    :return: Dictionary of the payloads by topic, empty if the broker is unreachable.
+    """
+    messages = {}
+
+    def on_reader_connect(reader, userdata, flags, rc):
+        if rc == 0:
+            for topic in topics:
+                reader.subscribe(topic)
+
+    def on_reader_message(reader, userdata, message):
+        if message.retain:
+            messages[message.topic] = bytes(message.payload)
+
+    reader = mqtt.Client()
+    reader.on_connect = on_reader_connect
+    reader.on_message = on_reader_message
+    try:
+        reader.connect(mqtt_broker_host, mqtt_broker_port, 60)
+    except OSError as e:
+        logger.warning("Could not read the retained messages from %s: %s", mqtt_broker_host, e)
+        return messages
+    reader.loop_start()
+    time.sleep(wait)
+    reader.disconnect()
+    reader.loop_stop()
+    return messages
+
+
+def restore_retained_messages():
+    """
+    Restores the latest values of the devices owned by this instance, in clustered mode.
+    The shared subscription never receives the retained messages, so they are read
+    separately. The announcements of the other members arrive meanwhile, so the owners
+    are known when the messages are applied.
+
+    :return: None
+    """
+    for topic, payload in read_retained_messages(mqtt_topics, retained_read_time).items():
+        route = parse_topic(topic)
+        if route is None or cluster.owner(route[1]) != cluster.instance_id:
+            continue
+        try:
+            handle_retained_message(route[0], route[1], payload)
+        except Exception:
+            logger.exception("Error while restoring the retained message of %s", topic)
+
+
+# Callback for when a PUBLISH message is received from the server.
+def on_message(client, userdata, message):
+    """
+    Callback for handling PUBLISH messages received from the server.
+
+    This function is called when a PUBLISH message is received from the MQTT server. 
+    In clustered mode, messages of devices owned by another instance are first forwarded
+    to it. The messages handled here are recorded if a capture file is configured.
+    Retained messages, sent by the broker on subscription, only restore the latest values.
+    The topic is split into a prefix and a device ID ('home/cam/<client_id>'), and the
+    message is routed to the handler of the prefix. Bare 'home/cam' and 'home/data' topics
+    are mapped to the default device.
+    
+    For camera-related messages:
+    - Queues the received image for motion detection against the camera's previous image.
+    
+    For data-related messages:
+    - Decodes and stores received data.
+    
+    :param client: The MQTT client instance.
+    :param userdata: User-specific data passed to the MQTT client.
+    :param message: The received MQTT message.
+    :return: None
+    """
+
+    topic = message.topic
+    if cluster is not None:
+        topic = cluster.route(client, topic, message.payload)
+        if topic is None:
+            return
+
+    # Recorded on the device topic. Retained messages are old messages sent again by the
+    # broker, not live traffic.
+    if capture is not None and not message.retain:
+        capture.record(topic, message.payload)
+
+    route = parse_topic(topic)
+    if route is None:
+        mqtt_messages_ignored_total.inc()
+        logger.warning("Ignoring message on unexpected topic %s", message.topic)
+        return
+
+    prefix, device_id = route
+    record_message(prefix, device_id, message.payload)
+    try:
+        if message.retain:
+            handle_retained_message(prefix, device_id, message.payload)
+        else:
+            topic_handlers[prefix](device_id, message.payload)
+    except Exception:
+        logger.exception("Error while handling message on %s", message.topic)
+
+
+def process_frame(camera_id, payload):
+    """
+    Detection task run by the dispatcher's worker threads for each camera frame.
+
+    :param camera_id: Identifier of the camera that sent the frame.
+    :param payload: Raw bytes of the received image.
+    :return: Future of the detection when it runs in the detection pool, None otherwise.
+    """
+    state = get_device(camera_id)
+    if in_memory_frames:
+        return process_frame_in_memory(client, state, payload)
+    process_frame_on_disk(client, state, payload)
+
+##################################################
+
+# Stores, opened by open_stores() at startup
+sensor_history = None
+event_store = None
+event_recorder = None
+image_cache = None
+capture = None
+
+# Periodic snapshot of the devices, started by restore_state()
+state_snapshot = None
+
+# Streaming anomaly detection on the sensor readings, started by start_anomaly_detection()
+anomaly_detector = None
+
+# Set once the stores are open and the detection is running
+startup_complete = threading.Event()
+
+
+def open_stores():
+    """
+    Opens the sensor history, the motion event store and the image cache, and starts the
+    recording of the messages if a capture file is configured. Stores already open are kept.
+    """
+    global sensor_history, event_store, event_recorder, image_cache, capture
+    from event_store import EventStore
+    from image_cache import VariantCache
+    from timeseries import TimeSeriesStore
+
+    # Open the sensor history, reloading the samples recorded before a restart
+    if sensor_history is None:
+        sensor_history = TimeSeriesStore(timeseries_folder)
+
+    # Open the motion event store and start its writer thread
+    if event_store is None:
+        event_store = EventStore(output_folder, event_store_max_bytes, event_queue_size, clip_fourcc=event_clip_fourcc,
+                                 legacy_camera=default_device_id)
+        event_store.start()
+        event_recorder = EventRecorder(event_store, event_pre_roll, event_post_roll, event_clip_max_seconds)
+        event_recorder.start()
+
+    # Cache of the image variants served to the web pages
+    if image_cache is None:
+        image_cache = VariantCache(image_cache_max_bytes, image_cache_folder, image_cache_folder_max_bytes)
+
+    # Start recording the incoming messages if a capture file is configured
+    if capture_file and capture is None:
+        capture = CaptureWriter(capture_file)
+        capture.start()
+
+# Detection processes, started with the MQTT client when detection_processes is set
+detection_pool = None
+
+# Membership of this instance in the cluster, in clustered mode, created by setup_cluster()
+cluster = None
+
+# Detection workers, created with the MQTT client
+dispatcher = None
+
+# MQTT client of the threaded server, created by start_mqtt_client()
+client = None
+
+
+def setup_cluster():
+    """
+    Joins the cluster if cluster_instance is set.
+
+    :return: The Cluster, or None for a standalone server.
+    """
+    global cluster
+    if cluster_instance and cluster is None:
+        cluster = Cluster(cluster_instance, cluster_url, device_of_topic, cluster_group,
+                          control_prefix=capture_control_topic)
+    return cluster
+
+##################################################
+
+## Metrics, exposed in the Prometheus text format by /metrics
+
+mqtt_connected = registry.gauge(
+    "mqtt_connected", "1 while the MQTT client is connected to the broker, 0 otherwise.")
+mqtt_messages_total = registry.counter(
+    "mqtt_messages_total", "MQTT messages received, per topic prefix and device.", ["topic", "device"])
+mqtt_messages_ignored_total = registry.counter(
+    "mqtt_messages_ignored_total", "MQTT messages received on a topic without handler.")
+mqtt_payload_bytes = registry.histogram(
+    "mqtt_payload_bytes", "Size of the received MQTT payloads.", ["topic"], default_size_buckets)
+motion_events_total = registry.counter(
+    "motion_events_total", "Motion alerts (transitions to ON), per camera.", ["device"])
+detection_queue_depth = registry.gauge(
+    "detection_queue_depth", "Camera frames waiting for motion detection.")
+detection_frames_processed_total = registry.counter(
+    "detection_frames_processed_total", "Camera frames processed by the motion detection.")
+detection_frames_dropped_total = registry.counter(
+    "detection_frames_dropped_total", "Camera frames dropped because the detection was behind, per camera.", ["device"])
+event_store_bytes = registry.gauge(
+    "event_store_bytes", "Disk space used by the saved motion events.")
+event_store_dropped_total = registry.counter(
+    "event_store_dropped_total", "Motion event frames dropped because the writer was behind.")
+event_clips_total = registry.counter(
+    "event_clips_total", "Motion clips started.")
+image_cache_bytes = registry.gauge(
+    "image_cache_bytes", "Memory used by the cached image variants.")
+image_cache_requests_total = registry.counter(
+    "image_cache_requests_total", "Image variants requested, per result (hit, disk_hit or miss).", ["result"])
+camera_capture_interval_seconds = registry.gauge(
+    "camera_capture_interval_seconds", "Capture interval last sent to each camera.", ["device"])
+sensor_alerts_total = registry.counter(
+    "sensor_alerts_total", "Sensor anomaly alerts raised, per kind (range, band, rate or silent).", ["kind"])
+
+detection_process_restarts_total = registry.counter(
+    "detection_process_restarts_total", "Detection processes restarted after a failure.")
+
+detection_process_restarts_total.set_function(lambda: detection_pool.restarts if detection_pool is not None else 0)
+event_store_bytes.set_function(lambda: event_store.total_bytes if event_store is not None else 0)
+event_store_dropped_total.set_function(lambda: event_store.dropped if event_store is not None else 0)
+event_clips_total.set_function(lambda: event_recorder.clips if event_recorder is not None else 0)
+image_cache_bytes.set_function(lambda: image_cache.total_bytes if image_cache is not None else 0)
+image_cache_requests_total.set_function(
+    lambda: {('hit',): image_cache.hits, ('disk_hit',): image_cache.disk_hits, ('miss',): image_cache.misses}
+    if image_cache is not None else {})
+camera_capture_interval_seconds.set_function(
+    lambda: {(state.device_id,): capture_rate_steps[state.capture_step]['interval']
+             for state in list(devices.values()) if state.capture_step is not None})
+sensor_alerts_total.set_function(
+    lambda: {(kind,): count for kind, count in anomaly_detector.alerts.items()} if anomaly_detector is not None else {})
+
+
+def register_detection_metrics(stats):
+    """
+    Exposes the queue depth and counters of a detection pool in the metrics.
+
+    :param stats: Function returning the statistics of the pool, as DetectionDispatcher.stats().
+    :return: None
+    """
+    detection_queue_depth.set_function(lambda: stats()['queue_depth'])
+    detection_frames_processed_total.set_function(lambda: stats()['processed'])
+    detection_frames_dropped_total.set_function(
+        lambda: {(camera,): count for camera, count in stats()['dropped'].items()})
+
+
+def start_detection_pool():
+    """
+    Starts the detection processes if detection_processes is set.
+
+    :return: The DetectionPool, or None if detection runs in the worker threads.
+    """
+    global detection_pool
+    from detection_pool import DetectionPool
+    if detection_processes and detection_pool is None:
+        detection_pool = DetectionPool(detection_processes, detection_slot_bytes, motion_detector, motion_detector_options,
+                                       detection_slots)
+        detection_pool.start()
+    return detection_pool
+
+
+def stop_detection_pool():
+    """
+    Stops the detection processes, if they were started.
+    """
+    global detection_pool
+    if detection_pool is not None:
+        detection_pool.stop()
+        detection_pool = None
+
+
+def close_event_store():
+    """
+    Ends the clips being recorded and waits until the event store has written them.
+    """
+    if event_recorder is not None:
+        event_recorder.close()
+    if event_store is not None:
+        event_store.close()
+
+
+def restore_state():
+    """
+    Reloads the state of the devices from the last snapshot and starts the periodic
+    snapshots. Called once the detection is running, as the models of the motion detectors
+    are restored in the detection processes.
+
+    :return: Number of devices restored.
+    """
+    global state_snapshot
+    from snapshot import StateSnapshot
+    if not snapshot_file or state_snapshot is not None:
+        return 0
+
+    state_snapshot = StateSnapshot(snapshot_file, snapshot_interval, collect_state)
+    saved_at, saved = state_snapshot.load()
+    restored = 0
+    for device_id, values in saved.items():
+        try:
+            get_device(device_id).restore(values, time.time() - saved_at)
+            restored += 1
+        except (KeyError, TypeError, ValueError, RuntimeError) as e:
+            logger.warning("Could not restore the state of %s: %s", device_id, e)
+    if saved_at is not None:
+        logger.info("Restored the state of %d devices from the snapshot of %s", restored,
+                    datetime.datetime.fromtimestamp(saved_at).isoformat(timespec='seconds'))
+    state_snapshot.start()
+    return restored
+
+
+def close_snapshot():
+    """
+    Stops the periodic snapshots and saves the state of the devices a last time.
+    """
+    global state_snapshot
+    if state_snapshot is not None:
+        state_snapshot.close()
+        state_snapshot = None
+
+
+def publish_alert(publisher, alert):
+    """
+    Publishes a sensor anomaly alert on anomaly_topic/<device_id>, as JSON.
+
+    :param publisher: MQTT client, or any object with a publish(topic, payload) method.
+    :param alert: Dictionary of the alert, from AnomalyDetector.
+    :return: None
+    """
+    if alert['state'] == 'raised':
+        logger.warning("Sensor alert for %s: %s %s", alert['device_id'], alert['kind'], alert.get('metric') or '')
+    else:
+        logger.info("Sensor alert cleared for %s: %s %s", alert['device_id'], alert['kind'], alert.get('metric') or '')
+    publisher.publish(f"{anomaly_topic}/{alert['device_id']}", json.dumps(alert))
+
+
+def start_anomaly_detection(publisher):
+    """
+    Starts the streaming anomaly detection on the sensor readings. The devices restored
+    from the snapshot are watched, so they are reported if they never send again.
+
+    :param publisher: MQTT client, or any object with a publish(topic, payload) method,
+                      used to publish the alerts.
+    :return: The AnomalyDetector, or None if the detection is disabled.
+    """
+    global anomaly_detector
+    from anomaly import AnomalyDetector
+    if not anomaly_detection or anomaly_detector is not None:
+        return anomaly_detector
+
+    anomaly_detector = AnomalyDetector(sensor_history.metrics, anomaly_alpha, anomaly_band, anomaly_warmup,
+                                       anomaly_ranges, anomaly_max_rates, silence_timeout=anomaly_silence_timeout)
+    for state in list(devices.values()):
+        if state.latest_data and state.last_seen is not None:
+            anomaly_detector.track(state.device_id, state.last_seen)
+    anomaly_detector.start(lambda alert: publish_alert(publisher, alert), anomaly_interval)
+    return anomaly_detector
+
+
+def stop_anomaly_detection():
+    """
+    Stops the streaming anomaly detection.
+    """
+    global anomaly_detector
+    if anomaly_detector is not None:
+        anomaly_detector.close()
+        anomaly_detector = None
+
+
+def start_detection():
+    """
+    Starts the detection processes and workers (threaded Flask server).
+
+    :return: The DetectionDispatcher.
+    """
+    global dispatcher
+    start_detection_pool()
+    if dispatcher is None:
+        # One worker thread per detection process at least, so every process gets frames
+        dispatcher = DetectionDispatcher(process_frame, max(detection_workers, detection_processes),
+                                         detection_queue_size)
+        register_detection_metrics(dispatcher.stats)
+        dispatcher.start()
+    return dispatcher
+
+
+# Callback for when the client connects (or reconnects) to the broker
+def on_connect(client, userdata, flags, rc):
+    """
+    Subscribes to the device topics and, in clustered mode, announces this instance. Done
+    on every connection, since the broker forgets the subscriptions of a lost session.
+
+    :param client: The MQTT client instance.
+    :param userdata: Private user data (unused).
+    :param flags: Response flags sent by the broker.
+    :param rc: Result of the connection, 0 on success.
+    :return: None
+    """
+    if rc != 0:
+        logger.warning("Connection to the broker %s refused (%s)", mqtt_broker_host, rc)
+        return
+    logger.info("Connected to the broker %s", mqtt_broker_host)
+    mqtt_connected.set(1)
+    for topic in subscription_topics():
+        client.subscribe(topic)
+    if cluster is not None:
+        client.publish(cluster.member_topic(), cluster.announcement(), retain=True)
+
+
+# Callback for when the client loses its connection to the broker
+def on_disconnect(client, userdata, rc):
+    """
+    Logs an unexpected disconnection. The network loop reconnects by itself.
+
+    :param client: The MQTT client instance.
+    :param userdata: Private user data (unused).
+    :param rc: Reason of the disconnection, 0 when requested by the client.
+    :return: None
+    """
+    mqtt_connected.set(0)
+    if rc != 0:
+        logger.warning("Connection to the broker %s lost (%s), reconnecting", mqtt_broker_host, rc)
+
+
+def start_mqtt_client():
+    """
+    Runs the MQTT client of the threaded Flask server in a separate thread.
+
+    The connection is made by that thread: an unreachable broker does not block the caller,
+    and the client keeps retrying, waiting from mqtt_reconnect_delay up to
+    mqtt_reconnect_max_delay seconds between attempts.
+
+    :return: The MQTT client instance.
+    """
+    global client
+
+    # Setup MQTT Client
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    if cluster is not None:
+        # The broker clears the announcement of this instance if it disappears
+        client.will_set(cluster.member_topic(), b"", retain=True)
+    client.reconnect_delay_set(mqtt_reconnect_delay, mqtt_reconnect_max_delay)
+    client.connect_async(mqtt_broker_host, mqtt_broker_port, 60)
+
+    # Run the MQTT client in a separate thread
+    client.loop_start()
+    if cluster is not None:
+        threading.Thread(target=restore_retained_messages, name="retained", daemon=True).start()
+    return client
+
+
+##################################################
+
+## Data shared by the web routes of the threaded (Flask) and async (ASGI) servers
+
+# Seconds between keepalive messages on idle push connections
+stream_keepalive = 15
+
+# Comment line sent on idle Server-Sent Events connections: keeps proxies from closing them
+sse_keepalive = ": keepalive\n\n"
+
+
+def dashboard_context(camera_id=None, sensor_id=None, size=None):
+    """
+    Template variables of the dashboard page.
+
+    :param camera_id: Camera to show, the first camera with a frame if None.
+    :param sensor_id: Sensor board to show, the first board with a reading if None.
+    :param size: Image variant streamed to the page (e.g. 'medium' on mobile connections),
+                 None for the original frames. Unknown variants are ignored.
+    :return: Dictionary of template variables.
+    """
+    if size not in image_variants:
+        size = None
+    frame_attribute = 'latest_frame' if in_memory_frames else 'latest_image_path'
+    camera = find_device(camera_id, frame_attribute)
+    sensor = find_device(sensor_id, 'latest_data')
+
+    # In memory mode the frames are pushed by the MJPEG stream of the camera
+    if camera is None:
+        image_url = ''
+    elif in_memory_frames:
+        image_url = f"/api/mjpeg/{quote(camera.device_id)}" + (f"?size={size}" if size else "")
+    else:
+        image_url = f"/static/{quote(camera.image_filename())}"
+
+    return {
+        'image_url': image_url,
+        'image_size': size or '',
+        'streaming': in_memory_frames,
+        'data': sensor.latest_data if sensor else {},
+        'sensor_id': sensor.device_id if sensor else '',
+        'camera_id': camera.device_id if camera else '',
+        'mouv': camera.detect_mouv if camera else False,
+    }
+
+
+def latest_snapshot(device_id=None):
+    """
+    Latest reading, motion flag and frame information of every device, or of one device.
+
+    :param device_id: Identifier of a device, all devices if None.
+    :return: Tuple (dictionary indexed by device ID, time of the last message or None),
+             or None if the device is unknown.
+    """
+    if device_id is not None:
+        if device_id not in devices:
+            return None
+        states = [devices[device_id]]
+    else:
+        states = list(devices.values())
+
+    latest = {}
+    for state in states:
+        entry = {'data': state.latest_data, 'timestamp': state.last_seen,
+                 'mouv': state.detect_mouv, 'motion_score': state.motion_score, 'frame': None}
+        frame = state.latest_frame
+        if frame is not None:
+            entry['frame'] = {'url': f"/api/frame/{quote(state.device_id)}",
+                              'etag': frame.digest.hex(), 'timestamp': frame.timestamp}
+        latest[state.device_id] = entry
+
+    last_seen = [state.last_seen for state in states if state.last_seen is not None]
+    return latest, max(last_seen) if last_seen else None
+
+
+def device_summaries():
+    """
+    Summary of every known device: motion flag, motion score, last message time and reading.
+
+    :return: List of dictionaries.
+    """
+    return [
+        {'device_id': state.device_id, 'mouv': state.detect_mouv, 'motion_score': state.motion_score,
+         'last_seen': state.last_seen,
+         'has_frame': state.latest_frame is not None, 'data': state.latest_data}
+        for state in list(devices.values())
+    ]
+
+
+def json_values(array, digits=3):
+    """
+    Converts a NumPy array to a JSON-friendly list, with NaN as null.
+
+    :param array: Array of numbers.
+    :param digits: Number of decimals kept. Default is 3.
+    :return: List of floats and None.
+    """
+    return [None if value != value else round(value, digits) for value in array.tolist()]
+
+
+def history_snapshot(device_id, start, end, points, method, metrics):
+    """
+    Sensor history of a device over a time range, downsampled to about 'points' points.
+
+    :param device_id: Identifier of the sensor board.
+    :param start: Start of the range (seconds since the epoch).
+    :param end: End of the range.
+    :param points: Number of points per metric.
+    :param method: 'minmax' or 'lttb'.
+    :param metrics: List of metric names, all of them if None.
+    :return: JSON-friendly dictionary, or None if the device is unknown.
+    """
+    from timeseries import downsample
+    if start >= end:
+        raise ValueError("The start of the range must be before its end.")
+
+    result = downsample(sensor_history, device_id, start, end, points, method, metrics)
+    if result is None:
+        return None
+
+    resolution, series = result
+    return {
+        'device_id': device_id,
+        'start': start,
+        'end': end,
+        'method': method,
+        'resolution': resolution,
+        'metrics': {metric: {key: json_values(values) for key, values in arrays.items()}
+                    for metric, arrays in series.items()},
+    }
+
+
+def owner_location(device_id, path):
+    """
+    URL of a request on the instance owning a device, in clustered mode.
+
+    :param device_id: Identifier of the device, or None.
+    :param path: Path and query string of the request.
+    :return: Absolute URL on the owner, or None if the request is answered by this instance.
+    """
+    if cluster is None or not device_id:
+        return None
+    base = cluster.owner_url(device_id)
+    return base + path if base is not None else None
+
+
+def cluster_summary():
+    """
+    Members of the cluster and owners of the devices known to this instance.
+
+    :return: Dictionary of the cluster state, {'clustered': False} for a standalone server.
+    """
+    if cluster is None:
+        return {'clustered': False}
+    summary = cluster.stats()
+    summary['clustered'] = True
+    with devices_lock:
+        device_ids = list(devices)
+    summary['owners'] = {device_id: cluster.owner(device_id) for device_id in device_ids}
+    return summary
+
+
+def with_pool_stats(stats):
+    """
+    Adds the statistics of the detection processes, when they run, to the detection statistics.
+
+    :param stats: Statistics of the detection workers.
+    :return: The same dictionary, with a 'pool' entry if the detection pool is running.
+    """
+    if detection_pool is not None:
+        stats['pool'] = detection_pool.stats()
+    return stats
+
+
+def initial_stream_events():
+    """
+    Notifications describing the current state, sent first on a new push connection.
+
+    :return: Generator of (kind, data) tuples.
+    """
+    for state in list(devices.values()):
+        if state.latest_data:
+            yield 'reading', reading_event(state)
+        if state.latest_frame is not None:
+            yield 'motion', motion_event(state)
+
+
+def format_sse(kind, data):
+    """
+    Formats a notification as a Server-Sent Event.
+
+    :param kind: Kind of notification, used as the event name.
+    :param data: JSON-serializable data.
+    :return: Text of the event.
+    """
+    return f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+
+def mjpeg_part(data):
+    """
+    Formats a frame as one part of a multipart MJPEG stream (boundary 'frame').
+
+    :param data: JPEG bytes of the frame.
+    :return: Bytes of the part.
+    """
+    return (b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+            + str(len(data)).encode() + b"\r\n\r\n" + data + b"\r\n")
+
+
+def check_variant(size):
+    """
+    Validates the 'size' parameter of an image request.
+
+    :param size: Name of an image variant, or None for the original image.
+    :raise ValueError: If the variant does not exist.
+    """
+    if size is not None and size not in image_variants:
+        raise ValueError(f"Unknown image size '{size}', expected one of {', '.join(image_variants)}.")
+
+
+def frame_image(device_id, frame, size=None):
+    """
+    Image of a camera frame: the received bytes, or a cached smaller variant.
+
+    :param device_id: Identifier of the camera.
+    :param frame: Frame of the camera.
+    :param size: Name of the variant, a key of image_variants, or None for the original.
+    :return: Image bytes.
+    """
+    from image_cache import resize_image
+    if size is None:
+        return frame.data
+    return image_cache.get(('frame', device_id, frame.digest.hex(), size),
+                           lambda: resize_image(frame.data, image_variants[size], image_variant_quality))
+
+
+def event_image_data(event, size=None):
+    """
+    Image of a motion event (the key frame of a clip), or a smaller variant, from the cache.
+    Browsing events then decodes each clip or image once.
+
+    :param event: Event dictionary.
+    :param size: Name of the variant, a key of image_variants, or None for the full size.
+    :return: JPEG bytes, or None if the event file cannot be read.
+    """
+    from image_cache import resize_image
+    if size is None:
+        return image_cache.get(('event', event['id'], 'full'), lambda: event_store.key_frame(event))
+
+    def generate():
+        image = event_image_data(event)
+        return resize_image(image, image_variants[size], image_variant_quality) if image is not None else None
+
+    return image_cache.get(('event', event['id'], size), generate)
+
+##################################################
+
+
+@app.route('/')
+def index():
+    """
+    Flask route for the web application's main page.
+
+    This route renders an HTML template with the latest image, data, and motion detection status.
+    The camera and the sensor board can be chosen with the 'camera' and 'sensor' query
+    parameters, otherwise the first device that has sent something is shown. '?size=medium'
+    or '?size=thumb' streams smaller images, for mobile connections.
+
+    :return: Rendered HTML template.
+    """
+    # In clustered mode, the dashboard of a camera is served by the instance owning it
+    redirect_to_owner(request.args.get('camera'))
+
+    # Render template with the latest image and data, later updates are pushed by '/api/stream'
+    return render_template('indexFinal.html',
+                           **dashboard_context(request.args.get('camera'), request.args.get('sensor'),
+                                               request.args.get('size')))
+
+
+def redirect_to_owner(device_id):
+    """
+    Sends the client to the instance owning a device, in clustered mode. Returns normally
+    when the request is answered by this instance.
+
+    :param device_id: Identifier of the device, or None.
+    """
+    location = owner_location(device_id, request.full_path.rstrip('?'))
+    if location is not None:
+        abort(redirect(location, 307))
+
+
+def image_mimetype(data):
+    """
+    Content type of an encoded image, from its first bytes.
+
+    :param data: Encoded image.
+    :return: MIME type, 'application/octet-stream' if the format is not recognized.
+    """
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    return 'application/octet-stream'
+
+
+def frame_response(state):
+    """
+    Builds a cacheable response holding the latest frame of a camera, or the variant given
+    by the 'size' query parameter.
+
+    The response carries an ETag (digest of the payload) and a Last-Modified date, and is
+    answered with 304 Not Modified when the client already has this frame.
+
+    :param state: DeviceState of the camera.
+    :return: Flask response.
+    """
+    size = request.args.get('size')
+    try:
+        check_variant(size)
+    except ValueError as e:
+        abort(400, str(e))
+    frame = state.latest_frame
+    data = frame_image(state.device_id, frame, size)
+    response = Response(data, mimetype=image_mimetype(data))
+    response.set_etag(frame.digest.hex() + (f"-{size}" if size else ""))
+    response.last_modified = datetime.datetime.fromtimestamp(frame.timestamp, datetime.timezone.utc)
+    # Browsers must revalidate, which costs a 304 when the frame did not change
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/latest_image')
+@app.route('/latest_image/<device_id>')
+@app.route('/api/frame/<device_id>')
+def latest_image(device_id=None):
+    """
+    Flask route serving the latest frame of a camera from memory, with conditional GET
+    support (ETag / If-None-Match and Last-Modified / If-Modified-Since).
+
+    :param device_id: Identifier of the camera, the first camera with a frame if omitted.
+    :return: The raw JPEG bytes of the latest frame (or of a smaller variant with
+             '?size=thumb' or '?size=medium'), 304 if unchanged, or 404 if no frame was
+             received yet.
+    """
+    redirect_to_owner(device_id)
+    camera = find_device(device_id, 'latest_frame')
+    if camera is None or camera.latest_frame is None:
+        abort(404)
+    return frame_response(camera)
+
+
+@app.route('/api/latest')
+def api_latest():
+    """
+    Flask route returning the latest reading, motion flag and frame information of every
+    device (or of the device given by the 'device' query parameter), with conditional GET
+    support so that polling costs a 304 when nothing changed.
+
+    :return: JSON dictionary indexed by device ID, 304 if unchanged, or 404 for an unknown device.
+    """
+    redirect_to_owner(request.args.get('device'))
+    snapshot = latest_snapshot(request.args.get('device'))
+    if snapshot is None:
+        abort(404)
+
+    latest, last_modified = snapshot
+    response = jsonify(latest)
+    response.add_etag()
+    if last_modified is not None:
+        response.last_modified = datetime.datetime.fromtimestamp(last_modified, datetime.timezone.utc)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/devices')
+def list_devices():
+    """
+    Flask route listing the known devices with their motion flag and last message time.
+
+    :return: JSON list of devices.
+    """
+    return jsonify(device_summaries())
+
+
+@app.route('/api/cluster')
+def api_cluster():
+    """
+    Flask route describing the cluster: members, forwarding counters and device owners.
+
+    :return: JSON description of the cluster.
+    """
+    return jsonify(cluster_summary())
+
+
+@app.route('/stats/detection')
+def detection_stats():
+    """
+    Flask route exposing the detection queue depth and drop counters.
+
+    :return: JSON statistics of the detection dispatcher.
+    """
+    return jsonify(with_pool_stats(dispatcher.stats() if dispatcher is not None else {}))
+
+
+@app.route('/api/history/<device_id>')
+def sensor_history_range(device_id):
+    """
+    Flask route returning the sensor history of a device over a time range, downsampled
+    on the server so that a long range only ships a few hundred points.
+
+    Query parameters:
+    - 'start', 'end': time range in seconds since the epoch (default: the last 24 hours).
+    - 'points': number of points per metric (default 500, at most 5000).
+    - 'method': 'minmax' (min, max and mean per time bucket, default) or 'lttb'.
+    - 'metrics': comma-separated metric names (default: all of them).
+
+    :param device_id: Identifier of the sensor board.
+    :return: JSON history, 400 for invalid parameters or 404 for an unknown device.
+    """
+    redirect_to_owner(device_id)
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', end - 24 * 3600, type=float)
+    points = min(max(request.args.get('points', 500, type=int), 3), 5000)
+    method = request.args.get('method', 'minmax')
+    metrics = request.args.get('metrics')
+    metrics = metrics.split(',') if metrics else None
+
+    try:
+        history = history_snapshot(device_id, start, end, points, method, metrics)
+    except ValueError as e:
+        abort(400, str(e))
+    if history is None:
+        abort(404)
+    response = jsonify(history)
+    # Dashboards served by another instance of the cluster fetch the history from here
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+@app.route('/api/stream')
+def event_stream():
+    """
+    Flask route pushing changes to the dashboard as Server-Sent Events.
+
+    The client first receives the current reading of every sensor board and the motion flag
+    of every camera, then only the changes: 'reading' when a reading changes, 'motion' when
+    a motion flag changes and 'frame' when a camera sends a new frame.
+
+    :return: Streaming 'text/event-stream' response.
+    """
+    def generate():
+        subscriber = broadcaster.subscribe({'reading', 'motion', 'frame'})
+        try:
+            # Current state first, so the page does not wait for the next change
+            for kind, data in initial_stream_events():
+                yield format_sse(kind, data)
+
+            while True:
+                try:
+                    kind, data = subscriber.get(timeout=stream_keepalive)
+                except queue.Empty:
+                    yield sse_keepalive
+                    continue
+                yield format_sse(kind, data)
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/mjpeg/<device_id>')
+def mjpeg_stream(device_id):
+    """
+    Flask route streaming the frames of a camera as multipart MJPEG, straight from memory.
+
+    A frame is sent only when the camera delivers a new one. A client that is slower than
+    the camera skips frames instead of falling behind. With '?size=thumb' or '?size=medium',
+    smaller variants of the frames are streamed, resized once for all the clients.
+
+    :param device_id: Identifier of the camera.
+    :return: Streaming 'multipart/x-mixed-replace' response, or 404 for an unknown camera.
+    """
+    redirect_to_owner(device_id)
+    size = request.args.get('size')
+    try:
+        check_variant(size)
+    except ValueError as e:
+        abort(400, str(e))
+    state = devices.get(device_id)
+    if state is None:
+        abort(404)
+
+    def generate():
+        subscriber = broadcaster.subscribe({'frame'})
+        try:
+            sent = None
+            while True:
+                frame = state.latest_frame
+                if frame is not None and frame is not sent:
+                    yield mjpeg_part(frame_image(device_id, frame, size))
+                    sent = frame
+
+                # Wait for the next frame of this camera
+                try:
+                    while subscriber.get(timeout=stream_keepalive)[1]['device_id'] != device_id:
+                        pass
+                except queue.Empty:
+                    pass
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/events')
+def list_events():
+    """
+    Flask route listing motion events from the index, most recent first.
+
+    Optional query parameters: 'camera', 'start' and 'end' (seconds since the epoch) and
+    'limit' (default 100).
+
+    :return: JSON list of events.
+    """
+    redirect_to_owner(request.args.get('camera'))
+    return jsonify(event_store.list(
+        camera=request.args.get('camera'),
+        start=request.args.get('start', type=float),
+        end=request.args.get('end', type=float),
+        limit=request.args.get('limit', 100, type=int),
+    ))
+
+
+@app.route('/events/<event_id>.jpg')
+def event_image(event_id):
+    """
+    Flask route serving the marked image of a motion event: for a clip, its frame of
+    highest motion. '?size=thumb' or '?size=medium' return a smaller variant.
+
+    :param event_id: ID of the event.
+    :return: The JPEG image, or 404 if the event does not exist.
+    """
+    size = request.args.get('size')
+    try:
+        check_variant(size)
+    except ValueError as e:
+        abort(400, str(e))
+    event = event_store.get(event_id)
+    image = event_image_data(event, size) if event is not None else None
+    if image is None:
+        abort(404)
+    response = Response(image, mimetype='image/jpeg')
+    # Events never change: browsers may keep their images
+    response.cache_control.max_age = 86400
+    return response
+
+
+@app.route('/events/<event_id>.avi')
+def event_clip(event_id):
+    """
+    Flask route serving the video clip of a motion event.
+
+    :param event_id: ID of the event.
+    :return: The AVI file, or 404 if the event does not exist or is a single image.
+    """
+    event = event_store.get(event_id)
+    if event is None or event['kind'] != 'clip':
+        abort(404)
+    return send_file(event_store.media_path(event), mimetype='video/x-msvideo', conditional=True)
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Exposes the server metrics in the Prometheus text format.
+    """
+    return Response(registry.render(), content_type=registry.content_type)
+
+
+@app.route('/api/alerts')
+def api_alerts():
+    """
+    Flask route listing the sensor anomalies going on and the counters of the detection.
+    With '?device=<id>', the moving statistics of the device are included.
+
+    :return: JSON description of the alerts.
+    """
+    if anomaly_detector is None:
+        abort(404)
+    result = {'active': anomaly_detector.active_alerts(), 'stats': anomaly_detector.stats()}
+    device_id = request.args.get('device')
+    if device_id is not None:
+        result['statistics'] = anomaly_detector.statistics(device_id)
+    return jsonify(result)
+
+
+@app.route('/stats/images')
+def image_stats():
+    """
+    Flask route returning the size and counters of the image variant cache.
+
+    :return: JSON statistics.
+    """
+    return jsonify(image_cache.stats())
+
+
+@app.route('/stats/events')
+def event_stats():
+    """
+    Flask route exposing the disk usage and counters of the motion event store.
+
+    :return: JSON statistics of the event store.
+    """
+    return jsonify(event_store.stats())
+
+##################################################
+
+## Startup
+
+# Routes reading the stores, answered with a 503 while they are being opened
+store_endpoints = {'sensor_history_range', 'list_events', 'event_image', 'event_clip', 'event_stats', 'image_stats'}
+
+
+@app.before_request
+def wait_for_startup():
+    """
+    Holds the requests needing the stores until they are open, for at most startup_wait
+    seconds. The other pages are served as soon as the web server is up.
+
+    :return: None, or a 503 response if the stores are still not open.
+    """
+    if request.endpoint in store_endpoints and not startup_complete.wait(startup_wait):
+        return Response("Starting up, retry shortly.", status=503, headers={'Retry-After': '5'},
+                        mimetype='text/plain')
+
+
+def coerce_setting(name, value):
+    """
+    Converts the value of a setting to the type of its default. Integers are accepted for
+    float settings, integral numbers for integer settings, and 0 or 1 for boolean settings.
+    Settings whose default is None take any value.
+
+    :param name: Name of the setting.
+    :param value: Value read from the configuration file or the environment.
+    :return: Converted value.
+    :raises ValueError: If the value does not have the type of the setting.
+    """
+    default = globals()[name]
+    if default is None or (value is None and name in nullable_settings):
+        return value
+    if isinstance(default, bool):
+        if isinstance(value, bool) or value in (0, 1):
+            return bool(value)
+    elif isinstance(default, (int, float)):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if isinstance(default, float):
+                return float(value)
+            if float(value).is_integer():
+                return int(value)
+    elif isinstance(value, type(default)):
+        return value
+    raise ValueError(f"Invalid value for setting {name}: {value!r} (expected {type(default).__name__})")
+
+
+def load_config(path=None, environ=None):
+    """
+    Overrides the settings of this module with a JSON configuration file, then with the
+    environment variables named config_env_prefix + the setting name in upper case.
+    Environment values of string settings are used as they are (except null for a setting
+    disabled by None), the others are parsed as JSON (numbers, booleans, lists, objects,
+    null). Each value is converted to the type of
+    the default of its setting (see coerce_setting()).
+
+    :param path: Path of the JSON configuration file. Default is the file named by the
+                 SERVER_PUB_CONFIG environment variable, if any.
+    :param environ: Environment variables. Default is os.environ.
+    :return: Dictionary of the overridden settings.
+    :raises ValueError: If a setting is unknown or has a value of the wrong type.
+    """
+    environ = os.environ if environ is None else environ
+    path = path or environ.get(config_env_prefix + "CONFIG")
+
+    settings = {}
+    if path:
+        with open(path) as config_file:
+            settings.update(json.load(config_file))
+    for name in config_settings:
+        value = environ.get(config_env_prefix + name.upper())
+        if value is not None:
+            if isinstance(globals()[name], str) and not (name in nullable_settings and value == 'null'):
+                settings[name] = value
+                continue
+            try:
+                settings[name] = json.loads(value)
+            except ValueError:
+                settings[name] = value
+
+    unknown = set(settings) - set(config_settings)
+    if unknown:
+        raise ValueError("Unknown settings: " + ", ".join(sorted(unknown)))
+    settings = {name: coerce_setting(name, value) for name, value in settings.items()}
+    if 'static_image_folder' in settings and 'output_folder' not in settings:
+        settings['output_folder'] = os.path.join(settings['static_image_folder'], 'MONITORING')
+    globals().update(settings)
+    return settings
+
+
+def startup():
+    """
+    Opens the stores, starts the detection, restores the state of the devices, connects to
+    the broker and starts the anomaly detection. Run in a background thread by create_app(),
+    so the web server answers while the stores are loading.
+    """
+    try:
+        open_stores()
+        start_detection()
+        restore_state()
+        startup_complete.set()
+        start_anomaly_detection(start_mqtt_client())
+    except Exception:
+        logger.exception("Error while starting the server")
+
+
+def create_app(config_file=None):
+    """
+    Configures the server and returns the Flask application at once: the stores are opened
+    and the broker is connected in the background.
+
+    :param config_file: Path of a JSON configuration file (see load_config()).
+    :return: The Flask application.
+    """
+    load_config(config_file)
+    setup_logging(log_level, log_burst, log_interval)
+    setup_cluster()
+    threading.Thread(target=startup, name="startup", daemon=True).start()
+    return app
+
 
 if __name__ == '__main__':
-    # Start the Flask web application
-    app.run(host='0.0.0.0', port=5001, use_reloader=False, threaded=True)
\ No newline at end of file
+    # Configure the server and start the Flask web application, the stores and the broker
+    # connection follow in the background
+    create_app()
+    try:
+        app.run(host=http_host, port=http_port, use_reloader=False, threaded=True)
+    finally:
+        stop_anomaly_detection()
+        close_snapshot()
+        close_event_store()
\ No newline at end of file
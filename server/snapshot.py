@@ -0,0 +1,199 @@
+# Import necessary libraries
+import io
+import os
+import json
+import time
+import logging
+import threading
+import numpy as np
+
+##################################################
+
+logger = logging.getLogger("snapshot")
+
+# Version of the snapshot format, a snapshot of another version is ignored
+snapshot_version = 1
+
+# Name of the member of the snapshot file holding the JSON description of the state
+meta_member = "meta"
+
+##################################################
+
+
+def encode_value(value, arrays):
+    """
+    Converts a value of the state to JSON, moving its arrays and bytes to 'arrays'.
+
+    :param value: JSON value, bytes, NumPy array, or a list or dictionary of them.
+    :param arrays: Dictionary receiving the arrays, by member name.
+    :return: JSON value, where arrays and bytes are replaced by a reference to their member.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        name = str(len(arrays))
+        arrays[name] = np.frombuffer(bytes(value), dtype=np.uint8)
+        return {'$bytes': name}
+    if isinstance(value, np.ndarray):
+        name = str(len(arrays))
+        arrays[name] = value
+        return {'$array': name}
+    if isinstance(value, dict):
+        return {key: encode_value(item, arrays) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item, arrays) for item in value]
+    return value
+
+
+def decode_value(value, arrays):
+    """
+    Rebuilds a value encoded by encode_value().
+
+    :param value: JSON value.
+    :param arrays: Loaded snapshot file, giving the arrays by member name.
+    :return: Value, with its arrays and bytes.
+    """
+    if isinstance(value, dict):
+        if '$bytes' in value:
+            return arrays[value['$bytes']].tobytes()
+        if '$array' in value:
+            return arrays[value['$array']]
+        return {key: decode_value(item, arrays) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_value(item, arrays) for item in value]
+    return value
+
+
+class StateSnapshot:
+    """
+    Periodic snapshot of the state of the devices, reloaded when the server restarts.
+
+    The state of each device is a dictionary of JSON values, bytes and NumPy arrays (e.g.
+    the background model of a motion detector). It is saved in one NumPy .npz file: the
+    arrays are members of the file and a JSON member describes the rest. The file is
+    written under a temporary name and then renamed, so a crash never leaves a partial
+    snapshot. Pickle is never used, so loading a snapshot cannot run code.
+    """
+
+    def __init__(self, path, interval=60.0, collect=None):
+        """
+        Initializes the snapshot.
+
+        :param path: Path of the snapshot file.
+        :param interval: Seconds between two snapshots. Default is 60.
+        :param collect: Function returning the state to save, a dictionary of the state of
+                        each device by device ID. Needed by start().
+        """
+        self.path = path
+        self.interval = interval
+        self.collect = collect
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.saves = 0
+        self.failures = 0
+        self.last_save = None
+        self.last_bytes = 0
+
+    def load(self):
+        """
+        Reads the last snapshot.
+
+        :return: Tuple (time of the snapshot, dictionary of the state of each device), or
+                 (None, {}) if there is no readable snapshot.
+        """
+        try:
+            with np.load(self.path, allow_pickle=False) as arrays:
+                meta = json.loads(arrays[meta_member].tobytes().decode("utf-8"))
+                if meta.get('version') != snapshot_version:
+                    logger.warning("Ignoring snapshot %s of version %s", self.path, meta.get('version'))
+                    return None, {}
+                return meta['timestamp'], decode_value(meta['devices'], arrays)
+        except FileNotFoundError:
+            return None, {}
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable snapshot %s: %s", self.path, e)
+            return None, {}
+
+    def save(self, devices):
+        """
+        Writes a snapshot, replacing the previous one.
+
+        :param devices: Dictionary of the state of each device by device ID.
+        :return: Size of the snapshot file in bytes.
+        """
+        arrays = {}
+        meta = {'version': snapshot_version, 'timestamp': time.time(), 'devices': encode_value(devices, arrays)}
+        arrays[meta_member] = np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)
+
+        # Built in memory, so the file is written in one go
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        data = buffer.getbuffer()
+
+        with self.lock:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            with open(self.path + ".tmp", "wb") as snapshot_file:
+                snapshot_file.write(data)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(self.path + ".tmp", self.path)
+            self.saves += 1
+            self.last_save = meta['timestamp']
+            self.last_bytes = len(data)
+        return len(data)
+
+    def save_now(self):
+        """
+        Saves the state returned by the collect function, logging errors.
+
+        :return: True if the snapshot was written, False otherwise.
+        """
+        try:
+            self.save(self.collect())
+            return True
+        except Exception:
+            self.failures += 1
+            logger.exception("Error while saving the snapshot %s", self.path)
+            return False
+
+    def start(self):
+        """
+        Starts the thread saving a snapshot every 'interval' seconds.
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="snapshot", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """
+        Snapshot loop.
+        """
+        while not self.stop_event.wait(self.interval):
+            self.save_now()
+
+    def close(self):
+        """
+        Stops the snapshot thread and saves a last snapshot.
+        """
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.save_now()
+
+    def stats(self):
+        """
+        Returns the counters of the snapshots.
+
+        :return: Dictionary of statistics.
+        """
+        return {
+            'path': self.path,
+            'interval': self.interval,
+            'saves': self.saves,
+            'failures': self.failures,
+            'last_save': self.last_save,
+            'last_bytes': self.last_bytes,
+        }
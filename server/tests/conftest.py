@@ -0,0 +1,6 @@
+# Import necessary libraries
+import os
+import sys
+
+# The server modules import each other by name, as when run from the server folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
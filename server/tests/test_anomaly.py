@@ -0,0 +1,28 @@
+# Import necessary libraries
+from anomaly import AnomalyDetector
+
+##################################################
+
+
+def test_faulty_readings_keep_the_band():
+    # Out-of-range readings must not shrink the variance, or the next normal reading
+    # would fall outside the band
+    detector = AnomalyDetector()
+    timestamp = 1_700_000_000.0
+    for k in range(100):
+        timestamp += 60.0
+        detector.submit('esp32', timestamp, {'T': 19.5 if k % 2 else 20.5})
+        detector.process(timestamp)
+    var = detector.var[0, 0]
+
+    for k in range(40):
+        timestamp += 60.0
+        detector.submit('esp32', timestamp, {'T': 150.0})
+        detector.process(timestamp)
+    assert detector.var[0, 0] == var
+
+    timestamp += 60.0
+    detector.submit('esp32', timestamp, {'T': 21.2})
+    alerts = detector.process(timestamp)
+    assert not [alert for alert in alerts if alert['kind'] == 'band']
+    assert [alert['state'] for alert in alerts if alert['kind'] == 'range'] == ['cleared']
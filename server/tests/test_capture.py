@@ -0,0 +1,48 @@
+# Import necessary libraries
+from capture import CaptureWriter, read_capture, replay
+
+##################################################
+
+messages = [
+    (1_700_000_000.0, 'home/cam/abc', b'\xff\xd8' + bytes(range(256)) * 4),
+    (1_700_000_000.5, 'home/data/esp32', b'{"T": 21.5, "H": 40, "P": 1013}'),
+    (1_700_000_001.0, 'home/cam', b''),
+]
+
+
+def write_capture(path, records):
+    writer = CaptureWriter(str(path))
+    writer.start()
+    for timestamp, topic, payload in records:
+        assert writer.record(topic, payload, timestamp)
+    writer.close()
+
+
+def test_capture_round_trip(tmp_path):
+    path = tmp_path / "traffic.cap"
+    write_capture(path, messages)
+    assert [tuple(record) for record in read_capture(str(path))] == messages
+
+
+def test_reopened_capture_is_appended_after_a_partial_record(tmp_path):
+    path = tmp_path / "traffic.cap"
+    write_capture(path, messages[:2])
+
+    # A crash cut the last record
+    with open(path, "r+b") as capture_file:
+        capture_file.truncate(path.stat().st_size - 5)
+    assert [tuple(record) for record in read_capture(str(path))] == messages[:1]
+
+    write_capture(path, messages[2:])
+    assert [tuple(record) for record in read_capture(str(path))] == [messages[0], messages[2]]
+
+
+def test_replay_feeds_every_message_in_order(tmp_path):
+    path = tmp_path / "traffic.cap"
+    write_capture(path, messages)
+    received = []
+    result = replay(read_capture(str(path)), lambda topic, payload: received.append((topic, payload)), speed=0)
+
+    assert received == [(topic, payload) for _, topic, payload in messages]
+    assert result['messages'] == 3
+    assert result['recorded_seconds'] == 1.0
@@ -0,0 +1,98 @@
+# Import necessary libraries
+import json
+from cluster import Cluster, HashRing
+
+##################################################
+
+devices = [f"cam{index}" for index in range(1000)]
+
+
+def device_of(topic):
+    prefix, _, device_id = topic.rpartition('/')
+    return device_id if prefix == 'home/cam' else None
+
+
+class RecordingClient:
+    """
+    Stands for the MQTT client, keeping the published messages.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, retain=False):
+        self.published.append((topic, payload, retain))
+
+
+def test_ring_spreads_devices_over_instances():
+    ring = HashRing(['a', 'b', 'c'])
+    counts = {}
+    for device_id in devices:
+        counts[ring.owner(device_id)] = counts.get(ring.owner(device_id), 0) + 1
+    assert set(counts) == {'a', 'b', 'c'}
+    assert min(counts.values()) > 200
+
+
+def test_only_devices_of_a_leaving_instance_move():
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b'])
+    for device_id in devices:
+        if before.owner(device_id) != 'c':
+            assert after.owner(device_id) == before.owner(device_id)
+
+
+def test_joining_instance_only_takes_devices():
+    before = HashRing(['a', 'b'])
+    after = HashRing(['a', 'b', 'c'])
+    moved = [device_id for device_id in devices if after.owner(device_id) != before.owner(device_id)]
+    assert moved
+    assert all(after.owner(device_id) == 'c' for device_id in moved)
+
+
+def test_message_of_another_instance_is_forwarded_once():
+    cluster = Cluster('a', 'http://a', device_of)
+    client = RecordingClient()
+    cluster.route(client, 'home/cluster/members/b', json.dumps({'url': 'http://b'}))
+    theirs = next(device_id for device_id in devices if cluster.owner(device_id) == 'b')
+    mine = next(device_id for device_id in devices if cluster.owner(device_id) == 'a')
+
+    assert cluster.route(client, f'home/cam/{mine}', b'frame') == f'home/cam/{mine}'
+    assert cluster.route(client, f'home/cam/{theirs}', b'frame') is None
+    assert client.published == [(f'home/cluster/forward/b/home/cam/{theirs}', b'frame', False)]
+
+    # A forwarded message is handled even if the ring changed meanwhile
+    assert cluster.route(client, f'home/cluster/forward/a/home/cam/{theirs}', b'frame') == f'home/cam/{theirs}'
+
+
+def test_cameras_of_a_leaving_instance_move_to_their_new_owner():
+    cluster = Cluster('a', 'http://a', device_of, control_prefix='home/control')
+    client = RecordingClient()
+    cluster.route(client, 'home/cluster/members/b', json.dumps({'url': 'http://b'}))
+    theirs = [device_id for device_id in devices[:50] if cluster.owner(device_id) == 'b']
+    for device_id in theirs:
+        control = {'interval': 5.0, 'topic': f'home/cluster/direct/b/home/cam/{device_id}'}
+        cluster.route(client, f'home/control/{device_id}', json.dumps(control))
+    assert client.published == []
+
+    # b leaves: its last will clears its announcement
+    cluster.route(client, 'home/cluster/members/b', b'')
+    assert sorted(client.published) == sorted(
+        (f'home/control/{device_id}',
+         json.dumps({'interval': 5.0, 'topic': f'home/cluster/direct/a/home/cam/{device_id}'}), True)
+        for device_id in theirs)
+
+    # The moved cameras then publish straight to this instance
+    assert cluster.route(client, f'home/cluster/direct/a/home/cam/{theirs[0]}', b'frame') == f'home/cam/{theirs[0]}'
+    assert cluster.stats()['direct'] == 1
+    assert cluster.stats()['forwarded'] == 0
+
+
+def test_direct_message_of_a_moved_camera_is_forwarded_to_its_owner():
+    cluster = Cluster('a', 'http://a', device_of, control_prefix='home/control')
+    client = RecordingClient()
+    cluster.route(client, 'home/cluster/members/b', json.dumps({'url': 'http://b'}))
+    theirs = next(device_id for device_id in devices if cluster.owner(device_id) == 'b')
+
+    # The camera was told a's topic before b joined
+    assert cluster.route(client, f'home/cluster/direct/a/home/cam/{theirs}', b'frame') is None
+    assert client.published == [(f'home/cluster/forward/b/home/cam/{theirs}', b'frame', False)]
@@ -0,0 +1,75 @@
+# Import necessary libraries
+import os
+import json
+import pytest
+import server_pub
+
+##################################################
+
+
+@pytest.fixture(autouse=True)
+def restore_settings():
+    # load_config() changes the settings of the module
+    saved = {name: getattr(server_pub, name) for name in server_pub.config_settings}
+    yield
+    for name, value in saved.items():
+        setattr(server_pub, name, value)
+
+
+def test_environment_overrides_configuration_file(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({'mqtt_broker_host': 'broker.local', 'detection_workers': 3, 'motion_on_score': 1}))
+    environ = {
+        'SERVER_PUB_DETECTION_WORKERS': '4',
+        'SERVER_PUB_MQTT_TOPICS': '["home/cam/+"]',
+        'SERVER_PUB_IN_MEMORY_FRAMES': 'false',
+        'SERVER_PUB_HTTP_HOST': '10',
+        'SERVER_PUB_SNAPSHOT_FILE': 'null',
+    }
+    settings = server_pub.load_config(str(path), environ)
+
+    assert settings['mqtt_broker_host'] == server_pub.mqtt_broker_host == 'broker.local'
+    assert server_pub.detection_workers == 4
+    assert server_pub.motion_on_score == 1.0 and isinstance(server_pub.motion_on_score, float)
+    assert server_pub.mqtt_topics == ["home/cam/+"]
+    assert server_pub.in_memory_frames is False
+    # String settings are not parsed
+    assert server_pub.http_host == '10'
+    assert server_pub.snapshot_file is None
+
+
+def test_configuration_file_named_by_environment(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({'http_port': 8080}))
+    server_pub.load_config(environ={'SERVER_PUB_CONFIG': str(path)})
+    assert server_pub.http_port == 8080
+
+
+@pytest.mark.parametrize('environ', [
+    {'SERVER_PUB_DETECTION_WORKERS': 'two'},
+    {'SERVER_PUB_DETECTION_WORKERS': '2.5'},
+    {'SERVER_PUB_IN_MEMORY_FRAMES': '2'},
+    {'SERVER_PUB_MQTT_TOPICS': '"home/cam/+"'},
+    {'SERVER_PUB_HTTP_PORT': 'null'},
+])
+def test_value_of_the_wrong_type_is_rejected(environ):
+    workers = server_pub.detection_workers
+    with pytest.raises(ValueError):
+        server_pub.load_config(environ=environ)
+    assert server_pub.detection_workers == workers
+
+
+def test_unknown_setting_is_rejected(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({'detection_worker': 4}))
+    with pytest.raises(ValueError, match="detection_worker"):
+        server_pub.load_config(str(path), {})
+
+
+def test_output_folder_follows_static_folder(tmp_path):
+    server_pub.load_config(environ={'SERVER_PUB_STATIC_IMAGE_FOLDER': str(tmp_path)})
+    assert server_pub.output_folder == os.path.join(str(tmp_path), 'MONITORING')
+
+    server_pub.load_config(environ={'SERVER_PUB_STATIC_IMAGE_FOLDER': str(tmp_path),
+                                    'SERVER_PUB_OUTPUT_FOLDER': str(tmp_path / 'events')})
+    assert server_pub.output_folder == str(tmp_path / 'events')
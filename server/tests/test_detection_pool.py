@@ -0,0 +1,86 @@
+# Import necessary libraries
+import os
+import time
+import numpy as np
+import pytest
+from detection_pool import DetectionPool
+from detectors import RunningAverageDetector
+
+##################################################
+
+
+def moving_frames(count, shape=(60, 80), seed=0):
+    """
+    Generates grayscale frames of a square moving over a noisy background.
+    """
+    generator = np.random.default_rng(seed)
+    background = generator.integers(0, 60, shape, dtype=np.uint8)
+    frames = []
+    for k in range(count):
+        frame = background.copy()
+        x = (k * 7) % (shape[1] - 10)
+        frame[20:30, x:x + 10] = 255
+        frames.append(frame)
+    return frames
+
+
+@pytest.fixture
+def pool():
+    pool = DetectionPool(num_processes=2, slot_bytes=80 * 60, slots=3)
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+def test_pool_results_match_local_detector(pool):
+    frames = moving_frames(30)
+    local = RunningAverageDetector()
+    expected = [local.update(frame) for frame in frames]
+
+    # Every frame is submitted before any reply is read: the slots of the ring are reused
+    pending = [pool.submit('cam', frame) for frame in frames]
+    results = [future.result(timeout=30)[0] for future in pending]
+    assert results == expected
+
+
+def test_frames_too_large_for_a_slot_go_through_the_pipe(pool):
+    frame = moving_frames(1, shape=(120, 160))[0]
+    result, _ = pool.detect('cam', frame)
+    assert result is None
+
+
+def test_state_requests_do_not_assign_cameras(pool):
+    local = RunningAverageDetector()
+    for frame in moving_frames(3):
+        local.update(frame)
+    state = local.get_state()
+
+    pool.set_state('cam', state)
+    assert pool.get_state('cam') is state
+    stats = pool.stats()
+    assert stats['requests'] == 0
+    assert stats['cameras_per_process'] == [0, 0]
+
+    # The restored model is loaded with the first frame, which is compared with it
+    frame = moving_frames(4)[3]
+    result, _ = pool.detect('cam', frame)
+    assert result == local.update(frame)
+    assert pool.stats()['requests'] == 1
+
+
+@pytest.mark.skipif((os.cpu_count() or 1) < 4, reason="needs at least 4 cores")
+def test_throughput_grows_with_processes():
+    frames = moving_frames(60, shape=(480, 640))
+    elapsed = {}
+    for processes in (1, 4):
+        pool = DetectionPool(processes, slot_bytes=640 * 480, detector='mog2')
+        pool.start()
+        try:
+            start = time.perf_counter()
+            pending = [pool.submit(f"cam{k % 4}", frame) for k, frame in enumerate(frames * 2)]
+            for future in pending:
+                future.result(timeout=60)
+            elapsed[processes] = time.perf_counter() - start
+        finally:
+            pool.stop()
+    assert elapsed[4] < elapsed[1] / 1.5
@@ -0,0 +1,50 @@
+# Import necessary libraries
+import numpy as np
+import pytest
+import server_pub
+from detectors import motion_detectors
+
+##################################################
+
+
+def still_frame(shape=(60, 80)):
+    return np.full(shape, 40, dtype=np.uint8)
+
+
+def moved_frame(shape=(60, 80)):
+    frame = still_frame(shape)
+    frame[20:40, 30:50] = 220
+    return frame
+
+
+@pytest.mark.parametrize('name', sorted(motion_detectors))
+def test_detector_returns_nothing_while_warming_up(name):
+    detector = motion_detectors[name]()
+    results = [detector.update(still_frame()) for _ in range(detector.warmup_frames)]
+    assert results == [None] * detector.warmup_frames
+
+    result = detector.update(moved_frame())
+    assert result is not None
+    assert result.score > 0
+    assert result.boxes
+
+
+@pytest.mark.parametrize('name', sorted(motion_detectors))
+def test_detector_warms_up_again_when_the_resolution_changes(name):
+    detector = motion_detectors[name]()
+    for _ in range(detector.warmup_frames + 1):
+        detector.update(still_frame())
+    assert detector.update(still_frame((30, 40))) is None
+
+
+def test_hysteresis_keeps_motion_between_thresholds(monkeypatch):
+    monkeypatch.setattr(server_pub, 'motion_on_score', 0.01)
+    monkeypatch.setattr(server_pub, 'motion_off_score', 0.003)
+
+    # Starts at the upper threshold only
+    assert not server_pub.apply_hysteresis(False, 0.005)
+    assert server_pub.apply_hysteresis(False, 0.01)
+
+    # Goes on until the score falls to the lower threshold
+    assert server_pub.apply_hysteresis(True, 0.005)
+    assert not server_pub.apply_hysteresis(True, 0.003)
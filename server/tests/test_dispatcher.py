@@ -0,0 +1,49 @@
+# Import necessary libraries
+import threading
+from server_pub import DetectionDispatcher
+
+##################################################
+
+
+def test_full_queue_drops_oldest_frame_of_same_camera():
+    # Not started: the frames stay in the queue
+    dispatcher = DetectionDispatcher(lambda camera_id, payload: None, num_workers=1, max_queue_size=3)
+    assert not dispatcher.submit('cam1', b'a1')
+    assert not dispatcher.submit('cam2', b'b1')
+    assert not dispatcher.submit('cam1', b'a2')
+
+    assert dispatcher.submit('cam1', b'a3')
+    assert list(dispatcher.queue) == [('cam2', b'b1'), ('cam1', b'a2'), ('cam1', b'a3')]
+    assert dispatcher.stats()['dropped'] == {'cam1': 1}
+
+
+def test_full_queue_drops_oldest_frame_when_camera_has_none_queued():
+    dispatcher = DetectionDispatcher(lambda camera_id, payload: None, num_workers=1, max_queue_size=2)
+    dispatcher.submit('cam1', b'a1')
+    dispatcher.submit('cam2', b'b1')
+
+    assert dispatcher.submit('cam3', b'c1')
+    assert list(dispatcher.queue) == [('cam2', b'b1'), ('cam3', b'c1')]
+    assert dispatcher.stats()['dropped'] == {'cam1': 1}
+
+
+def test_frames_of_a_camera_are_processed_in_order():
+    processed = []
+    done = threading.Event()
+
+    def handler(camera_id, payload):
+        processed.append((camera_id, payload))
+        if len(processed) == 20:
+            done.set()
+
+    dispatcher = DetectionDispatcher(handler, num_workers=4, max_queue_size=20)
+    for index in range(10):
+        dispatcher.submit('cam1', index)
+        dispatcher.submit('cam2', index)
+    dispatcher.start()
+    assert done.wait(10)
+    dispatcher.stop()
+
+    for camera_id in ('cam1', 'cam2'):
+        assert [payload for queued_id, payload in processed if queued_id == camera_id] == list(range(10))
+    assert dispatcher.stats()['processed'] == 20
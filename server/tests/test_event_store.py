@@ -0,0 +1,88 @@
+# Import necessary libraries
+import os
+import cv2
+import numpy as np
+from event_store import EventStore
+
+##################################################
+
+
+def noisy_image(seed, shape=(120, 160, 3)):
+    """
+    Generates a color image that does not compress well, so each event has a sizable file.
+    """
+    return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+
+
+def files_size(folder):
+    """
+    Total size of the event files of a store, without its index.
+    """
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(folder)
+               for name in names if name.endswith(('.jpg', '.avi')))
+
+
+def test_eviction_keeps_files_within_budget(tmp_path):
+    store = EventStore(str(tmp_path), max_bytes=100_000, queue_size=32)
+    store.start()
+    event_ids = [store.add('cam1', noisy_image(index), 0.5, [[0, 0, 10, 10]], 1_700_000_000 + index)
+                 for index in range(20)]
+    store.close()
+
+    store = EventStore(str(tmp_path), max_bytes=100_000)
+    remaining = [event['id'] for event in store.list(limit=100)]
+    stats = store.stats()
+    store.close()
+
+    assert 0 < stats['bytes'] <= 100_000
+    assert stats['bytes'] == files_size(tmp_path)
+    # The newest events are kept, the oldest ones evicted
+    assert remaining == event_ids[::-1][:len(remaining)]
+    assert len(remaining) < 20
+
+
+def test_legacy_images_are_indexed_and_evicted_first(tmp_path):
+    for day in range(1, 4):
+        with open(tmp_path / f"monitor_image_202401{day:02d}_120000.jpg", "wb") as image_file:
+            image_file.write(b"\xff\xd8" + b"\0" * 998)
+
+    store = EventStore(str(tmp_path), max_bytes=2_500)
+    events = store.list()
+    store.close()
+
+    # The oldest image does not fit in the budget
+    assert [event['path'] for event in events] == ["monitor_image_20240103_120000.jpg",
+                                                  "monitor_image_20240102_120000.jpg"]
+    assert not os.path.exists(tmp_path / "monitor_image_20240101_120000.jpg")
+
+    # Indexed once only
+    store = EventStore(str(tmp_path), max_bytes=2_500)
+    assert store.stats()['events'] == 2
+    assert store.stats()['bytes'] == 2_000
+    store.close()
+
+
+def test_clip_is_indexed_with_its_key_frame(tmp_path):
+    store = EventStore(str(tmp_path), max_bytes=10 ** 7)
+    store.start()
+    clip = store.open_clip('cam1', 1_700_000_000.0, fps=5)
+    scores = [None, 0.02, 0.08, 0.05, None]
+    for index, score in enumerate(scores):
+        _, encoded = cv2.imencode(".jpg", noisy_image(index))
+        boxes = [[10, 10, 20, 20]] if score is not None else None
+        store.add_clip_frame(clip, encoded.tobytes(), 1_700_000_000.0 + index, score, boxes, (120, 160))
+    store.close_clip(clip)
+    store.close()
+
+    store = EventStore(str(tmp_path), max_bytes=10 ** 7)
+    event = store.get(clip.event_id)
+    stats = store.stats()
+    store.close()
+
+    assert event['kind'] == 'clip'
+    assert event['frames'] == 5
+    assert event['key_frame'] == 2
+    assert event['score'] == 0.08
+    assert event['end_timestamp'] == 1_700_000_004.0
+    # The bytes counted while recording are not counted twice
+    assert stats['bytes'] == event['size'] == files_size(tmp_path)
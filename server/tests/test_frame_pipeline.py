@@ -0,0 +1,75 @@
+# Import necessary libraries
+import cv2
+import numpy as np
+import pytest
+import server_pub
+
+##################################################
+
+
+class RecordingClient:
+    """
+    Stands for the MQTT client, keeping the published messages.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, retain=False):
+        self.published.append((topic, payload))
+
+
+def encode(image):
+    _, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes()
+
+
+def scene(moved=False):
+    image = np.full((240, 320, 3), 60, dtype=np.uint8)
+    if moved:
+        image[80:160, 120:200] = 230
+    return encode(image)
+
+
+@pytest.fixture
+def camera(monkeypatch):
+    monkeypatch.setattr(server_pub, 'motion_detector', 'average')
+    monkeypatch.setattr(server_pub, 'detection_scale', 4)
+    return server_pub.DeviceState('test-camera')
+
+
+@pytest.mark.parametrize('scale', [1, 2, 4, 8])
+def test_detection_frame_is_decoded_at_reduced_size(scale):
+    gray = server_pub.decode_detection_frame(scene(), scale)
+    assert gray.shape == (240 // scale, 320 // scale)
+    assert gray.dtype == np.uint8
+
+
+def test_unsupported_scale_is_rejected():
+    with pytest.raises(ValueError):
+        server_pub.decode_detection_frame(scene(), 3)
+
+
+def test_motion_is_detected_on_the_reduced_frame(camera):
+    client = RecordingClient()
+    server_pub.process_frame_in_memory(client, camera, scene())
+    server_pub.process_frame_in_memory(client, camera, scene(moved=True))
+
+    assert camera.detect_mouv
+    assert camera.motion_score > server_pub.motion_on_score
+    assert (camera.monitoring_topic, "ON") in client.published
+
+
+def test_duplicate_frame_leaves_the_camera_state_untouched(camera):
+    client = RecordingClient()
+    server_pub.process_frame_in_memory(client, camera, scene())
+    server_pub.process_frame_in_memory(client, camera, scene(moved=True))
+    latest_frame, score, published = camera.latest_frame, camera.motion_score, list(client.published)
+
+    # The same payload again, e.g. a retransmission
+    server_pub.process_frame_in_memory(client, camera, scene(moved=True))
+
+    assert camera.detect_mouv
+    assert camera.motion_score == score
+    assert camera.latest_frame is latest_frame
+    assert client.published == published
@@ -0,0 +1,65 @@
+# Import necessary libraries
+import time
+import threading
+import cv2
+import numpy as np
+from image_cache import VariantCache, jpeg_size, resize_image
+
+##################################################
+
+
+def test_least_recently_used_image_is_evicted():
+    cache = VariantCache(max_bytes=250)
+    cache.get(('a',), lambda: b'a' * 100)
+    cache.get(('b',), lambda: b'b' * 100)
+    cache.get(('a',), lambda: b'A' * 100)
+    cache.get(('c',), lambda: b'c' * 100)
+
+    assert list(cache.entries) == [('a',), ('c',)]
+    assert cache.stats()['bytes'] == 200
+    assert cache.stats()['evictions'] == 1
+    assert cache.get(('b',), lambda: b'B' * 100) == b'B' * 100
+
+
+def test_evicted_image_is_read_back_from_the_spill_folder(tmp_path):
+    cache = VariantCache(max_bytes=150, folder=str(tmp_path))
+    cache.get(('a',), lambda: b'a' * 100)
+    cache.get(('b',), lambda: b'b' * 100)
+
+    assert cache.get(('a',), lambda: None) == b'a' * 100
+    assert cache.stats()['disk_hits'] == 1
+
+
+def test_concurrent_requests_share_one_generation():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def generate():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return b'image'
+
+    cache = VariantCache()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(('frame',), generate)))
+               for _ in range(8)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # Lets the other requests reach the cache while the image is being generated
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == [b'image'] * 8
+
+
+def test_variant_is_smaller_and_keeps_the_aspect_ratio():
+    _, encoded = cv2.imencode(".jpg", np.zeros((480, 640, 3), dtype=np.uint8))
+    variant = resize_image(encoded.tobytes(), 160)
+    assert jpeg_size(variant) == (160, 120)
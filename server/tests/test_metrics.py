@@ -0,0 +1,75 @@
+# Import necessary libraries
+import io
+import logging
+import pytest
+from metrics import MetricsRegistry, RateLimitedHandler
+
+##################################################
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    messages = registry.counter("mqtt_messages_total", "MQTT messages received.", ["topic"])
+    messages.inc(topic="home/cam")
+    messages.inc(2, topic='home/"data"')
+    registry.gauge("queue_depth", "Frames waiting.").set(3)
+    sizes = registry.histogram("payload_bytes", "Payload sizes.", ["topic"], buckets=(100, 1000))
+    sizes.observe(50, topic="home/cam")
+    sizes.observe(500, topic="home/cam")
+    sizes.observe(5000, topic="home/cam")
+
+    assert registry.render().splitlines() == [
+        "# HELP mqtt_messages_total MQTT messages received.",
+        "# TYPE mqtt_messages_total counter",
+        'mqtt_messages_total{topic="home/\\"data\\""} 2',
+        'mqtt_messages_total{topic="home/cam"} 1',
+        "# HELP queue_depth Frames waiting.",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3",
+        "# HELP payload_bytes Payload sizes.",
+        "# TYPE payload_bytes histogram",
+        'payload_bytes_bucket{topic="home/cam",le="100"} 1',
+        'payload_bytes_bucket{topic="home/cam",le="1000"} 2',
+        'payload_bytes_bucket{topic="home/cam",le="+Inf"} 3',
+        'payload_bytes_sum{topic="home/cam"} 5550',
+        'payload_bytes_count{topic="home/cam"} 3',
+    ]
+
+
+def test_registry_reads_function_metrics_and_skips_failing_ones():
+    registry = MetricsRegistry()
+    registry.gauge("dropped", "Dropped frames.", ["device"]).set_function(lambda: {("cam1",): 4})
+    registry.gauge("broken", "Failing metric.").set_function(lambda: 1 / 0)
+
+    lines = registry.render().splitlines()
+    assert 'dropped{device="cam1"} 4' in lines
+    assert not any(line.startswith("# HELP broken") for line in lines)
+
+
+def test_registry_rejects_wrong_labels():
+    registry = MetricsRegistry()
+    with pytest.raises(ValueError):
+        registry.counter("events_total", "Events.", ["device"]).inc(camera="cam1")
+
+
+def test_rate_limited_handler_counts_suppressed_records_on_a_copy():
+    limited = io.StringIO()
+    other = io.StringIO()
+    handler = RateLimitedHandler(burst=2, interval=60, stream=limited)
+    logger = logging.getLogger("test_metrics.rate_limit")
+    logger.handlers = [handler, logging.StreamHandler(other)]
+    logger.propagate = False
+    try:
+        for index in range(5):
+            logger.warning("Frame error %d", index)
+        # A new window starts
+        handler.limiter.windows = {key: (start - 60, emitted, suppressed)
+                                   for key, (start, emitted, suppressed) in handler.limiter.windows.items()}
+        logger.warning("Frame error %d", 5)
+    finally:
+        logger.handlers = []
+
+    assert limited.getvalue().splitlines() == ["Frame error 0", "Frame error 1",
+                                               "Frame error 5 (3 similar messages suppressed)"]
+    # The other handlers see every record unchanged
+    assert other.getvalue().splitlines() == [f"Frame error {index}" for index in range(6)]
@@ -0,0 +1,46 @@
+# Import necessary libraries
+import numpy as np
+from detectors import RunningAverageDetector
+from snapshot import StateSnapshot
+
+##################################################
+
+
+def test_snapshot_round_trip(tmp_path):
+    background = np.random.default_rng(0).random((60, 80), dtype=np.float32)
+    devices = {
+        'cam1': {'motion': True, 'frame': b'\xff\xd8\x00\x01', 'model': {'shape': [60, 80], 'background': background}},
+        'esp32': {'data': {'T': 21.5, 'H': 40.0}, 'boxes': [[1, 2, 3, 4]]},
+    }
+    snapshot = StateSnapshot(str(tmp_path / "state" / "snapshot.npz"))
+    snapshot.save(devices)
+
+    timestamp, loaded = StateSnapshot(snapshot.path).load()
+    assert timestamp == snapshot.last_save
+    assert loaded['cam1']['frame'] == b'\xff\xd8\x00\x01'
+    assert loaded['cam1']['motion'] is True
+    assert loaded['cam1']['model']['background'].dtype == np.float32
+    assert np.array_equal(loaded['cam1']['model']['background'], background)
+    assert loaded['esp32'] == devices['esp32']
+
+
+def test_restored_detector_model_gives_the_same_results(tmp_path):
+    frames = [np.full((60, 80), 40 + index, dtype=np.uint8) for index in range(5)]
+    frames[4][20:40, 30:50] = 220
+    detector = RunningAverageDetector()
+    for frame in frames[:4]:
+        detector.update(frame)
+
+    snapshot = StateSnapshot(str(tmp_path / "snapshot.npz"))
+    snapshot.save({'cam1': detector.get_state()})
+    restored = RunningAverageDetector()
+    restored.set_state(snapshot.load()[1]['cam1'])
+
+    assert restored.update(frames[4]) == detector.update(frames[4])
+
+
+def test_unreadable_snapshot_is_ignored(tmp_path):
+    path = tmp_path / "snapshot.npz"
+    path.write_bytes(b"not a snapshot")
+    assert StateSnapshot(str(path)).load() == (None, {})
+    assert StateSnapshot(str(tmp_path / "missing.npz")).load() == (None, {})
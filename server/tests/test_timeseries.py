@@ -0,0 +1,43 @@
+# Import necessary libraries
+import numpy as np
+from timeseries import TimeSeriesStore, downsample
+
+##################################################
+
+
+def fill_store(folder, days, step):
+    """
+    Creates a store holding one sample every 'step' seconds over the last 'days' days.
+
+    :return: Tuple (store, time of the last sample).
+    """
+    store = TimeSeriesStore(str(folder))
+    end = 1_700_000_000.0
+    timestamps = np.arange(end - days * 86400, end, step)
+    series = store.series('esp32', create=True)
+    for timestamp in timestamps:
+        series.append(timestamp, {'T': 20.0, 'H': 50.0, 'P': 1000.0})
+    return store, timestamps[-1]
+
+
+def test_downsample_range_longer_than_minute_rollup(tmp_path):
+    # 14 days at 500 points: the 1-hour rollup has too few buckets and the 1-minute
+    # rollup only keeps 7 days, so the samples must come from the file
+    store, last = fill_store(tmp_path, days=20, step=60)
+    start, end = last - 14 * 86400, last + 1
+    resolution, result = downsample(store, 'esp32', start, end, 500)
+    store.close()
+
+    assert resolution is None
+    timestamps = result['T']['timestamp']
+    assert timestamps[0] - start < 86400
+    assert len(timestamps) == 500
+
+
+def test_downsample_recent_range_uses_rollup(tmp_path):
+    store, last = fill_store(tmp_path, days=3, step=60)
+    resolution, result = downsample(store, 'esp32', last - 2 * 86400, last + 1, 500)
+    store.close()
+
+    assert resolution == 60
+    assert np.allclose(result['T']['mean'], 20.0)
@@ -0,0 +1,613 @@
+# Import necessary libraries
+import os
+import re
+import threading
+import numpy as np
+
+##################################################
+
+## Initialization
+
+# Sensor metrics stored for each device, as sent by the ESP32 on 'home/data'
+# (T: temperature, H: humidity, P: pressure)
+default_metrics = ('T', 'H', 'P')
+
+# Raw samples kept in memory: one week at one sample every 5 seconds
+default_raw_capacity = 7 * 24 * 3600 // 5
+
+# Rollup resolutions (seconds) and the number of buckets kept in memory for each:
+# one week of 1-minute buckets and one year of 1-hour buckets
+default_rollups = {60: 7 * 24 * 60, 3600: 366 * 24}
+
+##################################################
+
+
+class RingBuffer:
+    """
+    Preallocated ring buffer of timestamped rows, kept in time order.
+
+    Timestamps and values are stored in separate contiguous arrays, so a time range is
+    found with a binary search on each of the (at most two) ordered segments of the ring.
+    """
+
+    def __init__(self, capacity, width, dtype=np.float32):
+        """
+        Initializes the ring buffer.
+
+        :param capacity: Maximum number of rows.
+        :param width: Number of values per row.
+        :param dtype: NumPy type of the values. Default is float32.
+        """
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, width), dtype=dtype)
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp, row):
+        """
+        Appends a row, overwriting the oldest one when the buffer is full.
+
+        :param timestamp: Time of the row (seconds since the epoch).
+        :param row: Sequence of values.
+        """
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = row
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def extend(self, timestamps, rows):
+        """
+        Appends several rows at once, overwriting the oldest ones when the buffer is full.
+
+        :param timestamps: Array of timestamps, in time order.
+        :param rows: 2D array of values, one row per timestamp.
+        """
+        n = len(timestamps)
+        if n >= self.capacity:
+            timestamps = timestamps[n - self.capacity:]
+            rows = rows[n - self.capacity:]
+            n = self.capacity
+        index = (self.head + np.arange(n)) % self.capacity
+        self.timestamps[index] = timestamps
+        self.values[index] = rows
+        self.head = (self.head + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    def last_row(self):
+        """
+        Returns the most recent row, as a view that can be updated in place.
+
+        :return: Array of values, or None if the buffer is empty.
+        """
+        if self.count == 0:
+            return None
+        return self.values[(self.head - 1) % self.capacity]
+
+    def oldest(self):
+        """
+        Returns the timestamp of the oldest row.
+
+        :return: Timestamp, or None if the buffer is empty.
+        """
+        if self.count == 0:
+            return None
+        return self.timestamps[self.head if self.count == self.capacity else 0]
+
+    def range(self, start, end):
+        """
+        Returns a copy of the rows with start <= timestamp < end.
+
+        :param start: Start of the range (seconds since the epoch).
+        :param end: End of the range.
+        :return: Tuple (timestamps, values).
+        """
+        if self.count < self.capacity:
+            segments = [(0, self.count)]
+        else:
+            segments = [(self.head, self.capacity), (0, self.head)]
+
+        timestamps = []
+        values = []
+        for first, last in segments:
+            segment = self.timestamps[first:last]
+            i = first + np.searchsorted(segment, start, side='left')
+            j = first + np.searchsorted(segment, end, side='left')
+            timestamps.append(self.timestamps[i:j])
+            values.append(self.values[i:j])
+        return np.concatenate(timestamps), np.concatenate(values)
+
+
+class Rollup:
+    """
+    Incremental min/max/mean of each metric over fixed time buckets.
+
+    Each bucket row holds, for every metric, the number of samples, the minimum, the
+    maximum and the sum. Missing values (NaN) are left out of the bucket.
+    """
+
+    def __init__(self, resolution, capacity, num_metrics):
+        """
+        Initializes the rollup.
+
+        :param resolution: Duration of a bucket, in seconds.
+        :param capacity: Number of buckets kept.
+        :param num_metrics: Number of metrics per sample.
+        """
+        self.resolution = resolution
+        self.num_metrics = num_metrics
+        self.buffer = RingBuffer(capacity, 4 * num_metrics, dtype=np.float64)
+        self.current_start = None
+
+    def bucket_start(self, timestamp):
+        """
+        Start time of the bucket containing a timestamp.
+        """
+        return timestamp - timestamp % self.resolution
+
+    def covers(self, start, latest):
+        """
+        Tells whether the bucket containing 'start' is still kept, given the latest sample.
+
+        :param start: Start of a time range (seconds since the epoch).
+        :param latest: Time of the latest sample added.
+        :return: True if the buckets from 'start' on are all in memory.
+        """
+        oldest = self.bucket_start(latest) - (self.buffer.capacity - 1) * self.resolution
+        return self.bucket_start(start) >= oldest
+
+    def add(self, timestamp, values):
+        """
+        Adds a sample to its bucket, opening a new bucket when the time moves past the current one.
+
+        :param timestamp: Time of the sample.
+        :param values: Array of metric values, NaN when missing.
+        """
+        n = self.num_metrics
+        valid = ~np.isnan(values)
+        start = self.bucket_start(timestamp)
+
+        if start != self.current_start:
+            self.current_start = start
+            self.buffer.append(start, np.concatenate((valid, values, values, np.where(valid, values, 0.0))))
+            return
+
+        row = self.buffer.last_row()
+        row[:n] += valid
+        np.fmin(row[n:2 * n], values, out=row[n:2 * n])
+        np.fmax(row[2 * n:3 * n], values, out=row[2 * n:3 * n])
+        row[3 * n:] += np.where(valid, values, 0.0)
+
+    def extend(self, timestamps, values):
+        """
+        Adds many samples in one vectorized pass (used when loading the file).
+
+        :param timestamps: Array of timestamps, in time order.
+        :param values: 2D array of metric values, one row per timestamp.
+        """
+        if len(timestamps) == 0:
+            return
+
+        # Index of the first sample of each bucket
+        starts = self.bucket_start(timestamps)
+        first = np.concatenate(([0], np.flatnonzero(np.diff(starts)) + 1))
+
+        values = values.astype(np.float64)
+        valid = ~np.isnan(values)
+        rows = np.hstack((
+            np.add.reduceat(valid.astype(np.float64), first, axis=0),
+            np.fmin.reduceat(values, first, axis=0),
+            np.fmax.reduceat(values, first, axis=0),
+            np.add.reduceat(np.where(valid, values, 0.0), first, axis=0),
+        ))
+        starts = starts[first]
+
+        # The first bucket may continue the current one
+        if starts[0] == self.current_start:
+            n = self.num_metrics
+            row = self.buffer.last_row()
+            row[:n] += rows[0, :n]
+            np.fmin(row[n:2 * n], rows[0, n:2 * n], out=row[n:2 * n])
+            np.fmax(row[2 * n:3 * n], rows[0, 2 * n:3 * n], out=row[2 * n:3 * n])
+            row[3 * n:] += rows[0, 3 * n:]
+            starts = starts[1:]
+            rows = rows[1:]
+
+        if len(starts):
+            self.buffer.extend(starts, rows)
+            self.current_start = starts[-1]
+
+    def range(self, start, end, metrics):
+        """
+        Returns the buckets that start in [start, end).
+
+        :param start: Start of the range (seconds since the epoch).
+        :param end: End of the range.
+        :param metrics: Names of the metrics, in storage order.
+        :return: Dictionary of arrays: 'timestamp', then '<metric>_min', '_max', '_mean' and '_count'.
+        """
+        n = self.num_metrics
+        timestamps, rows = self.buffer.range(self.bucket_start(start), end)
+        counts = rows[:, :n]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = rows[:, 3 * n:] / counts
+
+        result = {'timestamp': timestamps}
+        for k, metric in enumerate(metrics):
+            result[f'{metric}_min'] = rows[:, n + k]
+            result[f'{metric}_max'] = rows[:, 2 * n + k]
+            result[f'{metric}_mean'] = means[:, k]
+            result[f'{metric}_count'] = counts[:, k]
+        return result
+
+
+class DeviceSeries:
+    """
+    Sensor history of one device: raw samples, rollups and the append-only file.
+    """
+
+    def __init__(self, path, metrics, raw_capacity, rollups):
+        """
+        Initializes the history of a device and loads the samples already in its file.
+
+        :param path: Path of the device's append-only sample file.
+        :param metrics: Names of the metrics.
+        :param raw_capacity: Number of raw samples kept in memory.
+        :param rollups: Dictionary {resolution in seconds: number of buckets kept}.
+        """
+        self.path = path
+        self.metrics = metrics
+        self.record_dtype = np.dtype([('timestamp', '<f8')] + [(metric, '<f4') for metric in metrics])
+        self.raw = RingBuffer(raw_capacity, len(metrics))
+        self.rollups = {resolution: Rollup(resolution, capacity, len(metrics))
+                        for resolution, capacity in rollups.items()}
+        self.last_timestamp = None
+        self.lock = threading.Lock()
+
+        self._load()
+        self.file = open(path, 'ab', buffering=0)
+
+    def _records(self):
+        """
+        Maps the sample file into memory.
+
+        :return: Structured array of records (read-only memory map), or None if the file is empty.
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < self.record_dtype.itemsize:
+            return None
+        count = os.path.getsize(self.path) // self.record_dtype.itemsize
+        return np.memmap(self.path, dtype=self.record_dtype, mode='r', shape=(count,))
+
+    def _load(self):
+        """
+        Loads the recent samples from the file and rebuilds the rollups.
+        """
+        if os.path.exists(self.path):
+            # Drop a partial record left by an interrupted write
+            size = os.path.getsize(self.path)
+            if size % self.record_dtype.itemsize:
+                os.truncate(self.path, size - size % self.record_dtype.itemsize)
+
+        records = self._records()
+        if records is None:
+            return
+
+        # Only read the samples needed by the raw buffer and the rollup windows
+        timestamps = records['timestamp']
+        horizon = max(rollup.resolution * rollup.buffer.capacity for rollup in self.rollups.values()) \
+            if self.rollups else 0
+        first = min(max(len(records) - self.raw.capacity, 0),
+                    np.searchsorted(timestamps, timestamps[-1] - horizon))
+
+        # Load in chunks to bound the temporary memory
+        chunk_size = 1 << 20
+        for i in range(first, len(records), chunk_size):
+            chunk = records[i:i + chunk_size]
+            chunk_timestamps = np.array(chunk['timestamp'])
+            values = np.column_stack([chunk[metric] for metric in self.metrics])
+            self.raw.extend(chunk_timestamps, values)
+            for rollup in self.rollups.values():
+                rollup.extend(chunk_timestamps, values)
+        self.last_timestamp = timestamps[-1]
+
+    def append(self, timestamp, values):
+        """
+        Records a sample in memory and in the file.
+
+        :param timestamp: Time of the sample. Samples older than the last one are ignored.
+        :param values: Dictionary {metric: value}, missing metrics are stored as NaN.
+        :return: True if the sample was recorded, False otherwise.
+        """
+        row = np.array([values.get(metric, np.nan) for metric in self.metrics], dtype=np.float32)
+        record = np.array([(timestamp, *row)], dtype=self.record_dtype)
+
+        with self.lock:
+            if self.last_timestamp is not None and timestamp < self.last_timestamp:
+                return False
+            self.last_timestamp = timestamp
+            self.raw.append(timestamp, row)
+            for rollup in self.rollups.values():
+                rollup.add(timestamp, row.astype(np.float64))
+            self.file.write(record.tobytes())
+        return True
+
+    def query(self, start, end, resolution=None):
+        """
+        Returns the samples of a time range.
+
+        :param start: Start of the range (seconds since the epoch).
+        :param end: End of the range.
+        :param resolution: None for raw samples, or the resolution of a rollup (e.g. 60).
+        :return: Dictionary of arrays: 'timestamp' and one array per metric (raw), or the
+                 min/max/mean/count arrays of each metric (rollup).
+        """
+        if resolution is not None:
+            if resolution not in self.rollups:
+                raise ValueError(f"No rollup at a resolution of {resolution} s.")
+            with self.lock:
+                return self.rollups[resolution].range(start, end, self.metrics)
+
+        with self.lock:
+            oldest = self.raw.oldest()
+            if oldest is not None and start >= oldest:
+                timestamps, values = self.raw.range(start, end)
+                result = {'timestamp': timestamps}
+                for k, metric in enumerate(self.metrics):
+                    result[metric] = values[:, k]
+                return result
+
+        # Older than the in-memory window: read the range straight from the mapped file
+        records = self._records()
+        if records is None:
+            return {'timestamp': np.empty(0), **{metric: np.empty(0, np.float32) for metric in self.metrics}}
+        i, j = np.searchsorted(records['timestamp'], [start, end], side='left')
+        selected = records[i:j]
+        result = {'timestamp': np.array(selected['timestamp'])}
+        for metric in self.metrics:
+            result[metric] = np.array(selected[metric])
+        return result
+
+    def close(self):
+        """
+        Closes the sample file.
+        """
+        with self.lock:
+            self.file.close()
+
+
+class TimeSeriesStore:
+    """
+    In-process store of the sensor history of every device.
+
+    Each device has preallocated ring buffers of raw samples, 1-minute and 1-hour
+    min/max/mean rollups updated incrementally, and an append-only file of fixed-size
+    records that can be memory-mapped to reload or query older samples.
+    """
+
+    def __init__(self, folder, metrics=default_metrics, raw_capacity=default_raw_capacity, rollups=None):
+        """
+        Initializes the store and loads the devices already recorded in the folder.
+
+        :param folder: Folder of the sample files, one '<device_id>.ts' file per device.
+        :param metrics: Names of the metrics. Default is ('T', 'H', 'P').
+        :param raw_capacity: Number of raw samples kept in memory per device.
+        :param rollups: Dictionary {resolution in seconds: number of buckets kept}.
+        """
+        self.folder = folder
+        self.metrics = tuple(metrics)
+        self.raw_capacity = raw_capacity
+        self.rollups = dict(default_rollups if rollups is None else rollups)
+        self.devices = {}
+        self.lock = threading.Lock()
+
+        # Create the folder if it doesn't exist
+        os.makedirs(folder, exist_ok=True)
+
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith('.ts'):
+                self._open(filename[:-3])
+
+    def _open(self, device_id):
+        """
+        Opens the history of a device.
+        """
+        # Keep file names safe whatever the device ID
+        safe_id = re.sub(r'[^A-Za-z0-9_.-]', '_', device_id)
+        series = DeviceSeries(os.path.join(self.folder, f'{safe_id}.ts'), self.metrics,
+                              self.raw_capacity, self.rollups)
+        self.devices[device_id] = series
+        return series
+
+    def series(self, device_id, create=False):
+        """
+        Returns the history of a device.
+
+        :param device_id: Identifier of the device.
+        :param create: Whether to create the history of an unknown device.
+        :return: DeviceSeries, or None if the device is unknown and create is False.
+        """
+        series = self.devices.get(device_id)
+        if series is None and create:
+            with self.lock:
+                series = self.devices.get(device_id) or self._open(device_id)
+        return series
+
+    def append(self, device_id, timestamp, values):
+        """
+        Records a sample of a device.
+
+        :param device_id: Identifier of the device.
+        :param timestamp: Time of the sample (seconds since the epoch).
+        :param values: Dictionary {metric: value}.
+        :return: True if the sample was recorded, False otherwise.
+        """
+        return self.series(device_id, create=True).append(timestamp, values)
+
+    def query(self, device_id, start, end, resolution=None):
+        """
+        Returns the samples of a device over a time range.
+
+        :param device_id: Identifier of the device.
+        :param start: Start of the range (seconds since the epoch).
+        :param end: End of the range.
+        :param resolution: None for raw samples, or the resolution of a rollup (e.g. 60).
+        :return: Dictionary of arrays (see DeviceSeries.query), or None if the device is unknown.
+        """
+        series = self.series(device_id)
+        if series is None:
+            return None
+        return series.query(start, end, resolution)
+
+    def close(self):
+        """
+        Closes the sample files.
+        """
+        for series in list(self.devices.values()):
+            series.close()
+
+
+##################################################
+
+
+def minmax_downsample(timestamps, mins, maxs, sums, counts, start, end, points):
+    """
+    Downsamples a series into equal-time buckets holding the min, max and mean.
+
+    Works on raw samples (mins = maxs = sums = values, counts = 1) as well as on rollup
+    buckets, so the extremes are kept whatever the source resolution.
+
+    :param timestamps: Array of timestamps, in time order.
+    :param mins: Array of minimum values.
+    :param maxs: Array of maximum values.
+    :param sums: Array of sums of values.
+    :param counts: Array of numbers of values.
+    :param start: Start of the range (seconds since the epoch).
+    :param end: End of the range.
+    :param points: Number of buckets.
+    :return: Dictionary of arrays 'timestamp' (bucket start), 'min', 'max' and 'mean',
+             with empty buckets left out.
+    """
+    if len(timestamps) == 0:
+        empty = np.empty(0)
+        return {'timestamp': empty, 'min': empty, 'max': empty, 'mean': empty}
+
+    # A rollup bucket starting before the range goes into the first bucket
+    edges = np.linspace(start, end, points + 1)[:-1]
+    first = np.searchsorted(timestamps, edges, side='left')
+    first[0] = 0
+    first = np.unique(first[first < len(timestamps)])
+
+    # Bucket of each non-empty group, to report its start time
+    bucket = np.maximum(np.searchsorted(edges, timestamps[first], side='right') - 1, 0)
+    total = np.add.reduceat(np.nan_to_num(sums), first)
+    count = np.add.reduceat(counts, first)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    return {
+        'timestamp': edges[bucket],
+        'min': np.fmin.reduceat(mins, first),
+        'max': np.fmax.reduceat(maxs, first),
+        'mean': mean,
+    }
+
+
+def lttb_downsample(timestamps, values, points):
+    """
+    Downsamples a series with the Largest-Triangle-Three-Buckets algorithm, which keeps
+    the points that matter most to the shape of a line chart.
+
+    :param timestamps: Array of timestamps, in time order.
+    :param values: Array of values (NaN values are left out).
+    :param points: Number of points to keep (at least 3).
+    :return: Dictionary of arrays 'timestamp' and 'value'.
+    """
+    keep = ~np.isnan(values)
+    x = np.asarray(timestamps, dtype=np.float64)[keep]
+    y = np.asarray(values, dtype=np.float64)[keep]
+    n = len(x)
+    if points >= n or points < 3:
+        return {'timestamp': x, 'value': y}
+
+    # The first and last points are always kept, the others are split into buckets
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    previous = 0
+    for k in range(points - 2):
+        first, last = edges[k], edges[k + 1]
+
+        # Average of the next bucket (the last point for the last bucket)
+        if k + 2 < len(edges):
+            next_first, next_last = edges[k + 1], edges[k + 2]
+        else:
+            next_first, next_last = n - 1, n
+        average_x = x[next_first:next_last].mean()
+        average_y = y[next_first:next_last].mean()
+
+        # Point of the bucket forming the largest triangle with the previous point and the average
+        area = np.abs((x[previous] - average_x) * (y[first:last] - y[previous])
+                      - (x[previous] - x[first:last]) * (average_y - y[previous]))
+        previous = first + int(np.argmax(area))
+        selected[k + 1] = previous
+
+    return {'timestamp': x[selected], 'value': y[selected]}
+
+
+def downsample(store, device_id, start, end, points, method='minmax', metrics=None):
+    """
+    Returns the history of a device over a time range, downsampled to about 'points' points.
+
+    The data is read from the coarsest rollup that still has at least 'points' buckets in
+    the range and still holds its start, or from the raw samples (in memory or in the file)
+    otherwise, so long recent ranges never go through every raw sample.
+
+    :param store: TimeSeriesStore.
+    :param device_id: Identifier of the device.
+    :param start: Start of the range (seconds since the epoch).
+    :param end: End of the range.
+    :param points: Number of points wanted.
+    :param method: 'minmax' (min, max and mean per time bucket) or 'lttb'. Default is 'minmax'.
+    :param metrics: Names of the metrics, all of them if None.
+    :return: Tuple (source resolution in seconds or None for raw, {metric: dictionary of arrays}),
+             or None if the device is unknown.
+    """
+    if method not in ('minmax', 'lttb'):
+        raise ValueError(f"Unknown downsampling method {method}, use 'minmax' or 'lttb'.")
+    series = store.series(device_id)
+    if series is None:
+        return None
+    metrics = series.metrics if metrics is None else metrics
+    for metric in metrics:
+        if metric not in series.metrics:
+            raise ValueError(f"Unknown metric {metric}.")
+
+    # A rollup only qualifies if it still holds the start of the range, otherwise the
+    # samples are read from the raw buffer or the file
+    resolution = None
+    latest = end if series.last_timestamp is None else series.last_timestamp
+    for candidate in sorted(series.rollups, reverse=True):
+        if (end - start) / candidate >= points and series.rollups[candidate].covers(start, latest):
+            resolution = candidate
+            break
+
+    data = series.query(start, end, resolution)
+    timestamps = data['timestamp']
+    result = {}
+    for metric in metrics:
+        if resolution is None:
+            values = data[metric]
+            mins = maxs = sums = values
+            counts = (~np.isnan(values)).astype(np.float64)
+        else:
+            mins, maxs = data[f'{metric}_min'], data[f'{metric}_max']
+            values = data[f'{metric}_mean']
+            counts = data[f'{metric}_count']
+            sums = values * counts
+
+        if method == 'lttb':
+            result[metric] = lttb_downsample(timestamps, values, points)
+        else:
+            result[metric] = minmax_downsample(timestamps, mins, maxs, sums, counts, start, end, points)
+    return resolution, result